@@ -1,7 +1,11 @@
-import cython
-import numpy as np
-
-STEPS = [
+# cython: boundscheck=False, wraparound=False, cdivision=True
+#
+# Compiled ADPCM kernel used by adpcmwave.py.
+# Build with "python setup.py build_ext --inplace" and copy the resulting
+# _adpcmwave module next to adpcmwave.py.
+
+cdef int STEPS[49]
+STEPS[:] = [
       256,  272,  304,   336,   368,   400,   448,   496,   544,   592,   656,   720,
       800,  880,  960,  1056,  1168,  1280,  1408,  1552,  1712,  1888,  2080,  2288,
      2512, 2768, 3040,  3344,  3680,  4048,  4464,  4912,  5392,  5936,  6528,  7184,
@@ -9,146 +13,160 @@ STEPS = [
      24832
 ]
 
-CHANGES = [
+cdef int CHANGES[16]
+CHANGES[:] = [
     -1, -1, -1, -1, 2, 4, 6, 8,
     -1, -1, -1, -1, 2, 4, 6, 8
 ]
 
-cdef class AdpcmWave:
-    @cython.cdivision(True)
-    def process_sample_batch(self, samples, samples_len, output, output_offset=0, output_sample_width=2, encode=False):
-        cdef int step_index = 0
-        cdef int pcm_sample = 0
-        cdef int delta = 0
-        cdef int sample = 0
-        cdef int new_sample = 0
-        cdef int sample_encode = 0
-        cdef int v = 0
-        cdef int step = 0
-        cdef int change = 0
-        cdef int mask = 0xfffffffe
-        cdef int idx = 0
-
-        while idx < samples_len:
-            sample = samples[idx]
-
-            step = STEPS[step_index]
-
-            if encode:
-                delta = sample - pcm_sample
-
-                sign = 0
-                if delta < 0:
-                    sign = 0x08
-                    delta = -delta
-
-                v = (delta << 2)
-                v = v // step
-
-                if v > 7:
-                    v = 7
-
-                sample = sign | v
-                sample_encode = sample
-
-            # new_sample = (step >> 3) \
-            #             + ((step >> 2) & -(sample & 1)) \
-            #             + ((step >> 1) & -((sample >> 1) & 1)) \
-            #             + (step & -((sample >> 2) & 1))
-
-            new_sample = (step >> 3)
-            if sample & 0x01:
-                new_sample += (step >> 2) & mask
-            if sample & 0x02:
-                new_sample += (step >> 1) & mask
-            if sample & 0x04:
-                new_sample += step & mask
-
-            change = CHANGES[sample % 16]
-            step_index += change
-
-            if step_index > 48:
-                step_index = 48
-            elif step_index < 0:
-                step_index = 0
-
-            if sample & 0x08:
-                new_sample = -new_sample
-
-            pcm_sample += new_sample
-
-            if pcm_sample > 32767:
-                pcm_sample = 32767
-            elif pcm_sample < -32768:
-                pcm_sample = -32768
-
-            if encode:
-                output[idx * output_sample_width][output_offset] = sample_encode
-            else:
-                output[idx * output_sample_width][output_offset] = pcm_sample
-
-            idx += 1
-
-        return output
-
-
-    @staticmethod
-    def decode_data(data, rate, channels, bits):
-        decoders = [AdpcmWave()]
-
-        if channels == 1:
-            output = np.zeros((len(data) * 2, channels), dtype=np.int16)
-            samples = np.zeros(len(data) * 2, dtype=np.int8)
-
-            idx = 0
-            for i in range(len(data)):
-                samples[idx] = (data[i] >> 4) & 0x0f
-                samples[idx + 1] = data[i] & 0x0f
-                idx += 2
-
-            output = decoders[0].process_sample_batch(samples, len(data) * 2, output, 0, 1)
-        else:
-            output = np.zeros((len(data), channels), dtype=np.int16)
-            decoders.append(AdpcmWave())
-
-            samples = np.zeros(len(data), dtype=np.int8)
-            for i in range(len(data)):
-                samples[i] = (data[i] >> 4) & 0x0f
-
-            decoders[0].process_sample_batch(samples, len(data), output, 0, 1)
-
-            for i in range(len(data)):
-                samples[i] = data[i] & 0x0f
 
-            decoders[1].process_sample_batch(samples, len(data), output, 1, 1)
+cdef inline int step_delta(int step, int sample) nogil:
+    cdef int new_sample = step >> 3
 
-        return output
+    if sample & 0x01:
+        new_sample += step >> 2
+    if sample & 0x02:
+        new_sample += step >> 1
+    if sample & 0x04:
+        new_sample += step
 
-    @staticmethod
-    def encode_data(data, channels):
-        output = np.zeros((len(data), 2), dtype=np.int8)
-        encoders = [AdpcmWave()]
+    if sample & 0x08:
+        new_sample = -new_sample
 
-        if channels == 1:
-            encoders[0].process_sample_batch(data, len(data), output, 0, 1, True)
-        else:
-            encoders.append(AdpcmWave())
+    return new_sample
 
-            samples = np.zeros(len(data), dtype=np.int16)
-            for i in range(len(data)):
-                samples[i] = data[i][0]
 
-            encoders[0].process_sample_batch(samples, len(data), output, 0, 1, True)
+cdef inline int clamp_step_index(int step_index) nogil:
+    if step_index > 48:
+        return 48
+    elif step_index < 0:
+        return 0
+    return step_index
 
-            for i in range(len(data)):
-                samples[i] = data[i][1]
 
-            encoders[1].process_sample_batch(samples, len(data), output, 1, 1, True)
+cdef inline int clamp_pcm(int pcm_sample) nogil:
+    if pcm_sample > 32767:
+        return 32767
+    elif pcm_sample < -32768:
+        return -32768
+    return pcm_sample
 
-        idx = 0
-        output2 = np.zeros(len(data), dtype=np.int8)
-        for i in range(0, len(output)):
-            output2[idx] = ((output[i][0] << 4) | output[i][1]) & 0xff
-            idx += 1
 
-        return output2.tobytes()
+def decode_nibbles(const unsigned char[::1] nibbles, short[::1] output, int step_index, int pcm_sample):
+    cdef Py_ssize_t idx
+    cdef int sample
+
+    with nogil:
+        for idx in range(nibbles.shape[0]):
+            sample = nibbles[idx]
+            pcm_sample = clamp_pcm(pcm_sample + step_delta(STEPS[step_index], sample))
+            step_index = clamp_step_index(step_index + CHANGES[sample])
+            output[idx] = <short>pcm_sample
+
+    return step_index, pcm_sample
+
+
+cdef inline int encode_sample(int sample, int *step_index, int *pcm_sample) nogil:
+    cdef int step = STEPS[step_index[0]]
+    cdef int delta = sample - pcm_sample[0]
+    cdef int encoded = 0
+    cdef int v
+
+    if delta < 0:
+        encoded = 0x08
+        delta = -delta
+
+    v = (delta << 2) // step
+    if v > 7:
+        v = 7
+
+    encoded |= v
+
+    pcm_sample[0] = clamp_pcm(pcm_sample[0] + step_delta(step, encoded))
+    step_index[0] = clamp_step_index(step_index[0] + CHANGES[encoded])
+
+    return encoded
+
+
+def encode_samples(const short[::1] samples, unsigned char[::1] output, int step_index, int pcm_sample):
+    cdef Py_ssize_t idx
+
+    with nogil:
+        for idx in range(samples.shape[0]):
+            output[idx] = <unsigned char>encode_sample(samples[idx], &step_index, &pcm_sample)
+
+    return step_index, pcm_sample
+
+
+def decode_segments(const unsigned char[::1] data, const long long[::1] offsets, const long long[::1] lengths, const long long[::1] channels, short[::1] output, const long long[::1] output_offsets):
+    cdef Py_ssize_t segment
+    cdef Py_ssize_t idx
+    cdef Py_ssize_t offset
+    cdef Py_ssize_t output_offset
+    cdef int value
+    cdef int sample
+    cdef int step_index
+    cdef int pcm_sample
+    cdef int step_index2
+    cdef int pcm_sample2
+
+    with nogil:
+        for segment in range(offsets.shape[0]):
+            offset = offsets[segment]
+            output_offset = output_offsets[segment]
+            step_index = 0
+            pcm_sample = 0
+            step_index2 = 0
+            pcm_sample2 = 0
+
+            for idx in range(lengths[segment]):
+                value = data[offset + idx]
+
+                sample = (value >> 4) & 0x0f
+                pcm_sample = clamp_pcm(pcm_sample + step_delta(STEPS[step_index], sample))
+                step_index = clamp_step_index(step_index + CHANGES[sample])
+                output[output_offset + idx * 2] = <short>pcm_sample
+
+                # Mono streams continue with the same state, stereo streams switch to the right channel
+                sample = value & 0x0f
+                if channels[segment] == 1:
+                    pcm_sample = clamp_pcm(pcm_sample + step_delta(STEPS[step_index], sample))
+                    step_index = clamp_step_index(step_index + CHANGES[sample])
+                    output[output_offset + idx * 2 + 1] = <short>pcm_sample
+                else:
+                    pcm_sample2 = clamp_pcm(pcm_sample2 + step_delta(STEPS[step_index2], sample))
+                    step_index2 = clamp_step_index(step_index2 + CHANGES[sample])
+                    output[output_offset + idx * 2 + 1] = <short>pcm_sample2
+
+
+def encode_segments(const short[::1] samples, const long long[::1] offsets, const long long[::1] lengths, const long long[::1] channels, unsigned char[::1] output, const long long[::1] output_offsets):
+    cdef Py_ssize_t segment
+    cdef Py_ssize_t idx
+    cdef Py_ssize_t offset
+    cdef Py_ssize_t output_offset
+    cdef int step_index
+    cdef int pcm_sample
+    cdef int step_index2
+    cdef int pcm_sample2
+    cdef int high
+    cdef int low
+
+    with nogil:
+        for segment in range(offsets.shape[0]):
+            offset = offsets[segment]
+            output_offset = output_offsets[segment]
+            step_index = 0
+            pcm_sample = 0
+            step_index2 = 0
+            pcm_sample2 = 0
+
+            # lengths are in output bytes, which is always two samples
+            for idx in range(lengths[segment]):
+                high = encode_sample(samples[offset + idx * 2], &step_index, &pcm_sample)
+
+                if channels[segment] == 1:
+                    low = encode_sample(samples[offset + idx * 2 + 1], &step_index, &pcm_sample)
+                else:
+                    low = encode_sample(samples[offset + idx * 2 + 1], &step_index2, &pcm_sample2)
+
+                output[output_offset + idx] = <unsigned char>((high << 4) | low)
@@ -1,6 +1,6 @@
-from distutils.core import setup
+from setuptools import setup, Extension
 from Cython.Build import cythonize
 
 setup(
-    ext_modules=cythonize("adpcmwave.pyx"),
+    ext_modules=cythonize([Extension("_adpcmwave", ["adpcmwave.pyx"])]),
 )
@@ -1,47 +1,368 @@
+# ADPCM codec used by VA3 keysounds and BMP .bin audio
+#
+# Each sample is stored as a 4-bit nibble. Mono data stores two consecutive
+# samples per byte (high nibble first), stereo data stores one frame per byte
+# (left channel in the high nibble, right channel in the low nibble).
+#
+# The compiled kernel from _misc/adpcmwave.pyx is used when it has been built.
+# Without it, decoding runs through the NumPy implementation below. The NumPy
+# encoder is much slower, so encoding goes through adpcmwavetool.exe like before
+# when the tool can run.
+
 import os
+import shutil
 import subprocess
-import tmpfile
+import numpy
 
 import helper
+import tmpfile
 
-def decode_data(data, rate, channels, bits):
-    input_filename = tmpfile.mkstemp()
-    output_filename = tmpfile.mkstemp()
+try:
+    import _adpcmwave
+except ImportError:
+    _adpcmwave = None
 
-    with open(input_filename, "wb") as f:
-        f.write(data)
+ADPCMWAVETOOL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "adpcmwavetool.exe")
 
-    prefix = ""
-    if helper.is_wsl():
-        prefix = "./"
-    elif os.name != "nt":
-        prefix = "wine "
+STEPS = [
+      256,  272,  304,   336,   368,   400,   448,   496,   544,   592,   656,   720,
+      800,  880,  960,  1056,  1168,  1280,  1408,  1552,  1712,  1888,  2080,  2288,
+     2512, 2768, 3040,  3344,  3680,  4048,  4464,  4912,  5392,  5936,  6528,  7184,
+     7904, 8704, 9568, 10528, 11584, 12736, 14016, 15408, 16960, 18656, 20512, 22576,
+     24832
+]
 
-    cmd = "{}adpcmwavetool.exe d \"{}\" \"{}\" {}".format(prefix, helper.get_windows_path(input_filename), helper.get_windows_path(output_filename), channels)
-    subprocess.call(cmd, shell=True)
+CHANGES = [
+    -1, -1, -1, -1, 2, 4, 6, 8,
+    -1, -1, -1, -1, 2, 4, 6, 8
+]
 
-    with open(output_filename, "rb") as f:
-        data = bytearray(f.read())
+STEP_INDEX_MAX = len(STEPS) - 1
 
-    return data
+# Initial (step_index, pcm_sample) of every channel
+INITIAL_STATE = (0, 0)
 
-def encode_data(data, channels):
+
+def use_adpcmwavetool():
+    if _adpcmwave is not None or not os.path.exists(ADPCMWAVETOOL_PATH):
+        return False
+
+    return os.name == "nt" or helper.is_wsl() or shutil.which("wine") is not None
+
+
+def _run_adpcmwavetool(mode, data, channels):
     input_filename = tmpfile.mkstemp()
     output_filename = tmpfile.mkstemp()
 
-    with open(input_filename, "wb") as f:
-        f.write(data)
+    try:
+        with open(input_filename, "wb") as f:
+            f.write(data)
+
+        prefix = ""
+        if os.name != "nt" and not helper.is_wsl():
+            prefix = "wine "
+
+        cmd = "{}\"{}\" {} \"{}\" \"{}\" {}".format(prefix, ADPCMWAVETOOL_PATH, mode, helper.get_windows_path(input_filename), helper.get_windows_path(output_filename), channels)
+        subprocess.call(cmd, shell=True)
+
+        with open(output_filename, "rb") as f:
+            output = f.read()
+
+    finally:
+        for filename in [input_filename, output_filename]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    if len(data) > 0 and len(output) == 0:
+        raise Exception("adpcmwavetool.exe couldn't process the audio")
+
+    return output
+
+
+def _step_delta(step, sample):
+    new_sample = step >> 3
+
+    if sample & 0x01:
+        new_sample += step >> 2
+    if sample & 0x02:
+        new_sample += step >> 1
+    if sample & 0x04:
+        new_sample += step
+
+    if sample & 0x08:
+        new_sample = -new_sample
+
+    return new_sample
+
+
+# DELTAS[step_index][nibble] is the PCM change caused by a nibble
+DELTAS = [[_step_delta(step, sample) for sample in range(16)] for step in STEPS]
+
+_CHANGES_ARRAY = numpy.array(CHANGES, dtype=numpy.int32)
+_DELTAS_ARRAY = numpy.array(DELTAS, dtype=numpy.int64)
+
+
+def _clamped_scan(deltas, start, lo, hi):
+    # Every step is a function x -> min(max(x + a, l), h) and those functions stay
+    # in the same form when composed, so a log2(n) pass prefix scan can be used.
+    a = deltas.astype(numpy.int64)
+    l = numpy.full(len(a), lo, dtype=numpy.int64)
+    h = numpy.full(len(a), hi, dtype=numpy.int64)
+
+    shift = 1
+    while shift < len(a):
+        a_prev, l_prev, h_prev = a[:-shift], l[:-shift], h[:-shift]
+        a_cur, l_cur, h_cur = a[shift:], l[shift:], h[shift:]
+
+        new_l = numpy.minimum(numpy.maximum(l_prev + a_cur, l_cur), h_cur)
+        new_h = numpy.maximum(numpy.minimum(h_prev + a_cur, h_cur), l_cur)
+        new_a = a_prev + a_cur
+
+        a[shift:] = new_a
+        l[shift:] = new_l
+        h[shift:] = new_h
+
+        shift <<= 1
+
+    return numpy.minimum(numpy.maximum(a + start, l), h)
+
+
+def _clamped_cumsum(deltas, start, lo, hi, max_restarts=8):
+    # Computes output[i] = clamp(output[i - 1] + deltas[i], lo, hi) without a Python loop.
+    # Only clamping against lo has a closed form (a running minimum), so that is
+    # tried first and restarted from the first sample that goes above hi.
+    # Audio that keeps hitting hi is handed off to the slower prefix scan.
+    output = numpy.empty(len(deltas), dtype=numpy.int64)
+
+    pos = 0
+    for _ in range(max_restarts):
+        if pos >= len(deltas):
+            return output
+
+        x = numpy.cumsum(deltas[pos:], dtype=numpy.int64)
+        x += start
+
+        lowest = numpy.minimum.accumulate(x)
+        numpy.minimum(lowest, lo, out=lowest)
+        x += lo - lowest
+
+        over = numpy.flatnonzero(x > hi)
+        if len(over) == 0:
+            output[pos:] = x
+            return output
+
+        end = pos + over[0]
+        output[pos:end] = x[:over[0]]
+        output[end] = hi
+
+        start = hi
+        pos = end + 1
+
+    output[pos:] = _clamped_scan(deltas[pos:], start, lo, hi)
+
+    return output
+
+
+def decode_nibbles(nibbles, state=INITIAL_STATE):
+    """Decode a single channel of nibbles into int16 PCM.
+
+    Returns the decoded samples and the (step_index, pcm_sample) state
+    needed to continue decoding the same channel.
+    """
+
+    nibbles = numpy.ascontiguousarray(nibbles, dtype=numpy.uint8)
+    output = numpy.empty(len(nibbles), dtype=numpy.int16)
+
+    if len(nibbles) == 0:
+        return output, state
+
+    step_index, pcm_sample = state
+
+    if _adpcmwave is not None:
+        state = _adpcmwave.decode_nibbles(nibbles, output, step_index, pcm_sample)
+        return output, state
+
+    step_indexes = numpy.empty(len(nibbles), dtype=numpy.int64)
+    step_indexes[0] = step_index
+    step_indexes[1:] = _clamped_cumsum(_CHANGES_ARRAY[nibbles[:-1]], step_index, 0, STEP_INDEX_MAX)
+
+    pcm = _clamped_cumsum(_DELTAS_ARRAY[step_indexes, nibbles], pcm_sample, -32768, 32767)
+    output[:] = pcm
+
+    last_step_index = min(max(int(step_indexes[-1]) + CHANGES[nibbles[-1]], 0), STEP_INDEX_MAX)
+
+    return output, (last_step_index, int(pcm[-1]))
 
-    prefix = ""
-    if helper.is_wsl():
-        prefix = "./"
-    elif os.name != "nt":
-        prefix = "wine "
 
-    cmd = "{}adpcmwavetool.exe e \"{}\" \"{}\" {}".format(prefix, helper.get_windows_path(input_filename), helper.get_windows_path(output_filename), channels)
-    subprocess.call(cmd, shell=True)
+def encode_samples(samples, state=INITIAL_STATE):
+    """Encode a single channel of int16 PCM into nibbles.
 
-    with open(output_filename, "rb") as f:
-        data = bytearray(f.read())
+    Returns the nibbles and the (step_index, pcm_sample) state needed to
+    continue encoding the same channel.
+    """
 
-    return data
+    samples = numpy.ascontiguousarray(samples, dtype=numpy.int16)
+    output = numpy.empty(len(samples), dtype=numpy.uint8)
+
+    if len(samples) == 0:
+        return output, state
+
+    step_index, pcm_sample = state
+
+    if _adpcmwave is not None:
+        state = _adpcmwave.encode_samples(samples, output, step_index, pcm_sample)
+        return output, state
+
+    # Every nibble depends on the previous reconstructed sample, so this can't be vectorized
+    encoded = [0] * len(samples)
+    for idx, sample in enumerate(samples.tolist()):
+        step = STEPS[step_index]
+        delta = sample - pcm_sample
+
+        nibble = 0
+        if delta < 0:
+            nibble = 0x08
+            delta = -delta
+
+        nibble |= min((delta << 2) // step, 7)
+
+        pcm_sample = min(max(pcm_sample + DELTAS[step_index][nibble], -32768), 32767)
+        step_index = min(max(step_index + CHANGES[nibble], 0), STEP_INDEX_MAX)
+        encoded[idx] = nibble
+
+    output[:] = encoded
+
+    return output, (step_index, pcm_sample)
+
+
+def split_nibbles(data, channels):
+    data = numpy.frombuffer(data, dtype=numpy.uint8)
+
+    if channels == 1:
+        nibbles = numpy.empty((len(data), 2), dtype=numpy.uint8)
+        numpy.right_shift(data, 4, out=nibbles[:, 0])
+        numpy.bitwise_and(data, 0x0f, out=nibbles[:, 1])
+        return [nibbles.reshape(-1)]
+
+    return [data >> 4, data & 0x0f]
+
+
+def join_nibbles(nibbles):
+    if len(nibbles) == 1:
+        nibbles = nibbles[0]
+        nibbles = nibbles[:len(nibbles) - (len(nibbles) % 2)]
+        return (nibbles[0::2] << 4) | nibbles[1::2]
+
+    return (nibbles[0] << 4) | nibbles[1]
+
+
+def decode_batch(data, slices):
+    """Decode several ADPCM streams stored in one buffer.
+
+    slices is a list of (offset, length, channels) tuples describing where each
+    stream is in data. All streams are decoded into one shared int16 array and
+    a (frames, channels) view into it is returned for every slice.
+    """
+
+    # Slices running past the end of the buffer are truncated
+    slices = [(offset, max(min(length, len(data) - offset), 0), channels) for offset, length, channels in slices]
+
+    offsets = numpy.array([offset for offset, _, _ in slices], dtype=numpy.int64)
+    lengths = numpy.array([length for _, length, _ in slices], dtype=numpy.int64)
+    channels = numpy.array([channel for _, _, channel in slices], dtype=numpy.int64)
+
+    output_offsets = numpy.zeros(len(slices), dtype=numpy.int64)
+    numpy.cumsum(lengths[:-1] * 2, out=output_offsets[1:])
+    arena = numpy.empty(int(lengths.sum()) * 2, dtype=numpy.int16)
+
+    if _adpcmwave is not None:
+        _adpcmwave.decode_segments(numpy.frombuffer(data, dtype=numpy.uint8), offsets, lengths, channels, arena, output_offsets)
+
+    else:
+        data = memoryview(data)
+
+        for (offset, length, channel), output_offset in zip(slices, output_offsets):
+            output = arena[output_offset:output_offset + length * 2].reshape(-1, channel)
+
+            for idx, nibbles in enumerate(split_nibbles(data[offset:offset + length], channel)):
+                output[:, idx], _ = decode_nibbles(nibbles)
+
+    return [arena[output_offset:output_offset + length * 2].reshape(-1, channel) for (_, length, channel), output_offset in zip(slices, output_offsets)]
+
+
+def encode_batch(items, alignment=1):
+    """Encode several PCM buffers into one ADPCM buffer.
+
+    items is a list of (samples, channels) tuples. Each encoded stream starts
+    at a multiple of alignment and the gaps are zero filled.
+    Returns the encoded buffer and a list of (offset, length) tuples.
+    """
+
+    items = [(numpy.asarray(samples, dtype=numpy.int16).reshape(-1, channels), channels) for samples, channels in items]
+
+    # Mono streams drop a trailing odd sample, like the original tool did
+    lengths = [len(samples) * channels // 2 for samples, channels in items]
+
+    slices = []
+    output_len = 0
+    for length in lengths:
+        slices.append((output_len, length))
+        output_len += length + (-length % alignment)
+
+    output = bytearray(output_len)
+
+    if _adpcmwave is not None and len(items) > 0:
+        arena = numpy.concatenate([samples[:length * 2 // channels].reshape(-1) for (samples, channels), length in zip(items, lengths)])
+        sample_offsets = numpy.zeros(len(items), dtype=numpy.int64)
+        numpy.cumsum(numpy.array(lengths[:-1], dtype=numpy.int64) * 2, out=sample_offsets[1:])
+
+        _adpcmwave.encode_segments(
+            arena,
+            sample_offsets,
+            numpy.array(lengths, dtype=numpy.int64),
+            numpy.array([channels for _, channels in items], dtype=numpy.int64),
+            numpy.frombuffer(output, dtype=numpy.uint8),
+            numpy.array([offset for offset, _ in slices], dtype=numpy.int64)
+        )
+
+    elif use_adpcmwavetool():
+        for (samples, channels), (offset, length) in zip(items, slices):
+            if length == 0:
+                continue
+
+            encoded = _run_adpcmwavetool("e", samples[:length * 2 // channels].tobytes(), channels)
+            output[offset:offset + length] = encoded[:length]
+
+    else:
+        for (samples, channels), (offset, length) in zip(items, slices):
+            nibbles = [encode_samples(samples[:, channel])[0] for channel in range(channels)]
+            output[offset:offset + length] = join_nibbles(nibbles).tobytes()
+
+    return output, slices
+
+
+def decode_chunks(chunks, channels):
+    """Decode an ADPCM stream that arrives in pieces.
+
+    Takes an iterable of byte strings and yields a (frames, channels) int16
+    array for each one, carrying the decoder state across chunk boundaries.
+    """
+
+    states = [INITIAL_STATE] * channels
+
+    for chunk in chunks:
+        output = numpy.empty((len(chunk) * 2 // channels, channels), dtype=numpy.int16)
+
+        for channel, nibbles in enumerate(split_nibbles(chunk, channels)):
+            output[:, channel], states[channel] = decode_nibbles(nibbles, states[channel])
+
+        yield output
+
+
+def decode_data(data, rate, channels, bits):
+    return decode_batch(data, [(0, len(data), channels)])[0]
+
+
+def encode_data(data, channels):
+    output, _ = encode_batch([(data, channels)])
+    return bytes(output)
@@ -1,19 +1,53 @@
 # Audio-related helper functions
 
+import atexit
+import collections
 import fnmatch
 import glob
+import hashlib
+import imageio_ffmpeg
+import json
+import math
+import numpy
 import os
+import struct
 import subprocess
+import threading
 import pydub
+import pydub.utils
 import tmpfile
 
 import helper
 import ifs
 import wavbintool
+import wavfile
 
 helper.check_ffmpeg()
 
-def get_audio_file(filename):
+# Number of input samples on each side of the resampling filter
+RESAMPLE_HALF_TAPS = 16
+
+# Cutoff of the resampling filter relative to the lower of the two Nyquist frequencies
+RESAMPLE_CUTOFF = 0.95
+
+# Maximum amount of decoded audio kept in memory by get_audio_file
+AUDIO_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Sidecar file in each sound folder that remembers durations between runs
+AUDIO_INDEX_FILENAME = ".audio_index.json"
+AUDIO_INDEX_VERSION = 1
+
+# Encoders that ffmpeg doesn't pick by default for a format, same as pydub's export
+ENCODER_CODECS = {
+    'ogg': "libvorbis",
+}
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xfffe
+
+
+def resolve_audio_filename(filename):
     filename = helper.getCaseInsensitivePath(filename)
     if not filename or not os.path.exists(filename):
         return None
@@ -26,17 +60,317 @@ def get_audio_file(filename):
         else:
             filename = wav_filename
 
-    return pydub.AudioSegment.from_file(filename, "wav")
+    return filename
+
+
+class AudioCache:
+    """Byte-limited LRU cache of decoded audio.
+
+    Entries are keyed on the path, modification time and size of the file
+    so an edited file is decoded again. Safe to share between threads.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(filename):
+        stat = os.stat(filename)
+        return (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+
+            if size > self.max_bytes:
+                return
+
+            self.entries[key] = (value, size)
+            self.size += size
+
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'bytes': self.size,
+            }
+
+
+audio_cache = AudioCache(AUDIO_CACHE_MAX_BYTES)
+
+
+def get_audio_file(filename):
+    source_filename = helper.getCaseInsensitivePath(filename)
+    if not source_filename or not os.path.exists(source_filename):
+        return None
+
+    # AudioSegments are immutable, so the same object can be handed to every caller.
+    # The key uses the requested file because .xa files are converted to a new WAV every time.
+    key = AudioCache.get_key(source_filename)
+    output = audio_cache.get(key)
+
+    if output is None:
+        output = pydub.AudioSegment.from_file(resolve_audio_filename(source_filename), "wav")
+        audio_cache.put(key, output, len(output.raw_data))
+
+    return output
+
+
+def read_wav_header(filename):
+    # Returns the format information of a WAV file without reading the audio data,
+    # or None if it isn't a WAV file
+    with open(filename, "rb") as f:
+        riff = f.read(12)
+
+        if len(riff) < 12 or riff[0:4] != b"RIFF" or riff[8:12] != b"WAVE":
+            return None
+
+        info = None
+        while True:
+            chunk_header = f.read(8)
+
+            if len(chunk_header) < 8:
+                return None
+
+            chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+
+            if chunk_id == b"fmt ":
+                fmt = f.read(chunk_size)
+                format_tag, channels, rate, _, _, bits = struct.unpack("<HHIIHH", fmt[:16])
+
+                if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+                    # The real format is the first two bytes of the sub-format GUID
+                    format_tag, = struct.unpack("<H", fmt[24:26])
+
+                info = {
+                    'format': format_tag,
+                    'channels': channels,
+                    'rate': rate,
+                    'bits': bits,
+                }
+
+            elif chunk_id == b"data":
+                if info is None:
+                    return None
+
+                info['data_size'] = chunk_size
+                info['data_offset'] = f.tell()
+                info['frames'] = chunk_size // max(info['channels'] * info['bits'] // 8, 1)
+                return info
+
+            else:
+                f.seek(chunk_size + (chunk_size & 1), 1)
+
+            if chunk_id == b"fmt " and chunk_size & 1:
+                f.seek(1, 1)
+
+
+def is_pcm_wav(filename):
+    info = read_wav_header(filename)
+
+    if not info:
+        return False
+
+    if info['format'] == WAVE_FORMAT_PCM:
+        return info['bits'] in [8, 16, 24, 32]
+
+    return info['format'] == WAVE_FORMAT_IEEE_FLOAT and info['bits'] == 32
+
+
+class AudioIndex:
+    """Duration and format information for the sound files in one folder.
+
+    Stored as AUDIO_INDEX_FILENAME inside the folder so later runs can skip
+    decoding. An entry is refreshed when the file's mtime or size changes.
+    """
+
+    def __init__(self, foldername):
+        self.foldername = foldername
+        self.filename = os.path.join(foldername, AUDIO_INDEX_FILENAME)
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+
+        try:
+            with open(self.filename, "r") as f:
+                index = json.load(f)
+
+            if index.get('version') == AUDIO_INDEX_VERSION:
+                self.entries = index['entries']
+
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def get_info(self, filename):
+        stat = os.stat(filename)
+        name = os.path.basename(filename)
+
+        with self.lock:
+            entry = self.entries.get(name)
+
+        if entry and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            return entry
+
+        entry = read_audio_info(filename)
+        entry['mtime'] = stat.st_mtime_ns
+        entry['size'] = stat.st_size
+
+        with open(filename, "rb") as f:
+            entry['hash'] = hashlib.sha1(f.read()).hexdigest()
+
+        with self.lock:
+            self.entries[name] = entry
+            self.dirty = True
+
+        return entry
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+
+            try:
+                temp_filename = "%s.%d" % (self.filename, os.getpid())
+                with open(temp_filename, "w") as f:
+                    json.dump({'version': AUDIO_INDEX_VERSION, 'entries': self.entries}, f)
+
+                os.replace(temp_filename, self.filename)
+                self.dirty = False
+
+            except OSError:
+                # Read-only sound folders just don't get an index
+                pass
+
+
+audio_indexes = {}
+audio_indexes_lock = threading.Lock()
+
+
+def get_audio_index(foldername):
+    foldername = os.path.abspath(foldername)
+
+    with audio_indexes_lock:
+        if foldername not in audio_indexes:
+            audio_indexes[foldername] = AudioIndex(foldername)
+
+        return audio_indexes[foldername]
+
+
+@atexit.register
+def save_audio_indexes():
+    with audio_indexes_lock:
+        indexes = list(audio_indexes.values())
+
+    for index in indexes:
+        index.save()
+
+
+def read_audio_info(filename):
+    # PCM WAVs are measured from the RIFF header, anything else has to be decoded
+    resolved_filename = resolve_audio_filename(filename)
+    info = read_wav_header(resolved_filename)
+
+    if info and info['format'] in [WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT] and info['rate'] > 0:
+        # Truncated files only count the frames that are actually there
+        data_size = min(info['data_size'], os.path.getsize(resolved_filename) - info['data_offset'])
+        frames = data_size // max(info['channels'] * info['bits'] // 8, 1)
+
+        # Rounded to the millisecond like len() of an AudioSegment
+        return {
+            'duration': round(frames * 1000 / info['rate']) / 1000,
+            'rate': info['rate'],
+            'channels': info['channels'],
+        }
+
+    sound_file = get_audio_file(filename)
+
+    return {
+        'duration': len(sound_file) / 1000,
+        'rate': sound_file.frame_rate,
+        'channels': sound_file.channels,
+    }
 
 
 def get_duration(filename):
     filename = helper.getCaseInsensitivePath(filename)
-    sound_file = get_audio_file(filename)
 
-    if not sound_file:
+    if not filename or not os.path.exists(filename):
         return 0
 
-    return len(sound_file) / 1000
+    return get_audio_index(os.path.dirname(filename)).get_info(filename)['duration']
+
+
+def get_pan_factors(pan_amount):
+    # Same pan law as pydub's AudioSegment.pan(): the side being panned
+    # towards gets up to 3dB louder while the other side is reduced
+    pan_amount = min(max(pan_amount, -1.0), 1.0)
+
+    max_boost_db = pydub.utils.ratio_to_db(2.0)
+    boost_db = abs(pan_amount) * max_boost_db
+
+    boost_factor = pydub.utils.db_to_float(boost_db)
+    reduce_factor = pydub.utils.db_to_float(max_boost_db) - boost_factor
+
+    reduce_factor = pydub.utils.db_to_float(pydub.utils.ratio_to_db(reduce_factor))
+    boost_factor = pydub.utils.db_to_float(boost_db / 2.0)
+
+    if pan_amount < 0:
+        return boost_factor, reduce_factor
+
+    return reduce_factor, boost_factor
+
+
+def apply_pan_and_gain(samples, pan_amount, gain):
+    """Pan and scale int16 samples without going through pydub.
+
+    Gives the same result as AudioSegment.pan(pan_amount) followed by a
+    gain change of gain (as a ratio). Mono input is returned as stereo.
+    """
+
+    samples = numpy.asarray(samples)
+
+    if samples.ndim == 1:
+        samples = samples.reshape(-1, 1)
+
+    output = samples * numpy.array(get_pan_factors(pan_amount), dtype=numpy.float64)
+
+    # Saturate and round down after every step like audioop.mul does
+    numpy.clip(output, -32768, 32767, out=output)
+    numpy.floor(output, out=output)
+
+    if gain != 1:
+        output *= gain
+        numpy.clip(output, -32768, 32767, out=output)
+        numpy.floor(output, out=output)
+
+    return output.astype(numpy.int16)
 
 
 def clip_audio(input_filename, output_filename, duration, loop_duration=0.370):
@@ -91,6 +425,72 @@ def merge_bgm(bgm_info, input_foldername, output_filename=None):
     return temp_filename
 
 
+class AudioEncoder:
+    """Encodes int16 PCM through an ffmpeg pipe while it's being written.
+
+    Blocks passed to write() go straight to ffmpeg, so the whole song
+    never needs to be in memory and encoding overlaps with whatever
+    produces the blocks.
+    """
+
+    def __init__(self, filename, format, rate, channels, bitrate=None, tags=None):
+        self.filename = filename
+
+        cmd = [
+            imageio_ffmpeg.get_ffmpeg_exe(),
+            "-y",
+            "-loglevel", "error",
+            "-f", "s16le", "-ar", str(rate), "-ac", str(channels), "-i", "-",
+        ]
+
+        if format in ENCODER_CODECS:
+            cmd += ["-acodec", ENCODER_CODECS[format]]
+
+        if bitrate and format != "wav":
+            cmd += ["-b:a", bitrate]
+
+        for key, value in (tags or {}).items():
+            cmd += ["-metadata", "{0}={1}".format(key, value)]
+
+        if format == "mp3":
+            cmd += ["-id3v2_version", "4"]
+
+        cmd += ["-f", format, filename]
+
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def write(self, samples):
+        try:
+            self.process.stdin.write(numpy.ascontiguousarray(samples, dtype='<i2').tobytes())
+
+        except BrokenPipeError:
+            # ffmpeg exited early, close() reports why
+            self.close()
+
+    def close(self):
+        if not self.process.stdin.closed:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        error = self.process.stderr.read()
+        self.process.stderr.close()
+
+        if self.process.wait() != 0:
+            raise Exception("Couldn't encode %s: %s" % (self.filename, error.decode(errors='ignore').strip()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.process.kill()
+            self.process.wait()
+
+
 def get_wav_from_xa(input_filename):
     input_filename = helper.getCaseInsensitivePath(input_filename)
 
@@ -126,9 +526,146 @@ def get_wav_from_pcm(input_filename):
     return wav_filename
 
 
+def to_float_samples(data, bits):
+    # Convert integer or float samples read by wavfile into floats between -1.0 and 1.0
+    if data.dtype.kind == 'f':
+        return data.astype(numpy.float64)
+
+    if data.dtype.kind == 'u':
+        return (data.astype(numpy.float64) - 128) / 128
+
+    return data.astype(numpy.float64) / (1 << (bits - 1))
+
+
+def mix_channels(data, channels):
+    if data.shape[1] == channels:
+        return data
+
+    if channels == 1:
+        return data.mean(axis=1, keepdims=True)
+
+    if data.shape[1] == 1:
+        return numpy.repeat(data, channels, axis=1)
+
+    return None
+
+
+def resample(data, rate, new_rate, half_taps=RESAMPLE_HALF_TAPS):
+    """Polyphase resampling of a (frames, channels) float array.
+
+    Upsamples by new_rate / gcd and downsamples by rate / gcd in one step
+    using a Kaiser windowed sinc filter that's split into one short filter
+    per output phase.
+    """
+
+    if rate == new_rate or len(data) == 0:
+        return data
+
+    g = math.gcd(rate, new_rate)
+    up = new_rate // g
+    down = rate // g
+
+    # Prototype low-pass filter at the upsampled rate, centered on half_taps * up
+    taps = (2 * half_taps + 1) * up
+    cutoff = RESAMPLE_CUTOFF / max(up, down)
+    center = half_taps * up
+    t = numpy.arange(taps) - center
+    prototype = numpy.sinc(cutoff * t) * numpy.kaiser(taps, 8.0)
+
+    # phases[p][k] is the weight of input sample (base - k) for outputs in phase p.
+    # Every phase is normalized so the gain at DC is exactly 1
+    phases = prototype.reshape(2 * half_taps + 1, up).T
+    phases = phases / phases.sum(axis=1, keepdims=True)
+
+    output_len = -(-len(data) * up // down)
+    positions = numpy.arange(output_len, dtype=numpy.int64) * down + center
+    phase = positions % up
+    base = positions // up
+
+    # Pad the input so every tap has something to read
+    padding = 2 * half_taps + 1
+    padded = numpy.zeros((len(data) + padding * 2, data.shape[1]), dtype=numpy.float64)
+    padded[padding:padding+len(data)] = data
+    base += padding
+
+    output = numpy.zeros((output_len, data.shape[1]), dtype=numpy.float64)
+    for k in range(phases.shape[1]):
+        output += phases[phase, k][:, None] * padded[base - k]
+
+    return output
+
+
+def get_processed_audio(input_filename, channels=1, bits=16, rate=48000, readloops=False):
+    """Load an audio file as a (frames, channels) array in the requested format.
+
+    PCM WAV files are converted in-process with NumPy. Everything else
+    is decoded through pydub/ffmpeg. Returns (rate, data, bits), plus the
+    loop points if readloops is set, like wavfile.read.
+    """
+
+    source_filename = input_filename
+    input_filename = resolve_audio_filename(input_filename)
+
+    if not input_filename:
+        return None
+
+    if bits == 16 and channels in [1, 2] and is_pcm_wav(input_filename):
+        input_rate, data, input_bits, loops = wavfile.read(input_filename, readloops=True)
+
+        if data.ndim == 1:
+            data = data.reshape(-1, 1)
+
+        if data.dtype != numpy.int16 or data.shape[1] != channels or input_rate != rate:
+            data = mix_channels(to_float_samples(data, input_bits), channels)
+
+        if data is not None:
+            if data.dtype != numpy.int16:
+                data = resample(data, input_rate, rate)
+                data = numpy.clip(numpy.round(data * 32768), -32768, 32767).astype(numpy.int16)
+
+            loops = [(loop_start * rate // input_rate, loop_end * rate // input_rate) for loop_start, loop_end in loops]
+
+            if channels == 1:
+                data = data.reshape(-1)
+
+            return (rate, data, bits) + ((loops,) if readloops else ())
+
+    output = get_audio_file(source_filename)
+
+    if not output:
+        return None
+
+    output = output.set_sample_width(bits // 8).set_channels(channels).set_frame_rate(rate)
+
+    data = numpy.frombuffer(output.raw_data, dtype=numpy.dtype('<i%d' % (bits // 8)))
+
+    if channels > 1:
+        data = data.reshape(-1, channels)
+
+    return (rate, data, bits) + (([],) if readloops else ())
+
+
 def get_processed_wav(input_filename, output_filename=None, channels=1, bits=16, rate=48000):
     input_filename = helper.getCaseInsensitivePath(input_filename)
 
+    if input_filename and input_filename.lower().endswith('.wav') and os.path.exists(input_filename) and is_pcm_wav(input_filename):
+        info = read_wav_header(input_filename)
+
+        if info['format'] == WAVE_FORMAT_PCM and info['bits'] == bits and info['channels'] == channels and info['rate'] == rate:
+            # This file is already the exact requirements, just return the original
+            return input_filename
+
+        processed = get_processed_audio(input_filename, channels=channels, bits=bits, rate=rate, readloops=True)
+
+        if processed:
+            if output_filename == None:
+                output_filename = tmpfile.mkstemp(suffix=".wav")
+
+            rate, data, bits, loops = processed
+            wavfile.write(output_filename, rate, data, loops=loops)
+
+            return output_filename
+
     output = get_audio_file(input_filename)
 
     if not output:
@@ -22,6 +22,11 @@ rmdir /S /Q %release%\manage_packages\__pycache__
 
 
 REM Prepare actual work tools for custom charters
+REM Build the compiled ADPCM codec, adpcmwavetool.exe is used if it isn't available
+pushd _misc
+python setup.py build_ext --inplace
+popd
+copy /Y _misc\_adpcmwave*.pyd %release%\work
 copy /Y adpcmwavetool.exe %release%\work
 copy /Y xa.exe %release%\work
 
@@ -0,0 +1,74 @@
+# Files cached between runs (parsed charts, encoded keysounds)
+#
+# Everything is stored in one folder next to the scripts, so the cache doesn't
+# depend on the working directory. Once the whole cache grows past
+# CACHE_MAX_BYTES the least recently used files are removed.
+
+import glob
+import os
+import threading
+
+CACHE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+def get_cache_filename(category, name):
+    return os.path.join(CACHE_FOLDER, category, name)
+
+
+def read_cache_file(category, name):
+    cache_filename = get_cache_filename(category, name)
+
+    try:
+        with open(cache_filename, "rb") as f:
+            data = f.read()
+
+        # Mark as recently used for evict_cache
+        os.utime(cache_filename)
+
+    except OSError:
+        return None
+
+    return data
+
+
+def write_cache_file(category, name, data):
+    cache_filename = get_cache_filename(category, name)
+    os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+
+    # Write to a temporary name first so other threads and processes never see a partial file
+    temp_filename = "%s.%d.%d.tmp" % (cache_filename, os.getpid(), threading.get_ident())
+    with open(temp_filename, "wb") as f:
+        f.write(data)
+
+    os.replace(temp_filename, cache_filename)
+
+    return cache_filename
+
+
+def evict_cache(keep_filenames=[]):
+    # Remove the least recently used files once the cache grows too big
+    entries = []
+    for filename in glob.glob(os.path.join(CACHE_FOLDER, "*", "*")):
+        if filename.endswith(".tmp"):
+            continue
+
+        try:
+            stat = os.stat(filename)
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        except OSError:
+            pass
+
+    total_size = sum(x[1] for x in entries)
+    for _, size, filename in sorted(entries):
+        if total_size <= CACHE_MAX_BYTES:
+            break
+
+        if filename in keep_filenames:
+            continue
+
+        try:
+            os.remove(filename)
+            total_size -= size
+        except OSError:
+            pass
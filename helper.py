@@ -1,3 +1,6 @@
+import concurrent.futures
+import json
+import multiprocessing
 import platform
 import os
 import shutil
@@ -72,10 +75,23 @@ def romanize(text):
     new_text = conv.do(text)
     return new_text.upper() if text != new_text else text
 
+def get_process_pool(workers=None):
+    # The pools are usually created from worker threads, and forking a process
+    # that has other threads running can deadlock, so workers are always spawned
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
 def check_ffmpeg():
     if not os.path.exists("ffmpeg.exe"):
         exe_path = imageio_ffmpeg.get_ffmpeg_exe()
         ext = os.path.splitext(exe_path)[-1]
         filename = "ffmpeg" + ext
 
-        shutil.copy(exe_path, filename)
\ No newline at end of file
+        shutil.copy(exe_path, filename)
+
+def get_json_data(data):
+    # Charts are passed between plugins as Python objects, but JSON text is still accepted
+    if isinstance(data, (str, bytes, bytearray)):
+        return json.loads(data)
+
+    return data
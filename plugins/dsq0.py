@@ -1,4 +1,3 @@
-import json
 import struct
 
 from plugins.gsq import generate_json_from_data
@@ -98,7 +97,7 @@ class Dsq0Format:
     def to_json(params):
         output_data = generate_json_from_data(params, read_dsq0_data)
         output_data['format'] = Dsq0Format.get_format_name()
-        return json.dumps(output_data, indent=4, sort_keys=True)
+        return output_data
 
     @staticmethod
     def to_chart(params):
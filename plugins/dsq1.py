@@ -1,4 +1,3 @@
-import json
 import struct
 
 from plugins.gsq import generate_json_from_data
@@ -74,7 +73,7 @@ class Dsq1Format:
     def to_json(params):
         output_data = generate_json_from_data(params, read_dsq1_data)
         output_data['format'] = Dsq1Format.get_format_name()
-        return json.dumps(output_data, indent=4, sort_keys=True)
+        return output_data
 
     @staticmethod
     def to_chart(params):
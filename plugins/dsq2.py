@@ -1,4 +1,3 @@
-import json
 import struct
 
 from plugins.gsq import generate_json_from_data
@@ -76,7 +75,7 @@ class Dsq2Format:
     def to_json(params):
         output_data = generate_json_from_data(params, read_dsq2_data)
         output_data['format'] = Dsq2Format.get_format_name()
-        return json.dumps(output_data, indent=4, sort_keys=True)
+        return output_data
 
     @staticmethod
     def to_chart(params):
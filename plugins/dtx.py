@@ -43,14 +43,16 @@
 
 
 import copy
+import bisect
 from fractions import Fraction
-import json
 import math
+import numpy
 from numpy import base_repr
 import os
 import re
 
 import audio
+import helper
 
 dtx_bonus_mapping = {
     "leftcymbal": 0x01,
@@ -238,28 +240,41 @@ class Fraction2:
 #   DTX reading code   #
 ########################
 
-def get_value_from_dtx(target_tag, lines, default=None):
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
-
-        if not matches:
-            continue
-
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
-
-        if tag.startswith(target_tag):
-            return value
-
-    return default
-
-
-def get_bpms_from_dtx(lines):
-    bpms = {}
-    base_bpm = 0
+DTX_LINE_REGEX = re.compile(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)")
+DTX_CHANNEL_REGEX = re.compile(r"(?P<measure>[0-9]{3})(?P<event>[0-9A-F]{2})")
+DTX_RESOURCE_ID_REGEX = re.compile(r"(?P<id>[0-9A-Z]{2})?")
+
+
+def get_resource_id(tag, prefix):
+    # WAV01 -> 1, WAV -> 0
+    resource_id = DTX_RESOURCE_ID_REGEX.match(tag, len(prefix)).group('id')
+    return int(resource_id, 36) if resource_id else 0
+
+
+def tokenize_dtx(lines):
+    """Classify every line of a DTX file in a single pass.
+
+    Returns a dict with the first value of every header tag (indexed by
+    every prefix of the tag, see get_value_from_dtx), the WAV, VOLUME, PAN
+    and BPM resource tables as raw values by resource id, and the channel
+    data by measure and event. Later lines override earlier ones, the same
+    as reading the lines in order.
+    """
+
+    tokens = {
+        'tags': {},
+        'wavs': {},
+        'volumes': {},
+        'pans': {},
+        'bpms': {},
+        'base_bpm': None,
+        'measure_lengths': {},
+        'channels': {},
+        'bonus_notes': [],
+    }
 
     for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
+        matches = DTX_LINE_REGEX.match(line)
 
         if not matches:
             continue
@@ -267,239 +282,161 @@ def get_bpms_from_dtx(lines):
         tag = matches.group('tag').upper()
         value = matches.group('value')
 
-        if tag.startswith("BPM"):
-            matches2 = re.match("BPM(?P<id>[0-9A-Z]{2})?", tag)
-
-            if not matches2:
-                pass
-
-            bpm_id = matches2.group('id')
-
-            if bpm_id:
-                bpm_id = int(bpm_id, 36)
-            else:
-                bpm_id = 0
-
-            bpms[bpm_id] = float(value)
-
-        elif tag.startswith("BASEBPM"):
-            base_bpm = float(value)
-
-    return bpms, base_bpm
+        if tag[0].isdigit():
+            matches2 = DTX_CHANNEL_REGEX.match(tag)
 
+            measure = int(matches2.group('measure'))
+            event = int(matches2.group('event'), 16)
 
-def get_wavs_from_dtx(lines, target_parts, sound_metadata, get_wav_length=True):
-    wav_filenames = {}
-    wav_lengths = {}
+            if event == 0x02:
+                # Measure length event
+                tokens['measure_lengths'][measure] = value
+                continue
 
-    for line in lines:
-        if ';' in line:
-            line = line[:line.index(';')].strip()
+            if event in [0x4c, 0x4d, 0x4e, 0x4f]:  # Bonus notes
+                tokens['bonus_notes'].append((measure, value))
 
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
+            if measure not in tokens['channels']:
+                tokens['channels'][measure] = {}
 
-        if not matches:
+            tokens['channels'][measure][event] = value
             continue
 
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
+        for i in range(1, len(tag) + 1):
+            if tag[:i] not in tokens['tags']:
+                tokens['tags'][tag[:i]] = value
 
         if tag.startswith("WAV") and not tag.startswith("WAVPAN") and not tag.startswith("WAVVOL"):
-            # Handle WAV tags
-            # This can be exported for use by va3 creator
-
-            matches2 = re.match("WAV(?P<id>[0-9A-Z]{2})?", tag)
-
-            if not matches2:
-                pass
-
-            wav_id = matches2.group('id')
-
-            if wav_id:
-                wav_id = int(wav_id, 36)
-            else:
-                wav_id = 0
-
-            wav_filenames[wav_id] = os.sep.join(value.split('\\'))
-
-            if get_wav_length and ('guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts):
-                duration = audio.get_duration(os.path.join(sound_metadata['sound_folder'], value))
-                wav_lengths[wav_id] = int(round(duration * 300))
-            else:
-                wav_lengths[wav_id] = 0
+            # Comments are only stripped from WAV filenames
+            if ';' in line:
+                value = DTX_LINE_REGEX.match(line[:line.index(';')].strip()).group('value')
 
-    return wav_filenames, wav_lengths
+            tokens['wavs'][get_resource_id(tag, "WAV")] = value
 
+        elif tag.startswith("VOLUME"):
+            tokens['volumes'][get_resource_id(tag, "VOLUME")] = value
 
-def get_wav_volumes_from_dtx(lines):
-    wav_volumes = {}
+        elif tag.startswith("WAVVOL"):
+            tokens['volumes'][get_resource_id(tag, "WAVVOL")] = value
 
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
+        elif tag.startswith("PAN"):
+            tokens['pans'][get_resource_id(tag, "PAN")] = value
 
-        if not matches:
-            continue
+        elif tag.startswith("WAVPAN"):
+            tokens['pans'][get_resource_id(tag, "WAVPAN")] = value
 
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
+        if tag.startswith("BPM"):
+            tokens['bpms'][get_resource_id(tag, "BPM")] = value
 
-        if tag.startswith("VOLUME"):
-            valid_tag = "VOLUME"
-        elif tag.startswith("WAVVOL"):
-            valid_tag = "WAVVOL"
-        else:
-            valid_tag = None
+        elif tag.startswith("BASEBPM"):
+            tokens['base_bpm'] = value
 
-        if valid_tag:
-            # Handle VOLUME tags
-            # This can be exported for use by va3 creator
+    return tokens
 
-            matches2 = re.match(valid_tag + "(?P<id>[0-9A-Z]{2})?", tag)
 
-            if not matches2:
-                pass
+def get_value_from_dtx(target_tag, tokens, default=None):
+    return tokens['tags'].get(target_tag, default)
 
-            vol_id = matches2.group('id')
 
-            if vol_id:
-                vol_id = int(vol_id, 36)
-            else:
-                vol_id = 0
+def get_bpms_from_dtx(tokens):
+    bpms = {bpm_id: float(value) for bpm_id, value in tokens['bpms'].items()}
+    base_bpm = float(tokens['base_bpm']) if tokens['base_bpm'] is not None else 0
 
-            wav_volumes[vol_id] = int(value)
+    return bpms, base_bpm
 
-    return wav_volumes
 
+def get_wavs_from_dtx(tokens, target_parts, sound_metadata, get_wav_length=True, wav_durations=None):
+    wav_filenames = {}
+    wav_lengths = {}
 
-def get_wav_pans_from_dtx(lines):
-    wav_pans = {}
+    # Durations can be shared between files that use the same WAV table
+    if wav_durations is None:
+        wav_durations = {}
 
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
+    for wav_id, value in tokens['wavs'].items():
+        # Handle WAV tags
+        # This can be exported for use by va3 creator
+        wav_filenames[wav_id] = os.sep.join(value.split('\\'))
 
-        if not matches:
-            continue
+        if get_wav_length and ('guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts):
+            wav_path = os.path.join(sound_metadata['sound_folder'], value)
 
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
+            if wav_path not in wav_durations:
+                wav_durations[wav_path] = audio.get_duration(wav_path)
 
-        if tag.startswith("PAN"):
-            valid_tag = "PAN"
-        elif tag.startswith("WAVPAN"):
-            valid_tag = "WAVPAN"
+            wav_lengths[wav_id] = int(round(wav_durations[wav_path] * 300))
         else:
-            valid_tag = None
-
-
-        if valid_tag:
-            # Handle PAN tags
-            # This can be exported for use by va3 creator
+            wav_lengths[wav_id] = 0
 
-            matches2 = re.match(valid_tag + "(?P<id>[0-9A-Z]{2})?", tag)
-
-            if not matches2:
-                pass
+    return wav_filenames, wav_lengths
 
-            pan_id = matches2.group('id')
 
-            if pan_id:
-                pan_id = int(pan_id, 36)
-            else:
-                pan_id = 0
+def get_wav_volumes_from_dtx(tokens):
+    # Handle VOLUME tags
+    # This can be exported for use by va3 creator
+    return {vol_id: int(value) for vol_id, value in tokens['volumes'].items()}
 
-            wav_pans[pan_id] = int(value)
 
-    return wav_pans
+def get_wav_pans_from_dtx(tokens):
+    # Handle PAN tags
+    # This can be exported for use by va3 creator
+    return {pan_id: int(value) for pan_id, value in tokens['pans'].items()}
 
 
-def get_bonus_notes_from_dtx(lines, start_offset_padding):
+def get_bonus_notes_from_dtx(tokens, start_offset_padding):
     bonus_notes = {}
 
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
-
-        if not matches:
-            continue
-
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
+    for measure, value in tokens['bonus_notes']:
+        measure += start_offset_padding
 
-        if tag[0].isdigit():
-            matches2 = re.match("(?P<measure>[0-9]{3})(?P<event>[0-9A-F]{2})", tag)
-
-            if not matches2:
-                pass
+        data = [value[i:i+2] for i in range(0, len(value), 2)]
+        for i in range(len(data)):
+            if measure not in bonus_notes:
+                bonus_notes[measure] = {}
 
-            measure = int(matches2.group('measure')) + start_offset_padding
-            event = int(matches2.group('event'), 16)
-
-            if event in [0x4c, 0x4d, 0x4e, 0x4f]:  # Bonus notes
-                data = [value[i:i+2] for i in range(0, len(value), 2)]
-                for i in range(len(data)):
-                    if measure not in bonus_notes:
-                        bonus_notes[measure] = {}
+            if i not in bonus_notes[measure]:
+                bonus_notes[measure][i] = []
 
-                    if i not in bonus_notes[measure]:
-                        bonus_notes[measure][i] = []
-
-                    bonus_notes[measure][i].append(int(data[i], 36))
+            bonus_notes[measure][i].append(int(data[i], 36))
 
     return bonus_notes
 
 
-def get_measure_lengths_from_dtx(lines, start_offset_padding):
+def get_measure_lengths_from_dtx(tokens, start_offset_padding):
     VALID_TIMESIG_DENOMINATORS = [1 << x for x in range(0, 256)]
 
     measure_lengths = {}
 
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
-
-        if not matches:
-            continue
-
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
-
-        if tag[0].isdigit():
-            matches2 = re.match("(?P<measure>[0-9]{3})(?P<event>[0-9A-F]{2})", tag)
-
-            if not matches2:
-                pass
-
-            measure = int(matches2.group('measure')) + start_offset_padding
-            event = int(matches2.group('event'), 16)
-
-            if event != 0x02:
-                continue
-
-            # Measure length event
-            f1 = Fraction(float(value)).limit_denominator()
-            numerator = f1.numerator
-            denominator = f1.denominator
-
-            # How to code this?
-            if denominator == 1:
-                numerator *= 4
-                denominator = 4
-            elif denominator == 2:
-                numerator *= 2
-                denominator = 4
-
-            f2 = Fraction2(numerator, denominator)
-
-            # Add check for impossible time signatures
-            if denominator not in VALID_TIMESIG_DENOMINATORS:
-                print("ERROR: This is an impossible to represent"
-                      "time signature: {}".format(value))
-                print("This came out to be", f2)
-                print("Valid denominators for the time signature"
-                      "must be a power of two...", VALID_TIMESIG_DENOMINATORS[:12])
-                print("Please try simplifying all measures which"
-                      "use the measure length {}".format(value))
-                exit(1)
+    for measure, value in tokens['measure_lengths'].items():
+        measure += start_offset_padding
+
+        # Measure length event
+        f1 = Fraction(float(value)).limit_denominator()
+        numerator = f1.numerator
+        denominator = f1.denominator
+
+        # How to code this?
+        if denominator == 1:
+            numerator *= 4
+            denominator = 4
+        elif denominator == 2:
+            numerator *= 2
+            denominator = 4
+
+        f2 = Fraction2(numerator, denominator)
+
+        # Add check for impossible time signatures
+        if denominator not in VALID_TIMESIG_DENOMINATORS:
+            print("ERROR: This is an impossible to represent"
+                  "time signature: {}".format(value))
+            print("This came out to be", f2)
+            print("Valid denominators for the time signature"
+                  "must be a power of two...", VALID_TIMESIG_DENOMINATORS[:12])
+            print("Please try simplifying all measures which"
+                  "use the measure length {}".format(value))
+            exit(1)
 
-            measure_lengths[measure] = f2
+        measure_lengths[measure] = f2
 
     if 0 not in measure_lengths:
         measure_lengths[0] = Fraction2(4, 4)  # Default to 4/4
@@ -507,60 +444,43 @@ def get_measure_lengths_from_dtx(lines, start_offset_padding):
     return measure_lengths
 
 
-def get_events_by_measure_from_dtx(lines, start_offset_padding):
+def get_events_by_measure_from_dtx(tokens, start_offset_padding):
     events_by_measure = {}
 
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
-
-        if not matches:
-            continue
-
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
-
-        if tag[0].isdigit():
-            matches2 = re.match("(?P<measure>[0-9]{3})(?P<event>[0-9A-F]{2})", tag)
-
-            if not matches2:
-                pass
-
-            measure = int(matches2.group('measure')) + start_offset_padding
-            event = int(matches2.group('event'), 16)
-
-            if event == 0x02:
-                continue
-
-            # Handle specific events
-            if measure not in events_by_measure:
-                events_by_measure[measure] = {}
-
-            events_by_measure[measure][event] = [value[i:i+2] for i in range(0, len(value), 2)]
+    for measure, events in tokens['channels'].items():
+        # Handle specific events
+        events_by_measure[measure + start_offset_padding] = {
+            event: [value[i:i+2] for i in range(0, len(value), 2)]
+            for event, value in events.items()
+        }
 
     return events_by_measure
 
 
 def pad_events(events_by_measure, measure_lengths):
     # Pad all measures to appropriate sizes
+    measure_lengths_keys = sorted(measure_lengths.keys(), key=lambda x: int(x))
+    measure_lengths_measures = [int(x) for x in measure_lengths_keys]
+
     for measure in events_by_measure:
-        for event in events_by_measure[measure]:
-            scale = Fraction(4, 4)
+        scale = Fraction(4, 4)
 
-            measure_lengths_keys = sorted(measure_lengths.keys(), key=lambda x: int(x))
-            matched_measures = [x for x in measure_lengths_keys if int(x) <= measure]
+        idx = bisect.bisect_right(measure_lengths_measures, measure)
+        if idx > 0:
+            scale = measure_lengths[measure_lengths_keys[idx - 1]]
 
-            if len(matched_measures) > 0:
-                scale = measure_lengths[matched_measures[-1]]
+        beat_division = (1920 / scale.denominator) * scale.numerator
 
-            event_count = len(events_by_measure[measure][event])
-            beat_division = (1920 / scale.denominator) * scale.numerator
+        for event in events_by_measure[measure]:
+            chips = events_by_measure[measure][event]
 
-            new_chips = []
-            for i in range(len(events_by_measure[measure][event])):
-                c = events_by_measure[measure][event][i]
+            if len(chips) == 0:
+                continue
 
-                new_chips.append(c)
-                new_chips += ['00'] * (int(beat_division / len(events_by_measure[measure][event])) - 1)
+            # Every chip is followed by enough empty chips to fill its share of the measure
+            step = max(int(beat_division / len(chips)), 1)
+            new_chips = ['00'] * (len(chips) * step)
+            new_chips[::step] = chips
 
             events_by_measure[measure][event] = new_chips
 
@@ -729,190 +649,132 @@ def generate_sound_metadata_map(sound_metadata, wav_filenames, wav_volumes, wav_
     return sound_metadata_map, sound_metadata
 
 
-bpm_cache = {}
-def find_last_bpm(measure, target_beat, bpms_at_measure_beat):
-    global bpm_cache
+def get_measure_beat_division(timesig):
+    # Number of chart beats in one measure
+    return (1920 / timesig.denominator) * (timesig.numerator / (timesig.denominator_orig / 2))
 
-    last_bpm = 0
 
-    if measure in bpm_cache and target_beat in bpm_cache[measure]:
-        return bpm_cache[measure][target_beat]
+def calculate_timestamp_delta(measures, beats, timesig, bpm):
+    # Time in seconds taken by the given number of measures and beats
+    one_measure = (1920 / timesig.denominator) * timesig.numerator
+    beat_ts = (60 / (bpm * (timesig.denominator / 4))) * 300
+    beat_len = (beat_ts * timesig.numerator) / one_measure
 
-    for pk in sorted(bpms_at_measure_beat.keys()):
-        if pk > measure:
-            break
+    return (((measures * one_measure) + beats) * beat_len) / 300
 
-        if pk not in bpms_at_measure_beat:
-            continue
-
-        for subbeat_k in sorted(bpms_at_measure_beat[pk].keys()):
-            is_start = measure == 0 and target_beat == 0
-            if not is_start and pk == measure and subbeat_k > target_beat:
-                break
-
-            last_bpm = bpms_at_measure_beat[pk][subbeat_k]
-
-    if measure not in bpm_cache:
-        bpm_cache[measure] = {}
-
-    bpm_cache[measure][target_beat] = last_bpm
-
-    return last_bpm
-
-def is_mid_bpm(measure, bpms_at_measure_beat):
-    if measure not in bpms_at_measure_beat:
-        return False
-
-    if len(bpms_at_measure_beat[measure].keys()) > 1:
-        return True
 
-    for subbeat_k in sorted(bpms_at_measure_beat[measure].keys()):
-        if subbeat_k > 0:
-            return True
+class TimingMap:
+    """Converts (measure, beat) positions of a chart into timestamps.
 
-    return False
+    The time at the start of every measure is a running total that is
+    extended as needed, and measures that are looked up by beat (or that
+    change BPM in the middle) get a running total for every beat.
+    The totals are summed in the same order as a measure by measure walk
+    from the start of the song, so the results don't depend on which
+    positions were looked up first.
 
+    It also keeps the chart beat at every time signature change so the
+    beat at the start of a measure is a single lookup.
+    """
 
-timestamp_cache = {}
-timestamp_cache2 = {}
-def calculate_current_timestamp(measure, target_beat, measure_lengths, bpms_at_measure_beat):
-    global bpm_cache
-    global timestamp_cache
-    global timestamp_cache2
+    def __init__(self, measure_lengths, bpms_at_measure_beat):
+        self.timesig_measures = sorted(measure_lengths.keys())
+        self.timesigs = [measure_lengths[x] for x in self.timesig_measures]
 
-    def _calculate_current_timestamp(measure, target_beat, prev, timesig, bpm):
-        cache_key = "%d_%d_%d_%d_%f" % (
-            measure,
-            target_beat,
-            timesig.numerator,
-            timesig.denominator,
-            bpm
-        )
+        self.timesig_beats = [0]
+        for i in range(1, len(self.timesig_measures)):
+            measures = self.timesig_measures[i] - self.timesig_measures[i - 1]
+            self.timesig_beats.append(self.timesig_beats[-1] + measures * get_measure_beat_division(self.timesigs[i - 1]))
 
-        if cache_key in timestamp_cache2:
-            return timestamp_cache2[cache_key]
+        self.bpm_positions = []
+        self.bpms = []
+        for measure in sorted(bpms_at_measure_beat.keys()):
+            for beat in sorted(bpms_at_measure_beat[measure].keys()):
+                self.bpm_positions.append((measure, beat))
+                self.bpms.append(bpms_at_measure_beat[measure][beat])
 
-        one_measure = (1920 / timesig.denominator) * timesig.numerator
-        beat_ts = (60 / (bpm * (timesig.denominator / 4))) * 300
-        beat_len = (beat_ts * timesig.numerator) / one_measure
+        # Measures with a BPM change after the first beat
+        self.mid_bpm_measures = set([measure for measure, beat in self.bpm_positions if beat > 0])
+        self.mid_bpm_measures.update([measure for measure in bpms_at_measure_beat if len(bpms_at_measure_beat[measure]) > 1])
 
-        timestamp = (((measure * one_measure) + target_beat) * beat_len) / 300
-        timestamp_cache2[cache_key] = timestamp
+        self.measure_timestamps = [0]
+        self.beat_timestamps = {}
 
-        return timestamp
 
-    if measure in timestamp_cache and target_beat in timestamp_cache[measure]:
-        return timestamp_cache[measure][target_beat]
+    def get_timesig(self, measure):
+        idx = bisect.bisect_right(self.timesig_measures, measure)
+        return self.timesigs[idx - 1] if idx > 0 else None
 
-    measure_lengths_before_target = {}
-    results = [0]
-    keys = sorted(measure_lengths.keys())
 
-    if len(keys) > 0:
-        measure_lengths_before_target[keys[0]] = 0
+    def get_measure_beat(self, measure):
+        # Chart beat at the start of the measure
+        idx = bisect.bisect_right(self.timesig_measures, measure) - 1
+        return self.timesig_beats[idx] + (measure - self.timesig_measures[idx]) * get_measure_beat_division(self.timesigs[idx])
 
-    for cur_measure in range(measure + 1):
-        current_timesig = find_last_timesig(cur_measure, measure_lengths)
 
-        if cur_measure == measure or is_mid_bpm(cur_measure, bpms_at_measure_beat):
-            numerator = current_timesig.numerator
-            denominator = current_timesig.denominator
-            beat_division = int(round((1920 // denominator) * numerator))
+    def get_bpm(self, measure, beat):
+        if measure == 0 and beat == 0:
+            # The song starts with the last BPM set in the first measure
+            beat = math.inf
 
-            for cur_beat in range(beat_division):
-                if cur_measure not in bpm_cache or cur_beat not in bpm_cache[cur_measure]:
-                    current_bpm = find_last_bpm(cur_measure, cur_beat, bpms_at_measure_beat)
-                else:
-                    current_bpm = bpm_cache[cur_measure][cur_beat]
-
-                if cur_measure >= measure and cur_beat >= target_beat:
-                    break
-
-                cache_key = "0_1_%d_%d_%f" % (
-                    current_timesig.numerator,
-                    current_timesig.denominator,
-                    current_bpm
-                )
-
-                results.append(results[-1] + timestamp_cache2.get(cache_key, _calculate_current_timestamp(0, 1, results[-1], current_timesig, current_bpm)))
-        else:
-            cur_beat = 0
+        idx = bisect.bisect_right(self.bpm_positions, (measure, beat))
+        return self.bpms[idx - 1] if idx > 0 else 0
 
-            if cur_measure not in bpm_cache or cur_beat not in bpm_cache[cur_measure]:
-                current_bpm = find_last_bpm(cur_measure, cur_beat, bpms_at_measure_beat)
-            else:
-                current_bpm = bpm_cache[cur_measure][cur_beat]
-
-            cache_key = "1_0_%d_%d_%f" % (
-                current_timesig.numerator,
-                current_timesig.denominator,
-                current_bpm
-            )
 
-            if cache_key in timestamp_cache2:
-                results.append(results[-1] + timestamp_cache2[cache_key])
-            else:
-                results.append(results[-1] + _calculate_current_timestamp(1, 0, results[-1], current_timesig, current_bpm))
+    def get_beat_timestamps(self, measure):
+        # Running total at every beat of a measure, the last entry is the end of the measure
+        if measure in self.beat_timestamps:
+            return self.beat_timestamps[measure]
 
-    if measure not in timestamp_cache:
-        timestamp_cache[measure] = {}
+        timesig = self.get_timesig(measure)
+        beat_division = int(round((1920 // timesig.denominator) * timesig.numerator))
 
-    result = int(round(results[-1] * 300))
-    timestamp_cache[measure][target_beat] = result
+        # The BPM only changes at the positions in bpm_positions, so fill the beats between them at once
+        first_idx = bisect.bisect_left(self.bpm_positions, (measure, -1))
+        last_idx = bisect.bisect_left(self.bpm_positions, (measure + 1, -1))
 
-    return result
+        deltas = numpy.empty(beat_division + 1)
+        deltas[0] = self.get_measure_timestamp(measure)
 
+        # Beats before the first BPM change of the measure use the BPM from earlier measures.
+        # The first beat of the song is handled by get_bpm instead.
+        carry_start = 1 if measure == 0 else 0
+        carry_end = self.bpm_positions[first_idx][1] if first_idx < last_idx else beat_division
+        if carry_start < carry_end:
+            deltas[carry_start + 1:carry_end + 1] = calculate_timestamp_delta(0, 1, timesig, self.bpms[first_idx - 1] if first_idx > 0 else 0)
 
-def find_last_timesig(measure, measure_lengths):
-    last_timesig = None
+        for idx in range(first_idx, last_idx):
+            beat = self.bpm_positions[idx][1]
+            deltas[beat + 1:] = calculate_timestamp_delta(0, 1, timesig, self.bpms[idx])
 
-    for pk in sorted(measure_lengths.keys()):
-        if pk > measure:
-            break
-
-        if pk not in measure_lengths:
-            continue
+        if measure == 0 and beat_division > 0:
+            deltas[1] = calculate_timestamp_delta(0, 1, timesig, self.get_bpm(0, 0))
 
-        last_timesig = measure_lengths[pk]
+        # add.accumulate sums strictly in order, the same as adding one beat at a time
+        timestamps = numpy.add.accumulate(deltas)
+        self.beat_timestamps[measure] = timestamps
 
-    return last_timesig
+        return timestamps
 
 
-def calculate_current_beat(measure, target_beat, measure_lengths):
-    def _calculate_current_beat(measure, target_beat, prev, timesig):
-        numerator = timesig.numerator
-        denominator = timesig.denominator
-        timesig = numerator / (timesig.denominator_orig / 2)
-        beat_division = (1920 / denominator) * timesig
-        return prev + measure * beat_division + target_beat
+    def get_measure_timestamp(self, measure):
+        while len(self.measure_timestamps) <= measure:
+            cur_measure = len(self.measure_timestamps) - 1
 
-    measure_lengths_before_target = {}
-    keys = sorted(measure_lengths.keys())
+            if cur_measure in self.mid_bpm_measures:
+                self.measure_timestamps.append(float(self.get_beat_timestamps(cur_measure)[-1]))
 
-    if len(keys) > 0:
-        measure_lengths_before_target[keys[0]] = 0
+            else:
+                timesig = self.get_timesig(cur_measure)
+                bpm = self.get_bpm(cur_measure, 0)
+                self.measure_timestamps.append(self.measure_timestamps[-1] + calculate_timestamp_delta(1, 0, timesig, bpm))
 
-    last_key = 0
-    for i in range(1, len(keys)):
-        if keys[i] <= int(measure):
-            pk = keys[i-1]
+        return self.measure_timestamps[measure]
 
-            measure_lengths_before_target[keys[i]] = _calculate_current_beat(
-                keys[i] - pk,
-                0,
-                measure_lengths_before_target[keys[i-1]],
-                measure_lengths[keys[i-1]]
-            )
-            last_key = keys[i]
-        else:
-            break
 
-    return _calculate_current_beat(
-        measure - last_key,
-        0,
-        measure_lengths_before_target[last_key],
-        measure_lengths[last_key]
-    )
+    def get_timestamp(self, measure, beat):
+        timestamps = self.get_beat_timestamps(measure)
+        return int(round(float(timestamps[min(beat, len(timestamps) - 1)]) * 300))
 
 
 def add_hold_notes(chart_data, long_note_time_by_measure_beat, long_note_info):
@@ -959,6 +821,16 @@ def generate_timestamp_set(chart, last_event):
     return chart
 
 
+def get_json_keyed_chart(chart):
+    # Charts are handed to the output plugins without going through JSON, so the
+    # beat and timestamp tables get the same string keys in numeric order here
+    for k in ['beats', 'timestamp']:
+        if k in chart:
+            chart[k] = {str(x): chart[k][x] for x in sorted(chart[k], key=float)}
+
+    return chart
+
+
 def get_valid_chart(chart):
     # A chart must have at least 1 note (played) to be considered valid
     if not chart or 'timestamp' not in chart:
@@ -975,14 +847,14 @@ def get_valid_chart(chart):
     return None
 
 
-def get_chart_datas(chart_data, lines):
-    song_title = get_value_from_dtx("TITLE", lines, default="")
-    artist_name = get_value_from_dtx("ARTIST", lines, default="")
-    drum_difficulty = get_value_from_dtx("DLEVEL", lines, default=0)
-    guitar_difficulty = get_value_from_dtx("GLEVEL", lines, default=0)
-    bass_difficulty = get_value_from_dtx("BLEVEL", lines, default=0)
-    pre_image = get_value_from_dtx("PREIMAGE", lines)
-    bpms, base_bpm = get_bpms_from_dtx(lines)
+def get_chart_datas(chart_data, tokens):
+    song_title = get_value_from_dtx("TITLE", tokens, default="")
+    artist_name = get_value_from_dtx("ARTIST", tokens, default="")
+    drum_difficulty = get_value_from_dtx("DLEVEL", tokens, default=0)
+    guitar_difficulty = get_value_from_dtx("GLEVEL", tokens, default=0)
+    bass_difficulty = get_value_from_dtx("BLEVEL", tokens, default=0)
+    pre_image = get_value_from_dtx("PREIMAGE", tokens)
+    bpms, base_bpm = get_bpms_from_dtx(tokens)
     first_bpm = bpms[sorted(bpms.keys(), key=lambda x:int(x))[0]]
 
     drum_chart_data = {
@@ -1066,566 +938,656 @@ def get_chart_datas(chart_data, lines):
     return get_valid_chart(drum_chart_data), get_valid_chart(guitar_chart_data), get_valid_chart(bass_chart_data)
 
 
-# TODO: Try to refactor this more later
-def parse_dtx_to_intermediate(filename,
-                              params,
-                              sound_metadata,
-                              target_parts=['drum', 'guitar', 'bass', 'open']):
-    global timestamp_cache
-    global bpm_cache
-    global timestamp_cache2
-
-    start_offset_padding = params.get('dtx_pad_start', 0)
-
-    timestamp_cache = {}
-    bpm_cache = {}
-    timestamp_cache2 = {}
-    bpms_at_measure_beat = {}
-
-    if not filename or not os.path.exists(filename):
-        return None, None, None, None, sound_metadata
-
+def read_dtx_lines(filename):
     try:
         with open(filename, "r", encoding="shift-jis") as f:
-            lines = [x.strip() for x in f if x.strip().startswith("#")]
+            return [x.strip() for x in f if x.strip().startswith("#")]
     except:
         try:
             with open(filename, "r", encoding="utf-8") as f:
-                lines = [x.strip() for x in f if x.strip().startswith("#")]
+                return [x.strip() for x in f if x.strip().startswith("#")]
         except:
             with open(filename, "r", encoding="utf-16") as f:
-                lines = [x.strip() for x in f if x.strip().startswith("#")]
+                return [x.strip() for x in f if x.strip().startswith("#")]
+
+
+def get_tables_from_dtx(tokens, target_parts, params, tables_cache=None, wav_durations=None):
+    # Resolve the WAV, VOLUME, PAN and BPM tables of a file
+    # Split charts of the same song usually carry the same tables, so each
+    # resolved table is reused for every file with the same raw values
+    if tables_cache is None:
+        tables_cache = {}
 
-    # Parse all commands
-    bgm_info = []
-    default_notes = {}
+    get_wav_length = not params.get('no_sounds', False)
+    has_wav_lengths = get_wav_length and ('guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts)
+    sound_folder = {'sound_folder': params.get('sound_folder', "")}
 
-    preview_filename = get_value_from_dtx("PREVIEW", lines)
-    wav_filenames, wav_lengths = get_wavs_from_dtx(lines, target_parts, sound_metadata, not params.get('no_sounds', False))
-    wav_volumes = get_wav_volumes_from_dtx(lines)
-    wav_pans = get_wav_pans_from_dtx(lines)
-    bpms, base_bpm = get_bpms_from_dtx(lines)
+    def get_table(name, raw_values, resolve):
+        cache_key = (name, repr(raw_values))
 
-    bonus_notes = get_bonus_notes_from_dtx(lines, start_offset_padding)
-    measure_lengths = get_measure_lengths_from_dtx(lines, start_offset_padding)
-    events_by_measure = get_events_by_measure_from_dtx(lines, start_offset_padding)
+        if cache_key not in tables_cache:
+            tables_cache[cache_key] = resolve()
 
+        return tables_cache[cache_key]
+
+    tables = {}
+    tables['wav_filenames'], tables['wav_lengths'] = get_table('wavs', (tokens['wavs'], has_wav_lengths), lambda: get_wavs_from_dtx(tokens, target_parts, sound_folder, get_wav_length, wav_durations))
+    tables['wav_volumes'] = get_table('volumes', tokens['volumes'], lambda: get_wav_volumes_from_dtx(tokens))
+    tables['wav_pans'] = get_table('pans', tokens['pans'], lambda: get_wav_pans_from_dtx(tokens))
+    tables['bpms'], tables['base_bpm'] = get_table('bpms', (tokens['bpms'], tokens['base_bpm']), lambda: get_bpms_from_dtx(tokens))
+
+    return tables
+
+
+def get_bgm_filenames_from_dtx(tokens, wav_filenames):
+    bgm_filenames = set()
+
+    for events in tokens['channels'].values():
+        value = events.get(0x01, "")
+
+        for i in range(0, len(value), 2):
+            chip = value[i:i+2]
+
+            if chip != '00' and int(chip, 36) in wav_filenames:
+                bgm_filenames.add(wav_filenames[int(chip, 36)])
+
+    return bgm_filenames
+
+
+def map_sounds_from_dtx(sound_metadata, tokens, tables, target_parts):
     # Build data for sound metadata file
     # This must be correct to get the right sound id for the note commands
     # It's not possible to store panning information in the chart data,
     # but volume data is possible.
     # As a result, all volume flags will be stored in the chart data
     # but the panning will be in the sound metadata.
-    sound_metadata_map, sound_metadata = generate_sound_metadata_map(sound_metadata, wav_filenames, wav_volumes, wav_pans, is_drums='drum' in target_parts)
-    sound_metadata_guitar = []
-    sound_metadata_drum = []
+    sound_metadata_map, sound_metadata = generate_sound_metadata_map(sound_metadata, tables['wav_filenames'], tables['wav_volumes'], tables['wav_pans'], is_drums='drum' in target_parts)
 
-    events_by_measure = pad_events(events_by_measure, measure_lengths)
-    bpms_at_measure_beat = get_bpms_at_measure_beat(events_by_measure, bpms)
+    # Remove any BGMs from the sound metadata
+    bgm_filenames = get_bgm_filenames_from_dtx(tokens, tables['wav_filenames'])
+    remove_keys = [k for k in sound_metadata['data'] if sound_metadata['data'][k]['filename'] in bgm_filenames]
 
-    guitar_long_notes_at_measure_beat = get_guitar_long_notes_at_measure_beat(events_by_measure)
-    guitar_long_note_time_by_measure_beat = \
-        get_long_note_time_by_measure_beat(events_by_measure, guitar_long_notes_at_measure_beat, 1)
+    for k in remove_keys:
+        del sound_metadata['data'][k]
 
-    bass_long_notes_at_measure_beat = get_bass_long_notes_at_measure_beat(events_by_measure)
-    bass_long_note_time_by_measure_beat = \
-        get_long_note_time_by_measure_beat(events_by_measure, bass_long_notes_at_measure_beat, 2)
+    return sound_metadata_map, sound_metadata
 
-    metadata_chart_data = {
-        "beats": {},
-        "header": {
-            "beat_division": 1920 // 4,
-            "time_division": 300,
-            "unk_sys": 0,
-            "is_metadata": 1,
-            "difficulty": 1,
-            "game_type": 0,
-        }
-    }
 
-    chart_data = {
-        "beats": {},
-        "header": {
-            "beat_division": 1920 // 4,
-            "time_division": 300,
-            "unk_sys": 0,
-            "is_metadata": 0,
-            "difficulty": 0,
-            "game_type": 0,
-        }
-    }
+def parse_dtx_charts(filename, params, target_parts, tokens, tables, sound_metadata_map):
+    # Runs in the DTX worker processes, so the padding and timing map are
+    # only built by the process that parses the chart
+    return DtxParser(filename, params, target_parts, tokens, tables).parse_charts(sound_metadata_map)
 
-    # Add start events
-    timestamp_cur = calculate_current_timestamp(0, 0, measure_lengths, bpms_at_measure_beat)
-    chart_data['beats'][0] = []
-    chart_data['beats'][0].append({
-        "name": "startpos",
-        'timestamp': timestamp_cur,
-    })
-    chart_data['beats'][0].append({
-        "name": "chipstart",
-        "data": {
-            "unk": 0
-        },
-        'timestamp': timestamp_cur,
-    })
-
-    metadata_chart_data['beats'][0] = []
-    metadata_chart_data['beats'][0].append({
-        "name": "startpos",
-        'timestamp': timestamp_cur,
-    })
-
-    metadata_chart_data['beats'][0].append({
-        "name": "baron",
-        'timestamp': timestamp_cur,
-    })
-
-    last_seen_bpm = bpms[sorted(bpms.keys(), key=lambda x:int(x))[0]]
-    metadata_chart_data['beats'][0].append({
-        "data": {
-            "bpm": last_seen_bpm
-        },
-        "name": "bpm",
-        'timestamp': timestamp_cur,
-    })
-
-    guitar_long_note_info = {}
-    bass_long_note_info = {}
-    last_event = (0, 0, 0)
-    current_time_signature = Fraction(4, 4)
-    keys = list(events_by_measure.keys()) + list(measure_lengths.keys())
-    measure_list = sorted(list(set(keys)), key=lambda x: int(x))
-    for measure in range(measure_list[-1] + 1):
-        time_signature = find_last_timesig(measure, measure_lengths)
-        same_numerator = time_signature.numerator == current_time_signature.numerator
-        same_denominator = time_signature.denominator == current_time_signature.denominator
-        updated_time_signature = not same_numerator or not same_denominator
-        current_time_signature = time_signature
-
-        global_beat_metadata = calculate_current_beat(
-            measure,
-            0,
-            measure_lengths
-        )
-
-        global_beat_chart = calculate_current_beat(
-            measure,
-            0,
-            measure_lengths
-        )
-
-        if global_beat_metadata not in metadata_chart_data['beats']:
-            metadata_chart_data['beats'][global_beat_metadata] = []
-
-        timestamp_cur = calculate_current_timestamp(measure, 0, measure_lengths, bpms_at_measure_beat)
-        if updated_time_signature:
-            metadata_chart_data['beats'][global_beat_metadata].append({
-                "data": {
-                    "numerator": time_signature.numerator,
-                    "denominator": time_signature.denominator,
-                },
-                "name": "barinfo",
-                'timestamp': timestamp_cur,
-            })
 
-        metadata_chart_data['beats'][global_beat_metadata].append({
-            "name": "measure",
-            "timestamp": timestamp_cur,
-        })
+class DtxParser:
+    """Reads a single DTX file into the intermediate chart format.
 
-        # x/16 time signature (and above?) only write half of the beat lines.
-        # This can be seen in Lindwurm. I haven't found any other instances
-        # of x/16 time signature to be able to check further.
-        beat_lines = current_time_signature.numerator
-        beat_lines_div = current_time_signature.denominator
+    Everything derived from the file (resource tables, padded events and
+    the TimingMap with its caches) belongs to the parser instead of module
+    globals, so several files can be parsed at the same time.
+    """
 
-        if current_time_signature.denominator >= 16:
-            beat_lines /= 2
-            beat_lines_div /= 2
+    def __init__(self, filename, params, target_parts=['drum', 'guitar', 'bass', 'open'], tokens=None, tables=None):
+        self.params = params
+        self.target_parts = target_parts
 
-        for j in range(1, int(round(beat_lines))):
-            cb = int(round(j * (1920 / beat_lines_div)))
-            beat = global_beat_metadata + cb
+        start_offset_padding = params.get('dtx_pad_start', 0)
 
-            if beat not in metadata_chart_data['beats']:
-                metadata_chart_data['beats'][beat] = []
+        # The tokens and tables can be passed in when they were already
+        # read by the caller, see create_json_from_dtx
+        if tokens is None:
+            tokens = tokenize_dtx(read_dtx_lines(filename))
 
-            metadata_chart_data['beats'][beat].append({
-                "name": "beat",
-                "timestamp": calculate_current_timestamp(measure, cb, measure_lengths, bpms_at_measure_beat),
-            })
+        if tables is None:
+            tables = get_tables_from_dtx(tokens, target_parts, params)
 
-        global_beat_metadata = int(round(global_beat_metadata))
-        global_beat_chart = int(round(global_beat_chart))
-
-        beat = global_beat_metadata
-
-        if measure in events_by_measure:
-            for event in events_by_measure[measure]:
-                auto_events = auto_play_ranges
-                ignore_events = [
-                    0x04,
-                    0x20, 0x21, 0x22, 0x23, 0x24, 0x25, 0x26, 0x27, 0x28, 0x29, 0x2f,
-                    0x4c, 0x4d, 0x4e, 0x4f,
-                    0x51, 0x54,
-                    0xa0, 0xa1, 0xa2, 0xa3, 0xa4, 0xa5, 0xa6, 0xa7, 0xa8, 0xa8, 0xaf,
-                    0xc2
-                ]
+        self.tokens = tokens
+        self.tables = tables
 
-                if event == 0x01:
-                    # BGM item
-                    data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
+        self.preview_filename = get_value_from_dtx("PREVIEW", self.tokens)
+        self.wav_filenames, self.wav_lengths = tables['wav_filenames'], tables['wav_lengths']
+        self.wav_volumes = tables['wav_volumes']
+        self.wav_pans = tables['wav_pans']
+        self.bpms, self.base_bpm = tables['bpms'], tables['base_bpm']
 
-                        timestamp = calculate_current_timestamp(
-                            measure,
-                            i % len(data),
-                            measure_lengths,
-                            bpms_at_measure_beat
-                        )
-
-                        if int(data[i], 36) in wav_filenames:
-                            bgm_info.append({
-                                'filename': wav_filenames[int(data[i], 36)],
-                                'timestamp': timestamp / 300
-                            })
+        self.bonus_notes = get_bonus_notes_from_dtx(self.tokens, start_offset_padding)
+        self.measure_lengths = get_measure_lengths_from_dtx(self.tokens, start_offset_padding)
+        self.events_by_measure = pad_events(get_events_by_measure_from_dtx(self.tokens, start_offset_padding), self.measure_lengths)
 
-                elif event == 0x03:
-                    # Base BPM addition
-                    data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
+        self.bpms_at_measure_beat = get_bpms_at_measure_beat(self.events_by_measure, self.bpms)
+        self.timing_map = TimingMap(self.measure_lengths, self.bpms_at_measure_beat)
 
-                        beat = global_beat_metadata + i
 
-                        if beat not in metadata_chart_data['beats']:
-                            metadata_chart_data['beats'][beat] = []
+    def map_sounds(self, sound_metadata):
+        return map_sounds_from_dtx(sound_metadata, self.tokens, self.tables, self.target_parts)
 
-                        new_bpm = int(data[i], 16) + base_bpm
 
-                        metadata_chart_data['beats'][beat].append({
-                            "data": {
-                                "bpm": new_bpm
-                            },
-                            "name": "bpm",
-                            "timestamp": calculate_current_timestamp(
-                                measure,
-                                i % len(data),
-                                measure_lengths,
-                                bpms_at_measure_beat
-                            ),
-                        })
+    def parse(self, sound_metadata):
+        sound_metadata_map, sound_metadata = self.map_sounds(sound_metadata)
+        metadata_chart_data, drum_chart_data, guitar_chart_data, bass_chart_data, chart_sounds = self.parse_charts(sound_metadata_map)
+        sound_metadata = merge_chart_sounds(sound_metadata, chart_sounds)
 
-                        if beat > last_event[2]:
-                            last_event = (measure, i, beat)
+        return metadata_chart_data, drum_chart_data, guitar_chart_data, bass_chart_data, sound_metadata
 
-                        last_seen_bpm = new_bpm
 
-                elif event == 0x08:
-                    # BPM event
-                    data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
+    # TODO: Try to refactor this more later
+    def parse_charts(self, sound_metadata_map):
+        params = self.params
+        target_parts = self.target_parts
 
-                        beat = global_beat_metadata + i
+        preview_filename = self.preview_filename
+        wav_filenames, wav_lengths = self.wav_filenames, self.wav_lengths
+        wav_volumes = self.wav_volumes
+        bpms, base_bpm = self.bpms, self.base_bpm
 
-                        if beat not in metadata_chart_data['beats']:
-                            metadata_chart_data['beats'][beat] = []
+        bonus_notes = self.bonus_notes
+        measure_lengths = self.measure_lengths
+        events_by_measure = self.events_by_measure
+        timing_map = self.timing_map
 
-                        if last_seen_bpm == bpms[int(data[i], 36)]:
-                            # Already the current BPM, don't write it again
-                            continue
+        # Parse all commands
+        bgm_info = []
+        default_notes = {}
+
+        sound_metadata_guitar = []
+        sound_metadata_drum = []
+
+        guitar_long_notes_at_measure_beat = get_guitar_long_notes_at_measure_beat(events_by_measure)
+        guitar_long_note_time_by_measure_beat = \
+            get_long_note_time_by_measure_beat(events_by_measure, guitar_long_notes_at_measure_beat, 1)
+
+        bass_long_notes_at_measure_beat = get_bass_long_notes_at_measure_beat(events_by_measure)
+        bass_long_note_time_by_measure_beat = \
+            get_long_note_time_by_measure_beat(events_by_measure, bass_long_notes_at_measure_beat, 2)
+
+        metadata_chart_data = {
+            "beats": {},
+            "header": {
+                "beat_division": 1920 // 4,
+                "time_division": 300,
+                "unk_sys": 0,
+                "is_metadata": 1,
+                "difficulty": 1,
+                "game_type": 0,
+            }
+        }
+
+        chart_data = {
+            "beats": {},
+            "header": {
+                "beat_division": 1920 // 4,
+                "time_division": 300,
+                "unk_sys": 0,
+                "is_metadata": 0,
+                "difficulty": 0,
+                "game_type": 0,
+            }
+        }
+
+        # Add start events
+        timestamp_cur = timing_map.get_timestamp(0, 0)
+        chart_data['beats'][0] = []
+        chart_data['beats'][0].append({
+            "name": "startpos",
+            'timestamp': timestamp_cur,
+        })
+        chart_data['beats'][0].append({
+            "name": "chipstart",
+            "data": {
+                "unk": 0
+            },
+            'timestamp': timestamp_cur,
+        })
+
+        metadata_chart_data['beats'][0] = []
+        metadata_chart_data['beats'][0].append({
+            "name": "startpos",
+            'timestamp': timestamp_cur,
+        })
+
+        metadata_chart_data['beats'][0].append({
+            "name": "baron",
+            'timestamp': timestamp_cur,
+        })
+
+        last_seen_bpm = bpms[sorted(bpms.keys(), key=lambda x:int(x))[0]]
+        metadata_chart_data['beats'][0].append({
+            "data": {
+                "bpm": last_seen_bpm
+            },
+            "name": "bpm",
+            'timestamp': timestamp_cur,
+        })
+
+        guitar_long_note_info = {}
+        bass_long_note_info = {}
+        last_event = (0, 0, 0)
+        current_time_signature = Fraction(4, 4)
+        keys = list(events_by_measure.keys()) + list(measure_lengths.keys())
+        measure_list = sorted(list(set(keys)), key=lambda x: int(x))
+        for measure in range(measure_list[-1] + 1):
+            time_signature = timing_map.get_timesig(measure)
+            same_numerator = time_signature.numerator == current_time_signature.numerator
+            same_denominator = time_signature.denominator == current_time_signature.denominator
+            updated_time_signature = not same_numerator or not same_denominator
+            current_time_signature = time_signature
+
+            global_beat_metadata = timing_map.get_measure_beat(measure)
+            global_beat_chart = timing_map.get_measure_beat(measure)
+
+            if global_beat_metadata not in metadata_chart_data['beats']:
+                metadata_chart_data['beats'][global_beat_metadata] = []
+
+            timestamp_cur = timing_map.get_timestamp(measure, 0)
+            if updated_time_signature:
+                metadata_chart_data['beats'][global_beat_metadata].append({
+                    "data": {
+                        "numerator": time_signature.numerator,
+                        "denominator": time_signature.denominator,
+                    },
+                    "name": "barinfo",
+                    'timestamp': timestamp_cur,
+                })
+
+            metadata_chart_data['beats'][global_beat_metadata].append({
+                "name": "measure",
+                "timestamp": timestamp_cur,
+            })
+
+            # x/16 time signature (and above?) only write half of the beat lines.
+            # This can be seen in Lindwurm. I haven't found any other instances
+            # of x/16 time signature to be able to check further.
+            beat_lines = current_time_signature.numerator
+            beat_lines_div = current_time_signature.denominator
+
+            if current_time_signature.denominator >= 16:
+                beat_lines /= 2
+                beat_lines_div /= 2
+
+            for j in range(1, int(round(beat_lines))):
+                cb = int(round(j * (1920 / beat_lines_div)))
+                beat = global_beat_metadata + cb
+
+                if beat not in metadata_chart_data['beats']:
+                    metadata_chart_data['beats'][beat] = []
+
+                metadata_chart_data['beats'][beat].append({
+                    "name": "beat",
+                    "timestamp": timing_map.get_timestamp(measure, cb),
+                })
+
+            global_beat_metadata = int(round(global_beat_metadata))
+            global_beat_chart = int(round(global_beat_chart))
+
+            beat = global_beat_metadata
+
+            if measure in events_by_measure:
+                for event in events_by_measure[measure]:
+                    auto_events = auto_play_ranges
+                    ignore_events = [
+                        0x04,
+                        0x20, 0x21, 0x22, 0x23, 0x24, 0x25, 0x26, 0x27, 0x28, 0x29, 0x2f,
+                        0x4c, 0x4d, 0x4e, 0x4f,
+                        0x51, 0x54,
+                        0xa0, 0xa1, 0xa2, 0xa3, 0xa4, 0xa5, 0xa6, 0xa7, 0xa8, 0xa8, 0xaf,
+                        0xc2
+                    ]
+
+                    if event == 0x01:
+                        # BGM item
+                        data = events_by_measure[measure][event]
+                        for i in range(len(data)):
+                            if data[i] == '00':
+                                continue
+
+                            timestamp = timing_map.get_timestamp(measure, i % len(data))
+
+                            if int(data[i], 36) in wav_filenames:
+                                bgm_info.append({
+                                    'filename': wav_filenames[int(data[i], 36)],
+                                    'timestamp': timestamp / 300
+                                })
+
+                    elif event == 0x03:
+                        # Base BPM addition
+                        data = events_by_measure[measure][event]
+                        for i in range(len(data)):
+                            if data[i] == '00':
+                                continue
+
+                            beat = global_beat_metadata + i
+
+                            if beat not in metadata_chart_data['beats']:
+                                metadata_chart_data['beats'][beat] = []
+
+                            new_bpm = int(data[i], 16) + base_bpm
 
-                        if not (measure == 0 and beat == 0):
                             metadata_chart_data['beats'][beat].append({
                                 "data": {
-                                    "bpm": base_bpm + bpms[int(data[i], 36)]
+                                    "bpm": new_bpm
                                 },
                                 "name": "bpm",
-                                "timestamp": calculate_current_timestamp(
-                                    measure,
-                                    i % len(data),
-                                    measure_lengths,
-                                    bpms_at_measure_beat
-                                ),
+                                "timestamp": timing_map.get_timestamp(measure, i % len(data)),
                             })
 
                             if beat > last_event[2]:
                                 last_event = (measure, i, beat)
 
-                            last_seen_bpm = base_bpm + bpms[int(data[i], 36)]
+                            last_seen_bpm = new_bpm
 
-                elif event == 0xc2:
-                    # baron/off
-                    data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
+                    elif event == 0x08:
+                        # BPM event
+                        data = events_by_measure[measure][event]
+                        for i in range(len(data)):
+                            if data[i] == '00':
+                                continue
 
-                        beat = global_beat_metadata + i
+                            beat = global_beat_metadata + i
 
-                        name = ""
-                        if data[i] == '01':
-                            name = "baron"
-                        elif data[i] == '02':
-                            name = "baroff"
-                        else:
-                            # Not a valid event, but we're using it anyway.
-                            # This is being abused for the endpos event
-                            # to properly calculate the exact end of a song.
-                            last_event = (measure, i, beat)
-                            continue
+                            if beat not in metadata_chart_data['beats']:
+                                metadata_chart_data['beats'][beat] = []
 
-                        if beat not in metadata_chart_data['beats']:
-                            metadata_chart_data['beats'][beat] = []
-
-                        metadata_chart_data['beats'][beat].append({
-                            "name": name,
-                            "timestamp": calculate_current_timestamp(
-                                measure,
-                                i % len(data),
-                                measure_lengths,
-                                bpms_at_measure_beat
-                            ),
-                        })
-
-                        if beat > last_event[2]:
-                            last_event = (measure, i, beat)
-
-                elif event in default_note_events:
-                    data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
+                            if last_seen_bpm == bpms[int(data[i], 36)]:
+                                # Already the current BPM, don't write it again
+                                continue
 
-                        sound_id = int(data[i], 36)
-                        mapped_sound_id = sound_metadata_map.get(sound_id, 0)
-                        default_notes[reverse_dtx_mapping[event]] = mapped_sound_id
+                            if not (measure == 0 and beat == 0):
+                                metadata_chart_data['beats'][beat].append({
+                                    "data": {
+                                        "bpm": base_bpm + bpms[int(data[i], 36)]
+                                    },
+                                    "name": "bpm",
+                                    "timestamp": timing_map.get_timestamp(measure, i % len(data)),
+                                })
+
+                                if beat > last_event[2]:
+                                    last_event = (measure, i, beat)
+
+                                last_seen_bpm = base_bpm + bpms[int(data[i], 36)]
+
+                    elif event == 0xc2:
+                        # baron/off
+                        data = events_by_measure[measure][event]
+                        for i in range(len(data)):
+                            if data[i] == '00':
+                                continue
 
-                elif event in [0x2a, 0x2c]:
-                    # Guitar long note
-                    data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
+                            beat = global_beat_metadata + i
 
-                        if measure not in guitar_long_note_info:
-                            guitar_long_note_info[measure] = {}
-
-                        guitar_long_note_info[measure][i] = calculate_current_timestamp(
-                            measure,
-                            i % len(data),
-                            measure_lengths,
-                            bpms_at_measure_beat
-                        )
-
-                elif event in [0x2b, 0x2d]:
-                    # Bass long note
-                    data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
+                            name = ""
+                            if data[i] == '01':
+                                name = "baron"
+                            elif data[i] == '02':
+                                name = "baroff"
+                            else:
+                                # Not a valid event, but we're using it anyway.
+                                # This is being abused for the endpos event
+                                # to properly calculate the exact end of a song.
+                                last_event = (measure, i, beat)
+                                continue
 
-                        if measure not in bass_long_note_info:
-                            bass_long_note_info[measure] = {}
+                            if beat not in metadata_chart_data['beats']:
+                                metadata_chart_data['beats'][beat] = []
 
-                        bass_long_note_info[measure][i] = calculate_current_timestamp(
-                            measure,
-                            i % len(data),
-                            measure_lengths,
-                            bpms_at_measure_beat
-                        )
+                            metadata_chart_data['beats'][beat].append({
+                                "name": name,
+                                "timestamp": timing_map.get_timestamp(measure, i % len(data)),
+                            })
 
-                elif event in reverse_dtx_mapping:
-                    data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
+                            if beat > last_event[2]:
+                                last_event = (measure, i, beat)
 
-                        beat = global_beat_chart + i
+                    elif event in default_note_events:
+                        data = events_by_measure[measure][event]
+                        for i in range(len(data)):
+                            if data[i] == '00':
+                                continue
 
-                        if beat not in chart_data['beats']:
-                            chart_data['beats'][beat] = []
+                            sound_id = int(data[i], 36)
+                            mapped_sound_id = sound_metadata_map.get(sound_id, 0)
+                            default_notes[reverse_dtx_mapping[event]] = mapped_sound_id
 
-                        sound_id = int(data[i], 36)
-                        mapped_sound_id = sound_metadata_map.get(sound_id, 0)
+                    elif event in [0x2a, 0x2c]:
+                        # Guitar long note
+                        data = events_by_measure[measure][event]
+                        for i in range(len(data)):
+                            if data[i] == '00':
+                                continue
 
-                        if event in drum_range:
-                            sound_metadata_drum.append(mapped_sound_id)
+                            if measure not in guitar_long_note_info:
+                                guitar_long_note_info[measure] = {}
 
-                            if reverse_dtx_mapping[event] not in default_notes:
-                                default_notes[reverse_dtx_mapping[event]] = mapped_sound_id
+                            guitar_long_note_info[measure][i] = timing_map.get_timestamp(measure, i % len(data))
 
-                        elif event in guitar_range or event in bass_range:
-                            sound_metadata_guitar.append(mapped_sound_id)
+                    elif event in [0x2b, 0x2d]:
+                        # Bass long note
+                        data = events_by_measure[measure][event]
+                        for i in range(len(data)):
+                            if data[i] == '00':
+                                continue
 
-                        if beat > last_event[2]:
-                            last_event = (measure, i, beat)
+                            if measure not in bass_long_note_info:
+                                bass_long_note_info[measure] = {}
 
-                        if event in drum_range and 'drum' not in target_parts:
-                            continue
+                            bass_long_note_info[measure][i] = timing_map.get_timestamp(measure, i % len(data))
 
-                        elif event in guitar_range and 'guitar' not in target_parts:
-                            continue
+                    elif event in reverse_dtx_mapping:
+                        data = events_by_measure[measure][event]
+                        for i in range(len(data)):
+                            if data[i] == '00':
+                                continue
 
-                        elif event in bass_range and 'bass' not in target_parts:
-                            continue
+                            beat = global_beat_chart + i
 
-                        wail_direction = 1
-                        wail_flag = 0
-                        wail_event = -1
+                            if beat not in chart_data['beats']:
+                                chart_data['beats'][beat] = []
 
-                        if event in guitar_range:
-                            wail_event = 0x28
+                            sound_id = int(data[i], 36)
+                            mapped_sound_id = sound_metadata_map.get(sound_id, 0)
 
-                        elif event in bass_range:
-                            wail_event = 0xa8
-
-                        if wail_event != -1 and wail_event in events_by_measure[measure]:
-                            if len(events_by_measure[measure][wail_event]) == len(events_by_measure[measure][event]) and events_by_measure[measure][wail_event][i] != "00":
-                                wail_flag = 1
-
-                        if event in guitar_range and measure in guitar_long_note_time_by_measure_beat and i in guitar_long_note_time_by_measure_beat[measure]:
-                            guitar_long_note_time_by_measure_beat[measure][i] = (guitar_long_note_time_by_measure_beat[measure][i], beat)
-                        elif event in bass_range and measure in bass_long_note_time_by_measure_beat and i in bass_long_note_time_by_measure_beat[measure]:
-                            bass_long_note_time_by_measure_beat[measure][i] = (bass_long_note_time_by_measure_beat[measure][i], beat)
-
-                        chart_data['beats'][beat].append({
-                            "data": {
-                                "auto_note": 0,
-                                "auto_volume": 0,
-                                "hold_duration": 0,
-                                "note": reverse_dtx_mapping[event],
-                                "note_length": 0,
-                                "sound_id": mapped_sound_id,
-                                "unk": 0,
-                                "volume": 127 if sound_id not in wav_volumes else int(round(127 * (wav_volumes[sound_id] / 100))),
-                                "wail_misc": wail_direction if wail_flag else 0,
-                                "guitar_special": wail_flag,
-                                "bonus_note": 1 if measure in bonus_notes and i in bonus_notes[measure] and sound_id in bonus_notes[measure][i] else 0,
-                            },
-                            "name": "note",
-                            "timestamp": calculate_current_timestamp(measure, i % len(data), measure_lengths, bpms_at_measure_beat),
-                        })
+                            if event in drum_range:
+                                sound_metadata_drum.append(mapped_sound_id)
 
-                        if 'guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts:
-                            if sound_id in wav_lengths:
-                                chart_data['beats'][beat][-1]['data']['note_length'] = wav_lengths[sound_id]
+                                if reverse_dtx_mapping[event] not in default_notes:
+                                    default_notes[reverse_dtx_mapping[event]] = mapped_sound_id
 
-                elif event in auto_events:
-                    if 'guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts:
-                        continue
+                            elif event in guitar_range or event in bass_range:
+                                sound_metadata_guitar.append(mapped_sound_id)
 
-                    data = events_by_measure[measure][event]
+                            if beat > last_event[2]:
+                                last_event = (measure, i, beat)
 
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
+                            if event in drum_range and 'drum' not in target_parts:
+                                continue
+
+                            elif event in guitar_range and 'guitar' not in target_parts:
+                                continue
+
+                            elif event in bass_range and 'bass' not in target_parts:
+                                continue
+
+                            wail_direction = 1
+                            wail_flag = 0
+                            wail_event = -1
+
+                            if event in guitar_range:
+                                wail_event = 0x28
 
-                        beat = global_beat_chart + i
-
-                        if beat not in chart_data['beats']:
-                            chart_data['beats'][beat] = []
-
-                        # Auto note
-                        sound_id = int(data[i], 36)
-
-                        chart_data['beats'][beat].append({
-                            "data": {
-                                "auto_note": 1,
-                                "auto_volume": 1,
-                                "hold_duration": 0,
-                                "note": "auto",
-                                "note_length": 0,
-                                "sound_id": 0 if sound_id not in sound_metadata_map else sound_metadata_map[sound_id],
-                                "unk": 0,
-                                "volume": 127 if sound_id not in wav_volumes else int(round(127 * (wav_volumes[sound_id] / 100))),
-                                "wail_direction": 0,
-                                "bonus_note": 0,
-                                "guitar_special": 0,
-                            },
-                            "name": "note",
-                            "timestamp": calculate_current_timestamp(measure, i % len(data), measure_lengths, bpms_at_measure_beat),
-                        })
+                            elif event in bass_range:
+                                wail_event = 0xa8
 
+                            if wail_event != -1 and wail_event in events_by_measure[measure]:
+                                if len(events_by_measure[measure][wail_event]) == len(events_by_measure[measure][event]) and events_by_measure[measure][wail_event][i] != "00":
+                                    wail_flag = 1
+
+                            if event in guitar_range and measure in guitar_long_note_time_by_measure_beat and i in guitar_long_note_time_by_measure_beat[measure]:
+                                guitar_long_note_time_by_measure_beat[measure][i] = (guitar_long_note_time_by_measure_beat[measure][i], beat)
+                            elif event in bass_range and measure in bass_long_note_time_by_measure_beat and i in bass_long_note_time_by_measure_beat[measure]:
+                                bass_long_note_time_by_measure_beat[measure][i] = (bass_long_note_time_by_measure_beat[measure][i], beat)
+
+                            chart_data['beats'][beat].append({
+                                "data": {
+                                    "auto_note": 0,
+                                    "auto_volume": 0,
+                                    "hold_duration": 0,
+                                    "note": reverse_dtx_mapping[event],
+                                    "note_length": 0,
+                                    "sound_id": mapped_sound_id,
+                                    "unk": 0,
+                                    "volume": 127 if sound_id not in wav_volumes else int(round(127 * (wav_volumes[sound_id] / 100))),
+                                    "wail_misc": wail_direction if wail_flag else 0,
+                                    "guitar_special": wail_flag,
+                                    "bonus_note": 1 if measure in bonus_notes and i in bonus_notes[measure] and sound_id in bonus_notes[measure][i] else 0,
+                                },
+                                "name": "note",
+                                "timestamp": timing_map.get_timestamp(measure, i % len(data)),
+                            })
+
+                            if 'guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts:
+                                if sound_id in wav_lengths:
+                                    chart_data['beats'][beat][-1]['data']['note_length'] = wav_lengths[sound_id]
+
+                    elif event in auto_events:
                         if 'guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts:
-                            if sound_id in wav_lengths:
-                                chart_data['beats'][beat][-1]['data']['note_length'] = wav_lengths[sound_id]
+                            continue
 
-                        if beat > last_event[2]:
-                            last_event = (measure, i, beat)
+                        data = events_by_measure[measure][event]
 
-                elif event not in ignore_events:
-                    print("Unknown event %02x" % event)
+                        for i in range(len(data)):
+                            if data[i] == '00':
+                                continue
 
-    chart_data = add_hold_notes(chart_data, guitar_long_note_time_by_measure_beat, guitar_long_note_info)
-    chart_data = add_hold_notes(chart_data, bass_long_note_time_by_measure_beat, bass_long_note_info)
+                            beat = global_beat_chart + i
 
-    # Add end events
-    if last_event[2] not in chart_data['beats']:
-        chart_data['beats'][last_event[2]] = []
+                            if beat not in chart_data['beats']:
+                                chart_data['beats'][beat] = []
 
-    if last_event[2] not in metadata_chart_data['beats']:
-        metadata_chart_data['beats'][last_event[2]] = []
+                            # Auto note
+                            sound_id = int(data[i], 36)
 
-    chart_data['beats'][last_event[2]].append({
-        "name": "chipend",
-        "timestamp": calculate_current_timestamp(last_event[0], last_event[1], measure_lengths, bpms_at_measure_beat),
-    })
+                            chart_data['beats'][beat].append({
+                                "data": {
+                                    "auto_note": 1,
+                                    "auto_volume": 1,
+                                    "hold_duration": 0,
+                                    "note": "auto",
+                                    "note_length": 0,
+                                    "sound_id": 0 if sound_id not in sound_metadata_map else sound_metadata_map[sound_id],
+                                    "unk": 0,
+                                    "volume": 127 if sound_id not in wav_volumes else int(round(127 * (wav_volumes[sound_id] / 100))),
+                                    "wail_direction": 0,
+                                    "bonus_note": 0,
+                                    "guitar_special": 0,
+                                },
+                                "name": "note",
+                                "timestamp": timing_map.get_timestamp(measure, i % len(data)),
+                            })
+
+                            if 'guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts:
+                                if sound_id in wav_lengths:
+                                    chart_data['beats'][beat][-1]['data']['note_length'] = wav_lengths[sound_id]
+
+                            if beat > last_event[2]:
+                                last_event = (measure, i, beat)
 
-    # Delayed end command
-    pad_end = params.get('dtx_pad_end', 0)
+                    elif event not in ignore_events:
+                        print("Unknown event %02x" % event)
 
-    if pad_end > 0:
-        one_measure = (1920 / measure_lengths[0].denominator) * (measure_lengths[0].numerator / (measure_lengths[0].denominator_orig / 2))
-        last_event = (last_event[0] + 2, 0, last_event[2] + (one_measure *  pad_end))
+        chart_data = add_hold_notes(chart_data, guitar_long_note_time_by_measure_beat, guitar_long_note_info)
+        chart_data = add_hold_notes(chart_data, bass_long_note_time_by_measure_beat, bass_long_note_info)
 
-    if last_event[2] not in chart_data['beats']:
-        chart_data['beats'][last_event[2]] = []
+        # Add end events
+        if last_event[2] not in chart_data['beats']:
+            chart_data['beats'][last_event[2]] = []
 
-    if last_event[2] not in metadata_chart_data['beats']:
-        metadata_chart_data['beats'][last_event[2]] = []
+        if last_event[2] not in metadata_chart_data['beats']:
+            metadata_chart_data['beats'][last_event[2]] = []
 
-    chart_data['beats'][last_event[2]].append({
-        "name": "endpos",
-        "timestamp": calculate_current_timestamp(last_event[0], last_event[1], measure_lengths, bpms_at_measure_beat),
-    })
+        chart_data['beats'][last_event[2]].append({
+            "name": "chipend",
+            "timestamp": timing_map.get_timestamp(last_event[0], last_event[1]),
+        })
 
-    metadata_chart_data['beats'][last_event[2]].append({
-        "name": "endpos",
-        "timestamp": calculate_current_timestamp(last_event[0], last_event[1], measure_lengths, bpms_at_measure_beat),
-    })
+        # Delayed end command
+        pad_end = params.get('dtx_pad_end', 0)
 
-    chart_data = generate_timestamp_set(chart_data, last_event)
-    metadata_chart_data = generate_timestamp_set(metadata_chart_data, last_event)
+        if pad_end > 0:
+            one_measure = (1920 / measure_lengths[0].denominator) * (measure_lengths[0].numerator / (measure_lengths[0].denominator_orig / 2))
+            last_event = (last_event[0] + 2, 0, last_event[2] + (one_measure *  pad_end))
 
-    # Remove any BGMs from the sound metadata
-    for bgm in bgm_info:
-        remove_keys = []
-        for k in sound_metadata['data']:
-            if sound_metadata['data'][k]['filename'] == bgm['filename']:
-                remove_keys.append(k)
+        if last_event[2] not in chart_data['beats']:
+            chart_data['beats'][last_event[2]] = []
 
-        for k in remove_keys:
-            del sound_metadata['data'][k]
+        if last_event[2] not in metadata_chart_data['beats']:
+            metadata_chart_data['beats'][last_event[2]] = []
 
-    sound_metadata['drum'] = list(set(sound_metadata['drum'] + sound_metadata_drum))
-    sound_metadata['guitar'] = list(set(sound_metadata['guitar'] + sound_metadata_guitar))
-    sound_metadata['bgm'] = {
-        'end': calculate_current_timestamp(last_event[0], last_event[1], measure_lengths, bpms_at_measure_beat) / 300,
-        'data': bgm_info
-    }
-    sound_metadata['preview'] = preview_filename
-    sound_metadata['defaults'] = default_notes
+        chart_data['beats'][last_event[2]].append({
+            "name": "endpos",
+            "timestamp": timing_map.get_timestamp(last_event[0], last_event[1]),
+        })
+
+        metadata_chart_data['beats'][last_event[2]].append({
+            "name": "endpos",
+            "timestamp": timing_map.get_timestamp(last_event[0], last_event[1]),
+        })
+
+        chart_data = generate_timestamp_set(chart_data, last_event)
+        metadata_chart_data = generate_timestamp_set(metadata_chart_data, last_event)
+
+        chart_sounds = {
+            'drum': sound_metadata_drum,
+            'guitar': sound_metadata_guitar,
+            'bgm': {
+                'end': timing_map.get_timestamp(last_event[0], last_event[1]) / 300,
+                'data': bgm_info
+            },
+            'preview': preview_filename,
+            'defaults': default_notes,
+        }
 
-    drum_chart_data, guitar_chart_data, bass_chart_data = get_chart_datas(chart_data, lines)
+        drum_chart_data, guitar_chart_data, bass_chart_data = get_chart_datas(chart_data, self.tokens)
 
-    return metadata_chart_data, drum_chart_data, guitar_chart_data, bass_chart_data, sound_metadata
+        return metadata_chart_data, drum_chart_data, guitar_chart_data, bass_chart_data, chart_sounds
+
+
+def merge_chart_sounds(sound_metadata, chart_sounds):
+    sound_metadata['drum'] = list(set(sound_metadata['drum'] + chart_sounds['drum']))
+    sound_metadata['guitar'] = list(set(sound_metadata['guitar'] + chart_sounds['guitar']))
+    sound_metadata['bgm'] = chart_sounds['bgm']
+    sound_metadata['preview'] = chart_sounds['preview']
+    sound_metadata['defaults'] = chart_sounds['defaults']
+
+    return sound_metadata
+
+
+def parse_dtx_to_intermediate(filename,
+                              params,
+                              sound_metadata,
+                              target_parts=['drum', 'guitar', 'bass', 'open']):
+    if not filename or not os.path.exists(filename):
+        return None, None, None, None, sound_metadata
+
+    return DtxParser(filename, params, target_parts).parse(sound_metadata)
+
+
+def get_sound_filenames_from_dtx(params):
+    # Sound files read for the note durations by get_wavs_from_dtx
+    if params.get('no_sounds', False):
+        return []
+
+    input_filenames = [params.get('input')]
+    for part in (params.get('input_split') or {}).values():
+        input_filenames += part.values()
+
+    filenames = []
+    for input_filename in input_filenames:
+        if not input_filename or not os.path.exists(input_filename):
+            continue
+
+        tokens = tokenize_dtx(read_dtx_lines(input_filename))
+        filenames += [os.path.join(params.get('sound_folder') or "", value) for value in tokens['wavs'].values()]
+
+    return sorted(set(filenames))
 
 
 def create_json_from_dtx(params):
@@ -1657,39 +1619,58 @@ def create_json_from_dtx(params):
 
     sound_metadata = {'sound_folder': params['sound_folder'] if 'sound_folder' in params else "", 'preview': "", 'bgm': {}, 'data': {}, 'guitar': [], 'drum': [], 'defaults': {}}
 
-    def get_chart_data(data, sound_metadata, parts):
-        metadatas = []
+    jobs = []
+    for difficulty, data in [('nov', novice_data), ('bsc', basic_data), ('adv', adv_data), ('ext', ext_data), ('mst', master_data)]:
+        for part in ['drum', 'guitar', 'bass']:
+            if part in params['parts'] and data[part]:
+                jobs.append((difficulty, part, data[part]))
+
+    # Sound IDs depend on every file parsed before, so the tables are
+    # resolved and mapped in order before the charts are parsed
+    tables_cache = {}
+    wav_durations = {}
+    parse_jobs = []
+    for _, part, filename in jobs:
+        tokens = tokenize_dtx(read_dtx_lines(filename))
+        tables = get_tables_from_dtx(tokens, part, params, tables_cache, wav_durations)
+        sound_metadata_map, sound_metadata = map_sounds_from_dtx(sound_metadata, tokens, tables, part)
+
+        parse_jobs.append((filename, params, part, tokens, tables, sound_metadata_map))
+
+    if params.get('single_threaded', False):
+        workers = 1
+    else:
+        workers = min(len(parse_jobs), params.get('dtx_workers') or os.cpu_count() or 1)
 
-        chart_drum = None
-        if "drum" in parts and 'drum' in data:
-            metadata1, chart_drum, _, _, sound_metadata = parse_dtx_to_intermediate(data['drum'], params, sound_metadata, "drum")
-            metadatas.append(metadata1)
+    if workers <= 1:
+        results = [parse_dtx_charts(*job) for job in parse_jobs]
 
-        chart_guitar = None
-        if "guitar" in parts and 'guitar' in data:
-            metadata2, _, chart_guitar, _, sound_metadata = parse_dtx_to_intermediate(data['guitar'], params, sound_metadata, "guitar")
-            metadatas.append(metadata2)
+    else:
+        with helper.get_process_pool(workers) as executor:
+            results = list(executor.map(parse_dtx_charts, *zip(*parse_jobs)))
+
+    charts = {}
+    for (difficulty, part, _), result in zip(jobs, results):
+        metadata, chart_drum, chart_guitar, chart_bass, chart_sounds = result
+        sound_metadata = merge_chart_sounds(sound_metadata, chart_sounds)
 
-        chart_bass = None
-        if "bass" in parts and 'bass' in data:
-            metadata3, _,  _, chart_bass, sound_metadata = parse_dtx_to_intermediate(data['bass'], params, sound_metadata, "bass")
-            metadatas.append(metadata3)
+        if difficulty not in charts:
+            charts[difficulty] = {'metadata': None}
 
-        chart_open = None
-        # if "open" in parts and 'open' in data:
-        #     metadata4, chart_bass, sound_metadata = parse_dtx_to_intermediate(data['open'], params, sound_metadata, "open")
-        #     metadatas.append(metadata4)
+        if charts[difficulty]['metadata'] is None:
+            charts[difficulty]['metadata'] = metadata
 
-        metadatas = [x for x in metadatas if x is not None]  # Filter bad metadata charts
-        metadata = None if len(metadatas) == 0 else metadatas[0]
+        charts[difficulty][part] = {'drum': chart_drum, 'guitar': chart_guitar, 'bass': chart_bass}[part]
 
-        return metadata, chart_drum, chart_guitar, chart_bass, chart_open, sound_metadata
+    def get_chart_data(difficulty):
+        chart = charts.get(difficulty, {})
+        return chart.get('metadata'), chart.get('drum'), chart.get('guitar'), chart.get('bass'), None
 
-    novice_metadata, novice_chart_drum, novice_chart_guitar, novice_chart_bass, novice_chart_open, sound_metadata = get_chart_data(novice_data, sound_metadata, params['parts'])
-    basic_metadata, basic_chart_drum, basic_chart_guitar, basic_chart_bass, basic_chart_open, sound_metadata = get_chart_data(basic_data, sound_metadata, params['parts'])
-    adv_metadata, adv_chart_drum, adv_chart_guitar, adv_chart_bass, adv_chart_open, sound_metadata = get_chart_data(adv_data, sound_metadata, params['parts'])
-    ext_metadata, ext_chart_drum, ext_chart_guitar, ext_chart_bass, ext_chart_open, sound_metadata = get_chart_data(ext_data, sound_metadata, params['parts'])
-    master_metadata, master_chart_drum, master_chart_guitar, master_chart_bass, master_chart_open, sound_metadata = get_chart_data(master_data, sound_metadata, params['parts'])
+    novice_metadata, novice_chart_drum, novice_chart_guitar, novice_chart_bass, novice_chart_open = get_chart_data('nov')
+    basic_metadata, basic_chart_drum, basic_chart_guitar, basic_chart_bass, basic_chart_open = get_chart_data('bsc')
+    adv_metadata, adv_chart_drum, adv_chart_guitar, adv_chart_bass, adv_chart_open = get_chart_data('adv')
+    ext_metadata, ext_chart_drum, ext_chart_guitar, ext_chart_bass, ext_chart_open = get_chart_data('ext')
+    master_metadata, master_chart_drum, master_chart_guitar, master_chart_bass, master_chart_open = get_chart_data('mst')
 
     # Create sound metadata file
     # Any notes not in the drums or guitar sound metadata fields should be added to both just in case
@@ -1792,7 +1773,7 @@ def create_json_from_dtx(params):
 
     output_json = {
         "musicid": 0 if 'musicid' not in params or not params['musicid'] else params['musicid'],
-        "charts": [x for x in ([metadata_charts[0]] if len(metadata_charts) > 0 else []) + ext_charts + master_charts + adv_charts + basic_charts + novice_charts if x is not None],
+        "charts": [get_json_keyed_chart(x) for x in ([metadata_charts[0]] if len(metadata_charts) > 0 else []) + ext_charts + master_charts + adv_charts + basic_charts + novice_charts if x is not None],
         "sound_metadata": {
             "guitar": sound_metadata_guitar,
             "drum": sound_metadata_drums,
@@ -1801,7 +1782,7 @@ def create_json_from_dtx(params):
         "preview": sound_metadata['preview'],
     }
 
-    return json.dumps(output_json, indent=4, sort_keys=True)
+    return output_json
 
 
 #########################
@@ -2785,7 +2766,7 @@ def get_charts_data(charts, sound_metadata, params):
 def create_dtx_from_json(params):
     dtx_data = params.get('input', None)
     sound_folder = params.get('sound_folder', None)
-    json_dtx = json.loads(dtx_data)
+    json_dtx = helper.get_json_data(dtx_data)
 
     output_folder = params.get('output', None)
     if output_folder and not os.path.exists(output_folder):
@@ -2885,6 +2866,10 @@ class DtxFormat:
     def to_chart(params):
         return create_dtx_from_json(params)
 
+    @staticmethod
+    def get_sound_filenames(params):
+        return get_sound_filenames_from_dtx(params)
+
     @staticmethod
     def is_format(filename):
         # How to determine a DTX?
@@ -1,4 +1,3 @@
-import json
 import struct
 
 from plugins.gsq import EVENT_ID_MAP, NOTE_MAPPING, generate_json_from_data
@@ -91,7 +90,7 @@ class Gsq2Format:
     def to_json(params):
         output_data = generate_json_from_data(params, read_gsq2_data)
         output_data['format'] = Gsq2Format.get_format_name()
-        return json.dumps(output_data, indent=4, sort_keys=True)
+        return output_data
 
     @staticmethod
     def to_chart(params):
@@ -21,8 +21,14 @@ class JsonFormat:
     def to_chart(params):
         output_filename = os.path.join(params.get('output', ""), "output.json")
 
+        data = params.get('input', "")
+
+        # Charts only get turned into JSON text when JSON is the requested output
+        if not isinstance(data, str):
+            data = json.dumps(data, indent=4, sort_keys=True)
+
         with open(output_filename, "w") as f:
-            f.write(params.get('input', ""))
+            f.write(data)
 
     @staticmethod
     def is_format(filename):
@@ -1,20 +1,136 @@
 import copy
 import os
+import struct
 
 import audio
 
+SEQP_PARTS = ["drum", "guitar", "bass", "open", "guitar1", "guitar2"]
+SEQP_DIFFICULTIES = ["nov", "bsc", "adv", "ext", "mst"]
+
+
+def read_seqp_index(data, data_offset, num_charts):
+    """Index the charts stored in a SEQP container.
+
+    Only the chart headers are read. The chart data of every entry is a
+    memoryview into data, so nothing is copied until a chart is parsed.
+    """
+
+    data = memoryview(data)
+
+    index = []
+    for i in range(num_charts):
+        data_size = struct.unpack("<I", data[data_offset:data_offset+4])[0]
+        chart_data = data[data_offset+0x10:data_offset+0x10+data_size]
+
+        # SQ2 and SQ3 charts share the same header layout
+        if len(chart_data) >= 0x18:
+            entry_count = struct.unpack("<I", chart_data[0x10:0x14])[0]
+            _, is_metadata, difficulty, game_type = chart_data[0x14:0x18]
+
+        else:
+            entry_count, is_metadata, difficulty, game_type = 0, None, None, None
+
+        index.append({
+            'data': chart_data,
+            'is_metadata': is_metadata,
+            'difficulty': difficulty,
+            'game_type': game_type,
+            'entry_count': entry_count,
+        })
+
+        data_offset += data_size
+
+    return index
+
+
+def filter_seqp_index(index, params):
+    """Drop the charts that seqtool's filter_charts would remove after parsing.
+
+    Metadata charts are always kept. With merge_guitars, guitar and bass
+    charts are kept together because they are merged before filtering.
+    When the min or max difficulty is requested, every chart at that
+    difficulty is kept so filter_charts still finds the same range.
+    """
+
+    if 'parts' not in params or 'difficulty' not in params:
+        return index
+
+    parts = SEQP_PARTS[:4] if 'all' in params['parts'] else list(params['parts'])
+    if params.get('merge_guitars', False):
+        if 'guitar' in parts or 'bass' in parts:
+            parts += ['guitar', 'bass']
+
+        if 'guitar1' in parts or 'guitar2' in parts:
+            parts += ['guitar1', 'guitar2']
+
+    # Charts that fail to parse are never seen by filter_charts
+    parsed_index = [x for x in index if x['is_metadata'] in [0, 1]]
+    if not parsed_index:
+        return index
+
+    range_diffs = []
+    if 'min' in params['difficulty']:
+        range_diffs.append(min(x['difficulty'] for x in parsed_index))
+
+    if 'max' in params['difficulty']:
+        range_diffs.append(max(x['difficulty'] for x in parsed_index))
+
+    filtered_index = []
+    for entry in index:
+        if entry['is_metadata'] != 0 or entry['game_type'] >= len(SEQP_PARTS) or entry['difficulty'] >= len(SEQP_DIFFICULTIES):
+            filtered_index.append(entry)
+            continue
+
+        if range_diffs:
+            if entry['difficulty'] in range_diffs:
+                filtered_index.append(entry)
+
+            continue
+
+        part = SEQP_PARTS[entry['game_type']]
+        diff = SEQP_DIFFICULTIES[entry['difficulty']]
+        has_part = part in parts or part not in SEQP_PARTS[:4]
+        has_diff = 'all' in params['difficulty'] or diff in params['difficulty']
+
+        if has_part and has_diff:
+            filtered_index.append(entry)
+
+    return filtered_index
+
+def get_sound_filenames(params):
+    # Sound files read by add_note_durations below
+    sound_metadata = params.get('sound_metadata', [])
+
+    if not sound_metadata or 'entries' not in sound_metadata:
+        return []
+
+    filenames = []
+    for entry in sound_metadata['entries']:
+        if 'duration' in entry and entry['duration'] != 0 and entry['duration'] != 0.0:
+            continue
+
+        filename = entry['filename']
+
+        if 'NoFilename' in entry['flags']:
+            filename = "%04x.wav" % entry['sound_id']
+
+        filenames.append(os.path.join(params['sound_folder'], filename))
+
+    return filenames
+
+
 def generate_json_from_data(params, read_data_callback, raw_charts):
     def combine_metadata_with_chart(metadata, chart):
         if not metadata:
             return chart
 
-        chart_combined = copy.deepcopy(chart)
-
+        # The chart isn't used anywhere else so it's extended in place, but the
+        # metadata events are copied so no event is shared between charts
         for event in metadata['beat_data']:
             if event['name'] in ['measure', 'beat']:
-                chart_combined['beat_data'].append(event)
+                chart['beat_data'].append(copy.deepcopy(event))
 
-        return chart_combined
+        return chart
 
 
     def combine_guitar_charts(guitar_charts, bass_charts):
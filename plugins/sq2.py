@@ -1,9 +1,10 @@
 import copy
-import json
 import os
 import struct
 
-from plugins.sq import generate_json_from_data
+import helper
+
+from plugins.sq import generate_json_from_data, read_seqp_index, filter_seqp_index, get_sound_filenames
 
 VALID_METACOMMANDS = ['startpos', 'endpos', 'baron', 'baroff', 'measure', 'beat', 'unk0c', 'bpm', 'barinfo']
 
@@ -332,7 +333,7 @@ def generate_sq2_from_json(params):
         return output
 
 
-    json_sq2 = json.loads(params['input']) if 'input' in params else None
+    json_sq2 = helper.get_json_data(params['input']) if 'input' in params else None
 
     if not json_sq2:
         print("Couldn't find input data")
@@ -511,18 +512,15 @@ def generate_json_from_sq2(params):
     data_offset = 0x20
     musicid, num_charts = struct.unpack("<II", data[0x14:0x1c])
 
-    raw_charts = []
-    for i in range(num_charts):
-        data_size = struct.unpack("<I", data[data_offset:data_offset+4])[0]
-        chart_data = data[data_offset+0x10:data_offset+0x10+data_size]
-        raw_charts.append((chart_data, None, None, None))
-        data_offset += data_size
+    # Only the charts that will be kept are parsed
+    index = filter_seqp_index(read_seqp_index(data, data_offset, num_charts), params)
+    raw_charts = [(x['data'], None, None, None) for x in index]
 
     output_data = generate_json_from_data(params, read_sq2_data, raw_charts)
     output_data['musicid'] = musicid
     output_data['format'] = Sq2Format.get_format_name()
 
-    return json.dumps(output_data, indent=4, sort_keys=True)
+    return output_data
 
 
 class Sq2Format:
@@ -538,6 +536,10 @@ class Sq2Format:
     def to_chart(params):
         generate_sq2_from_json(params)
 
+    @staticmethod
+    def get_sound_filenames(params):
+        return get_sound_filenames(params)
+
     @staticmethod
     def is_format(filename):
         header = open(filename, "rb").read(0x40)
@@ -1,14 +1,15 @@
 import copy
-import json
+import numpy
 import os
 import struct
 
 import eamxml
+import helper
 
 from lxml import etree
 from lxml.builder import E
 
-from plugins.sq import generate_json_from_data
+from plugins.sq import generate_json_from_data, read_seqp_index, filter_seqp_index, get_sound_filenames
 
 VALID_METACOMMANDS = ['startpos', 'endpos', 'baron', 'baroff', 'measure', 'beat', 'unk0c', 'bpm', 'barinfo']
 
@@ -278,93 +279,13 @@ def create_event_file(params, charts):
 
 
 def generate_sq3_from_json(params):
-    def build_command(event, game_type):
-        output = bytearray(0x40)
-
-        output[0x00:0x04] = struct.pack("<I", event['timestamp'])
-        output[0x04] = EVENT_ID_REVERSE[event['name']] & 0xff
-
-        if event['name'] == "bpm":
-            if event['data']['bpm'] < 1:
-                event['data']['bpm'] = 1
-
-            elif event['data']['bpm'] > 60000000:
-                event['data']['bpm'] = 60000000
-
-            output[0x34:0x38] = struct.pack("<I", int(round(60000000 / event['data']['bpm'])))
-
-        elif event['name'] == "barinfo":
-            output[0x34] = event['data']['numerator'] & 0xff
-
-            denominator = 1 << (event['data']['denominator'].bit_length() - 1)
-            if denominator != event['data']['denominator']:
-                raise Exception("ERROR: The time signature denominator must be divisible by 2."
-                                "Found {}".format(event['data']['denominator']))
-
-            output[0x35] = (event['data']['denominator'].bit_length() - 1) & 0xff
-
-        elif event['name'] == "chipstart":
-            if 'unk' in event['data']:
-                output[0x14:0x18] = struct.pack("<I", event['data']['unk'])
-
-            else:
-                output[0x14:0x18] = struct.pack("<I", 0x16c)
-
-        elif event['name'] == "note":
-            if event['data']['note'] not in REVERSE_NOTE_MAPPING:
-                # Set all unknown events to auto play
-                REVERSE_NOTE_MAPPING[event['data']['note']] = 0xff
-
-            if 'hold_duration' in event['data']:
-                output[0x08:0x0c] = struct.pack("<I", event['data']['hold_duration'])
-
-            if 'unk' in event['data']:
-                output[0x14:0x18] = struct.pack("<I", event['data']['unk'])
-
-            else:
-                output[0x14:0x18] = struct.pack("<I", 0x16c)
-
-            if 'sound_id' in event['data']:
-                output[0x20:0x24] = struct.pack("<I", event['data']['sound_id'])
-
-            if game_type != 0:
-                if 'note_length' in event['data']:
-                    output[0x24:0x28] = struct.pack("<I", event['data']['note_length'])
-
-                else:
-                    output[0x24:0x28] = struct.pack("<I", 0x40)
-
-            if 'volume' in event['data']:
-                output[0x2d] = event['data']['volume'] & 0xff
-
-            if 'auto_volume' in event['data']:
-                output[0x2e] = event['data']['auto_volume'] & 0xff
-
-            if 'note' in event['data']:
-                output[0x30] = REVERSE_NOTE_MAPPING[event['data']['note']] & 0xff
-
-            if 'wail_misc' in event['data']:
-                output[0x31] = event['data']['wail_misc'] & 0xff
-
-            if 'guitar_special' in event['data']:
-                output[0x32] = event['data']['guitar_special'] & 0xff
-
-            if 'auto_note' in event['data']:
-                output[0x34] = event['data']['auto_note'] & 0xff
-
-            if event['data'].get('note') == "auto":
-                output[0x34] = 1  # Auto note
-                output[0x2e] = 1  # Auto volume
-
-        return output
-
-
-    def contains_command(chart, command):
-        for event in chart:
-            if event['name'] == command:
-                return True
-
-        return False
+    def create_command(name, timestamp):
+        return {
+            'name': name,
+            'timestamp': timestamp,
+            'timestamp_ms': timestamp,
+            'data': {},
+        }
 
 
     def calculate_last_measure_duration(chart):
@@ -382,9 +303,9 @@ def generate_sq3_from_json(params):
 
     def create_final_sq3_chart(params, charts_data):
         # Create actual SQ3 data
-        archive_size = 0x20 + (0x30 * len(charts_data)) + sum([len(x['data']) for x in charts_data])
+        archive_size = 0x20 + (0x30 * len(charts_data)) + sum([x['data'].nbytes for x in charts_data])
 
-        output_data = bytearray(0x20)
+        output_data = bytearray(archive_size)
         output_data[0x00:0x04] = b'SEQP'
         output_data[0x04] = 0x01
         output_data[0x06] = 0x01
@@ -395,139 +316,70 @@ def generate_sq3_from_json(params):
         output_data[0x18:0x1c] = struct.pack("<I", len(charts_data))
         output_data[0x1c:0x20] = struct.pack("<I", 0x12345678)
 
-        output_data = bytearray(output_data)
+        offset = 0x20
         for chart_data in charts_data:
             data = chart_data['data']
 
-            sq3t_data = bytearray(0x20)
-            sq3t_data[0x00:0x04] = b'SQ3T'
-            sq3t_data[0x06] = 0x03  # SQ3 flag
-            sq3t_data[0x0a] = 0x03  # SQ3 flag 2?
-            sq3t_data[0x0c:0x10] = struct.pack("<I", 0x20)  # Size of header
-            sq3t_data[0x10:0x14] = struct.pack("<I", len(data) // 0x40)  # Number of events
-            sq3t_data[0x14] = chart_data['header'].get('unk_sys', 0) & 0xff
-            sq3t_data[0x15] = chart_data['header']['is_metadata'] & 0xff
-            sq3t_data[0x16] = chart_data['header']['difficulty'] & 0xff
-            sq3t_data[0x17] = chart_data['header']['game_type'] & 0xff
-            sq3t_data[0x18:0x1a] = struct.pack("<H", chart_data['header'].get('time_division', 300))
-            sq3t_data[0x1a:0x1c] = struct.pack("<H", chart_data['header'].get('beat_division', 480))
-            sq3t_data[0x1c:0x20] = struct.pack("<I", 0x40)  # Size of each entry
+            output_data[offset:offset + 0x04] = struct.pack("<I", data.nbytes + 0x30)
+            output_data[offset + 0x04] = 0x10
+
+            sq3t_offset = offset + 0x10
+            output_data[sq3t_offset + 0x00:sq3t_offset + 0x04] = b'SQ3T'
+            output_data[sq3t_offset + 0x06] = 0x03  # SQ3 flag
+            output_data[sq3t_offset + 0x0a] = 0x03  # SQ3 flag 2?
+            output_data[sq3t_offset + 0x0c:sq3t_offset + 0x10] = struct.pack("<I", 0x20)  # Size of header
+            output_data[sq3t_offset + 0x10:sq3t_offset + 0x14] = struct.pack("<I", len(data))  # Number of events
+            output_data[sq3t_offset + 0x14] = chart_data['header'].get('unk_sys', 0) & 0xff
+            output_data[sq3t_offset + 0x15] = chart_data['header']['is_metadata'] & 0xff
+            output_data[sq3t_offset + 0x16] = chart_data['header']['difficulty'] & 0xff
+            output_data[sq3t_offset + 0x17] = chart_data['header']['game_type'] & 0xff
+            output_data[sq3t_offset + 0x18:sq3t_offset + 0x1a] = struct.pack("<H", chart_data['header'].get('time_division', 300))
+            output_data[sq3t_offset + 0x1a:sq3t_offset + 0x1c] = struct.pack("<H", chart_data['header'].get('beat_division', 480))
+            output_data[sq3t_offset + 0x1c:sq3t_offset + 0x20] = struct.pack("<I", SQ3_EVENT_SIZE)  # Size of each entry
 
             if chart_data['header']['is_metadata'] != 0:
-                sq3t_data[0x15] = 0x01
-                sq3t_data[0x16] = 0x01
+                output_data[sq3t_offset + 0x15] = 0x01
+                output_data[sq3t_offset + 0x16] = 0x01
 
-            file_header = bytearray(0x10)
-            file_header[0x00:0x04] = struct.pack("<I", len(data) + 0x30)
-            file_header[0x04] = 0x10
-
-            output_data += file_header
-            output_data += sq3t_data
-            output_data += data
+            # The event table is copied straight into the output buffer
+            numpy.frombuffer(output_data, dtype=data.dtype, count=len(data), offset=offset + 0x30)[:] = data
+            offset += 0x30 + data.nbytes
 
         return output_data
 
 
-    def generate_metadata_chart(chart):
-        output = bytearray()
-
-        global last_beat, beat_by_timestamp
-        last_beat = 0
-
-        if not contains_command(chart['beat_data'], 'startpos'):
-            output += build_command({
-                'name': 'startpos',
-                'timestamp': 0,
-                'timestamp_ms': 0,
-                'data': {},
-            }, 0)
-
-        if not contains_command(chart['beat_data'], 'baron'):
-            output += build_command({
-                'name': 'baron',
-                'timestamp': 0,
-                'timestamp_ms': 0,
-                'data': {},
-            }, 0)
+    def generate_chart(chart, is_metadata):
+        # Sort once, the sort is stable so events with the same timestamp keep their order
+        beat_data = sorted(chart['beat_data'], key=lambda x:x['timestamp'])
 
-        for event in sorted(chart['beat_data'], key=lambda x:x['timestamp']):
+        commands = set()
+        for event in beat_data:
             if event['name'] not in EVENT_ID_REVERSE:
                 print("Couldn't find %s in EVENT_ID_REVERSE" % event['name'])
                 exit(1)
 
-            if event['name'] not in VALID_METACOMMANDS:
-                continue
+            commands.add(event['name'])
 
-            output += build_command(event, chart['header']['game_type'])
+        if is_metadata:
+            start_commands = ['startpos', 'baron']
+            end_commands = ['endpos']
 
-        last_measure_duration = calculate_last_measure_duration(chart['beat_data'])
-        last_event = sorted(chart['beat_data'], key=lambda x:x['timestamp'])[-1]
-        last_timestamp = last_event['timestamp'] + last_measure_duration
-
-        if not contains_command(chart['beat_data'], 'endpos'):
-            output += build_command({
-                'name': 'endpos',
-                'timestamp': last_timestamp,
-                'timestamp_ms': last_timestamp,
-                'data': {},
-            }, 0)
-
-        return output
-
-
-    def generate_chart(chart):
-        output = bytearray()
-
-        if not contains_command(chart['beat_data'], 'startpos'):
-            output += build_command({
-                'name': 'startpos',
-                'timestamp': 0,
-                'timestamp_ms': 0,
-                'data': {},
-            }, 0)
-
-        if not contains_command(chart['beat_data'], 'chipstart'):
-            output += build_command({
-                'name': 'chipstart',
-                'timestamp': 0,
-                'timestamp_ms': 0,
-                'data': {},
-            }, 0)
-
-        for event in sorted(chart['beat_data'], key=lambda x:x['timestamp']):
-            if event['name'] not in EVENT_ID_REVERSE:
-                print("Couldn't find %s in EVENT_ID_REVERSE" % event['name'])
-                exit(1)
-
-            if event['name'] in VALID_METACOMMANDS:
-                continue
-
-            output += build_command(event, chart['header']['game_type'])
+        else:
+            start_commands = ['startpos', 'chipstart']
+            end_commands = ['chipend', 'endpos']
 
         last_measure_duration = calculate_last_measure_duration(chart['beat_data'])
-        last_event = sorted(chart['beat_data'], key=lambda x:x['timestamp'])[-1]
-        last_timestamp = last_event['timestamp'] + last_measure_duration
-
-        if not contains_command(chart['beat_data'], 'chipend'):
-            output += build_command({
-                'name': 'chipend',
-                'timestamp': last_timestamp,
-                'timestamp_ms': last_timestamp,
-                'data': {},
-            }, 0)
+        last_timestamp = beat_data[-1]['timestamp'] + last_measure_duration
 
-        if not contains_command(chart['beat_data'], 'endpos'):
-            output += build_command({
-                'name': 'endpos',
-                'timestamp': last_timestamp,
-                'timestamp_ms': last_timestamp,
-                'data': {},
-            }, 0)
+        # Metadata charts only keep the metadata commands, note charts keep everything else
+        events = [create_command(x, 0) for x in start_commands if x not in commands]
+        events += [x for x in beat_data if (x['name'] in VALID_METACOMMANDS) == is_metadata]
+        events += [create_command(x, last_timestamp) for x in end_commands if x not in commands]
 
-        return output
+        return build_sq3_events(events, chart['header']['game_type'])
 
 
-    json_sq3 = json.loads(params['input']) if 'input' in params else None
+    json_sq3 = helper.get_json_data(params['input']) if 'input' in params else None
 
     if not json_sq3:
         print("Couldn't find input data")
@@ -549,7 +401,7 @@ def generate_sq3_from_json(params):
     found_parts = []
     parsed_charts = []
     for valid_parts in [['drum'], ['guitar', 'bass', 'open', 'guitar1', 'guitar2']]:
-        metadata_chart = generate_metadata_chart(chart_metadata)
+        metadata_chart = generate_chart(chart_metadata, True)
 
         # Step 2: Generate note charts from input charts
         filtered_charts = [
@@ -572,7 +424,7 @@ def generate_sq3_from_json(params):
 
         for chart in filtered_charts:
             parsed_charts.append({
-                'data': generate_chart(chart),
+                'data': generate_chart(chart, False),
                 'header': chart['header']
             })
 
@@ -585,84 +437,133 @@ def generate_sq3_from_json(params):
         create_event_file(params, filtered_charts)
 
 
-def read_sq3_data(data, events, other_params):
-    def parse_event_block(output, game, events={}):
-        packet_data = {}
+# Fields of a SQ3 event entry, as (type, offset). Some fields overlap because
+# their meaning depends on the event id (bpm, time signature or note data).
+SQ3_EVENT_FIELDS = {
+    'timestamp': ('<u4', 0x00),
+    'id': ('u1', 0x04),
+    'hold_duration': ('<u4', 0x08),
+    'beat': ('<u4', 0x10),
+    'unk': ('<u4', 0x14),
+    'sound_id': ('<u4', 0x20),
+    'note_length': ('<u4', 0x24),
+    'volume': ('u1', 0x2d),
+    'auto_volume': ('u1', 0x2e),
+    'note': ('u1', 0x30),
+    'wail_misc': ('u1', 0x31),
+    'guitar_special': ('u1', 0x32),
+    'auto_note': ('u1', 0x34),
+    'bpm_mpm': ('<u4', 0x34),
+    'numerator': ('u1', 0x34),
+    'denominator': ('u1', 0x35),
+}
 
-        timestamp = struct.unpack("<I", output[0x00:0x04])[0]
-        beat = struct.unpack("<I", output[0x10:0x14])[0]
-        game_type_id = {"drum": 0, "guitar": 1, "bass": 2}[game]
+SQ3_EVENT_MIN_SIZE = 0x38
 
-        if output[0x04] == 0x01:
-            bpm_mpm = struct.unpack("<I", output[0x34:0x38])[0]
-            packet_data['bpm'] = 60000000 / bpm_mpm
-            # print(timestamp, packet_data)
+# Size of the entries written by generate_sq3_from_json
+SQ3_EVENT_SIZE = 0x40
 
-        elif output[0x04] == 0x02:
-            # Time signature is represented as numerator/(1<<denominator)
-            packet_data['numerator'] = output[0x34]
-            packet_data['denominator'] = 1 << output[0x35]
-            packet_data['denominator_orig'] = output[0x35]
 
-            # print(timestamp, packet_data)
+def get_sq3_event_dtype(entry_size):
+    return numpy.dtype({
+        'names': list(SQ3_EVENT_FIELDS.keys()),
+        'formats': [x[0] for x in SQ3_EVENT_FIELDS.values()],
+        'offsets': [x[1] for x in SQ3_EVENT_FIELDS.values()],
+        'itemsize': entry_size,
+    })
 
-        elif output[0x04] == 0x07:
-            packet_data['unk'] = struct.unpack("<I", output[0x14:0x18])[0]  # What is this?
 
-        elif output[0x04] == 0x10:
-            packet_data['hold_duration'] = struct.unpack("<I", output[0x08:0x0c])[0]
-            packet_data['unk'] = struct.unpack("<I", output[0x14:0x18])[0]  # What is this?
-            packet_data['sound_id'] = struct.unpack("<I", output[0x20:0x24])[0]
+def build_sq3_events(events, game_type):
+    """Build the event table of a SQ3T chart from a list of JSON style events.
 
-            # Note length (relation to hold duration)
-            packet_data['note_length'] = struct.unpack("<I", output[0x24:0x28])[0]
+    The values of every field are gathered into columns first and then
+    written into one zero filled structured array (see SQ3_EVENT_FIELDS).
+    """
 
-            packet_data['volume'] = output[0x2d]
-            packet_data['auto_volume'] = output[0x2e]
-            packet_data['note'] = NOTE_MAPPING[game][output[0x30]]
+    columns = {name: ([], []) for name in SQ3_EVENT_FIELDS}
 
-            # wail direction? 0/1 = up, 2 = down. Seems to alternate 0 and 1 if wailing in succession
-            packet_data['wail_misc'] = output[0x31]
+    def set_field(name, idx, value):
+        columns[name][0].append(idx)
+        columns[name][1].append(value)
 
-            # 2 = hold note, 1 = wail (bitmasks, so 3 = wail + hold)
-            packet_data['guitar_special'] = output[0x32]
+    for idx, event in enumerate(events):
+        data = event['data']
 
-            # Auto note
-            packet_data['auto_note'] = output[0x34]
+        set_field('timestamp', idx, event['timestamp'])
+        set_field('id', idx, EVENT_ID_REVERSE[event['name']] & 0xff)
 
-            if packet_data['auto_note'] == 1:
-                packet_data['note'] = "auto"
+        if event['name'] == "bpm":
+            bpm = min(max(data['bpm'], 1), 60000000)
+            set_field('bpm_mpm', idx, int(round(60000000 / bpm)))
 
-            if beat in events:
-                for event in events[beat]:
-                    is_gametype = event['game_type'] == game_type_id
-                    is_eventtype = event['event_type'] == 0
-                    is_note = packet_data['sound_id'] == event['note']
+        elif event['name'] == "barinfo":
+            set_field('numerator', idx, data['numerator'] & 0xff)
 
-                    # This field seems to be maybe left over from previous games?
-                    # 1852 doesn't work properly set the gamelevel fields
-                    #is_diff = (event['gamelevel'] & (1 << difficulty)) != 0
+            denominator = 1 << (data['denominator'].bit_length() - 1)
+            if denominator != data['denominator']:
+                raise Exception("ERROR: The time signature denominator must be divisible by 2."
+                                "Found {}".format(data['denominator']))
 
-                    if is_gametype and is_eventtype and is_note:
-                        packet_data['bonus_note'] = True
+            set_field('denominator', idx, (data['denominator'].bit_length() - 1) & 0xff)
 
-        timestamp = struct.unpack("<I", output[0x00:0x04])[0]
+        elif event['name'] == "chipstart":
+            set_field('unk', idx, data.get('unk', 0x16c))
 
-        return {
-            "id": output[0x04],
-            "name": EVENT_ID_MAP[output[0x04]],
-            'timestamp': timestamp,
-            'timestamp_ms': timestamp / 300,
-            'beat': beat,
-            "data": packet_data
-        }
+        elif event['name'] == "note":
+            if data['note'] not in REVERSE_NOTE_MAPPING:
+                # Set all unknown events to auto play
+                REVERSE_NOTE_MAPPING[data['note']] = 0xff
 
-    output = {
-        "beat_data": []
-    }
+            if 'hold_duration' in data:
+                set_field('hold_duration', idx, data['hold_duration'])
 
-    if data is None:
-        return None
+            set_field('unk', idx, data.get('unk', 0x16c))
+
+            if 'sound_id' in data:
+                set_field('sound_id', idx, data['sound_id'])
+
+            if game_type != 0:
+                set_field('note_length', idx, data.get('note_length', 0x40))
+
+            if 'volume' in data:
+                set_field('volume', idx, data['volume'] & 0xff)
+
+            if 'note' in data:
+                set_field('note', idx, REVERSE_NOTE_MAPPING[data['note']] & 0xff)
+
+            if 'wail_misc' in data:
+                set_field('wail_misc', idx, data['wail_misc'] & 0xff)
+
+            if 'guitar_special' in data:
+                set_field('guitar_special', idx, data['guitar_special'] & 0xff)
+
+            if data.get('note') == "auto":
+                set_field('auto_note', idx, 1)  # Auto note
+                set_field('auto_volume', idx, 1)  # Auto volume
+
+            else:
+                if 'auto_note' in data:
+                    set_field('auto_note', idx, data['auto_note'] & 0xff)
+
+                if 'auto_volume' in data:
+                    set_field('auto_volume', idx, data['auto_volume'] & 0xff)
+
+    output = numpy.zeros(len(events), dtype=get_sq3_event_dtype(SQ3_EVENT_SIZE))
+
+    for name, (indexes, values) in columns.items():
+        if indexes:
+            output[name][indexes] = values
+
+    return output
+
+
+def read_sq3_events(data):
+    """Read the header and event table of a SQ3T chart.
+
+    The events are returned as a NumPy structured array that points into
+    data (see SQ3_EVENT_FIELDS), so nothing is copied or parsed per event.
+    Returns None if the chart type isn't supported.
+    """
 
     magic = data[0:4]
     if magic != b"SQ3T":
@@ -678,7 +579,7 @@ def read_sq3_data(data, events, other_params):
     if is_metadata not in [0, 1]: # Only support metadata and note charts. Not sure what type 2 is yet
         return None
 
-    output['header'] = {
+    header = {
         "unk_sys": unk_sys,
         "is_metadata": is_metadata,
         "difficulty": difficulty,
@@ -687,15 +588,111 @@ def read_sq3_data(data, events, other_params):
         "beat_division": beat_division,
     }
 
-    for i in range(entry_count):
-        mdata = data[header_size + (i * entry_size):header_size + (i * entry_size) + entry_size]
-        part = ["drum", "guitar", "bass"][game_type]
-        parsed_data = parse_event_block(mdata, part, events)
-        output['beat_data'].append(parsed_data)
+    if entry_size < SQ3_EVENT_MIN_SIZE:
+        print("Invalid SQ3 entry size: %d" % entry_size)
+        exit(-1)
+
+    entry_count = min(entry_count, max(len(data) - header_size, 0) // entry_size)
+    events = numpy.frombuffer(data, dtype=get_sq3_event_dtype(entry_size), count=entry_count, offset=header_size)
+
+    return header, events
+
+
+def get_sq3_event_dicts(events, game, bonus_events={}):
+    # Build the JSON style dict of every event from the columns of the event table
+    game_type_id = {"drum": 0, "guitar": 1, "bass": 2}[game]
+    note_mapping = NOTE_MAPPING[game]
+
+    # Bonus notes are matched by beat and sound ID
+    bonus_notes = set()
+    for beat in bonus_events:
+        for event in bonus_events[beat]:
+            # This field seems to be maybe left over from previous games?
+            # 1852 doesn't work properly set the gamelevel fields
+            #is_diff = (event['gamelevel'] & (1 << difficulty)) != 0
+
+            if event['game_type'] == game_type_id and event['event_type'] == 0:
+                bonus_notes.add((beat, event['note']))
+
+    columns = [events[name].tolist() for name in SQ3_EVENT_FIELDS]
+
+    output = []
+    for (timestamp, event_id, hold_duration, beat, unk, sound_id, note_length, volume, auto_volume,
+            note, wail_misc, guitar_special, auto_note, bpm_mpm, numerator, denominator) in zip(*columns):
+        packet_data = {}
+
+        if event_id == 0x01:
+            packet_data['bpm'] = 60000000 / bpm_mpm
+
+        elif event_id == 0x02:
+            # Time signature is represented as numerator/(1<<denominator)
+            packet_data['numerator'] = numerator
+            packet_data['denominator'] = 1 << denominator
+            packet_data['denominator_orig'] = denominator
+
+        elif event_id == 0x07:
+            packet_data['unk'] = unk  # What is this?
+
+        elif event_id == 0x10:
+            packet_data['hold_duration'] = hold_duration
+            packet_data['unk'] = unk  # What is this?
+            packet_data['sound_id'] = sound_id
+
+            # Note length (relation to hold duration)
+            packet_data['note_length'] = note_length
+
+            packet_data['volume'] = volume
+            packet_data['auto_volume'] = auto_volume
+            packet_data['note'] = note_mapping[note]
+
+            # wail direction? 0/1 = up, 2 = down. Seems to alternate 0 and 1 if wailing in succession
+            packet_data['wail_misc'] = wail_misc
+
+            # 2 = hold note, 1 = wail (bitmasks, so 3 = wail + hold)
+            packet_data['guitar_special'] = guitar_special
+
+            # Auto note
+            packet_data['auto_note'] = auto_note
+
+            if auto_note == 1:
+                packet_data['note'] = "auto"
+
+            if (beat, sound_id) in bonus_notes:
+                packet_data['bonus_note'] = True
+
+        output.append({
+            "id": event_id,
+            "name": EVENT_ID_MAP[event_id],
+            'timestamp': timestamp,
+            'timestamp_ms': timestamp / 300,
+            'beat': beat,
+            "data": packet_data
+        })
 
     return output
 
 
+def read_sq3_data(data, events, other_params):
+    if data is None:
+        return None
+
+    chart = read_sq3_events(data)
+
+    if chart is None:
+        return None
+
+    header, chart_events = chart
+    part = ["drum", "guitar", "bass"][header['game_type']]
+
+    # The dicts are built right away because generate_json_from_data goes through every
+    # event of the chart as soon as it is read (extra beats, note lengths, metadata events).
+    # Only the charts kept by filter_seqp_index get this far.
+    return {
+        "beat_data": get_sq3_event_dicts(chart_events, part, events),
+        "header": header,
+    }
+
+
 def generate_json_from_sq3(params):
     data = open(params['input'], "rb").read() if 'input' in params else None
 
@@ -713,18 +710,15 @@ def generate_json_from_sq3(params):
     if not params.get('musicid', None):
         params['musicid'] = musicid
 
-    raw_charts = []
-    for i in range(num_charts):
-        data_size = struct.unpack("<I", data[data_offset:data_offset+4])[0]
-        chart_data = data[data_offset+0x10:data_offset+0x10+data_size]
-        raw_charts.append((chart_data, None, None, None))
-        data_offset += data_size
+    # Only the charts that will be kept are parsed
+    index = filter_seqp_index(read_seqp_index(data, data_offset, num_charts), params)
+    raw_charts = [(x['data'], None, None, None) for x in index]
 
     output_data = generate_json_from_data(params, read_sq3_data, raw_charts)
     output_data['musicid'] = musicid
     output_data['format'] = Sq3Format.get_format_name()
 
-    return json.dumps(output_data, indent=4, sort_keys=True)
+    return output_data
 
 
 class Sq3Format:
@@ -740,6 +734,10 @@ class Sq3Format:
     def to_chart(params):
         generate_sq3_from_json(params)
 
+    @staticmethod
+    def get_sound_filenames(params):
+        return get_sound_filenames(params)
+
     @staticmethod
     def is_format(filename):
         header = open(filename, "rb").read(0x40)
@@ -1,10 +1,11 @@
+import concurrent.futures
 import glob
 import json
-import math
-import pydub
+import numpy
 import os
 import re
 import string
+import threading
 
 import audio
 import helper
@@ -15,15 +16,39 @@ import imageio_ffmpeg
 
 VOLUME_OVERHEAD_PERCENT = 75
 
+# Format everything is mixed in before encoding
+RENDER_RATE = 48000
+RENDER_CHANNELS = 2
 
-def percentage_to_db(percentage):
-    if percentage == 0:
-        return None
+# Number of frames mixed and sent to the encoder at a time
+RENDER_BLOCK_FRAMES = 0x10000
 
-    return 20 * math.log10(percentage / 100)
 
+class SampleBank:
+    """Decoded sounds shared by every chart rendered in one run.
 
-def get_base_audio(input_foldername, bgm_filename, chart_data, no_bgm):
+    Each file is only decoded once, as a (frames, RENDER_CHANNELS) float32
+    array at RENDER_RATE. Safe to use from several render threads.
+    """
+
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def get_samples(self, filename):
+        with self.lock:
+            if filename in self.samples:
+                return self.samples[filename]
+
+        # Decode outside of the lock so other threads can keep mixing
+        samples = load_samples(filename)
+
+        with self.lock:
+            return self.samples.setdefault(filename, samples)
+
+
+def get_base_length(bgm_filename, chart_data, no_bgm, sample_bank):
+    # Number of frames at RENDER_RATE that a rendered chart covers
     if no_bgm:
         # Find last timestamp
         last_timestamp = sorted([x['timestamp_ms'] for x in chart_data['beat_data']])[-1]
@@ -33,18 +58,75 @@ def get_base_audio(input_foldername, bgm_filename, chart_data, no_bgm):
         # case the final notes ring out for long
         duration = last_timestamp + 2 #((last_timestamp) / 0x12c) + 2
 
-        # Create silent audio file
-        output_audio = pydub.AudioSegment.silent(duration=duration * 1000)
-    else:
-        filename = os.path.join(input_foldername, bgm_filename)
-        filename = helper.getCaseInsensitivePath(filename)
-        output_audio = audio.get_audio_file(filename)
+        return int(round(duration * RENDER_RATE))
 
-    return output_audio
+    return len(sample_bank.get_samples(bgm_filename))
+
+
+def load_samples(filename):
+    # Decode a sound into a (frames, RENDER_CHANNELS) float32 array at RENDER_RATE
+    _, data, _ = audio.get_processed_audio(filename, channels=RENDER_CHANNELS, bits=16, rate=RENDER_RATE)
+    return data.astype(numpy.float32) / 32768
+
+
+def mix_at(output, samples, offset):
+    # Add samples into output starting at frame offset, cutting off anything past the end
+    if offset >= len(output):
+        return
+
+    if offset < 0:
+        samples = samples[-offset:]
+        offset = 0
+
+    length = min(len(samples), len(output) - offset)
+    output[offset:offset + length] += samples[:length]
+
+
+def to_int16(samples):
+    # Everything is mixed in float so clipping only happens once here
+    return numpy.clip(numpy.round(samples * 32768), -32768, 32767).astype(numpy.int16)
+
+
+class ChartMix:
+    """Notes of a rendered chart, mixed one block at a time.
+
+    Notes are only recorded by add(). mix_block() adds the parts of the
+    notes that overlap one block of output, so the whole song never has
+    to be held in memory.
+    """
+
+    def __init__(self, length):
+        self.length = length
+        self.offsets = []
+        self.samples = []
+        self.max_length = 0
+        self.sorted_offsets = None
+        self.order = None
+
+    def add(self, offset, samples):
+        if offset >= self.length or offset + len(samples) <= 0:
+            return
+
+        self.offsets.append(offset)
+        self.samples.append(samples)
+        self.max_length = max(self.max_length, len(samples))
+        self.order = None
 
+    def mix_block(self, output, start):
+        # Nothing past the end of the chart is heard, like the end of the BGM
+        output = output[:max(min(len(output), self.length - start), 0)]
 
-def make_silent(audio):
-    return pydub.AudioSegment.silent(duration=len(audio))
+        if self.order is None:
+            self.order = numpy.argsort(self.offsets, kind='stable')
+            self.sorted_offsets = numpy.array(self.offsets, dtype=numpy.int64)[self.order]
+
+        # Only notes starting less than max_length frames before the block can reach it
+        lo = numpy.searchsorted(self.sorted_offsets, start - self.max_length, side='right')
+        hi = numpy.searchsorted(self.sorted_offsets, start + len(output), side='left')
+
+        # Notes are added in chart order so overlapping notes sum the same way every time
+        for idx in numpy.sort(self.order[lo:hi]):
+            mix_at(output, self.samples[idx], self.offsets[idx] - start)
 
 
 def find_sound_filename(path):
@@ -68,20 +150,21 @@ def create_wav_from_chart(chart_data,
                           volume_part=100,
                           volume_bgm=100,
                           volume_auto=100,
-                          ignore_auto=False):
+                          ignore_auto=False,
+                          sample_bank=None):
+    """Render the notes of a chart without the BGM.
 
-    volume_part = 50
+    Returns a ChartMix at RENDER_RATE. Every keysound is only decoded
+    once and scaled once for each volume and pan combination.
+    """
 
-    output_audio = get_base_audio(input_foldername, bgm_filename, chart_data, no_bgm)
-    output_audio = make_silent(output_audio)
+    volume_part = 50
 
-    if volume_bgm != 100:
-        volume_bgm_db = percentage_to_db(volume_bgm)
-        if volume_bgm_db == 0:
-            output_audio = make_silent(output_audio)
+    if sample_bank is None:
+        sample_bank = SampleBank()
 
-        elif volume_bgm_db != 0:
-            output_audio += volume_bgm_db
+    bgm_filename = helper.getCaseInsensitivePath(os.path.join(input_foldername, bgm_filename))
+    output_audio = ChartMix(get_base_length(bgm_filename, chart_data, no_bgm, sample_bank))
 
     sound_files = {}
 
@@ -132,10 +215,6 @@ def create_wav_from_chart(chart_data,
                 print(cd['data'].get('pan'), pan)
                 exit(1)
 
-            if cd['data'].get('pan') != 64 or pan != 64:
-                print(cd['data'].get('pan'), pan)
-                exit(1)
-
             if cd['data'].get('pan'):
                 pan = (pan - (128 / 2)) / (128 / 2)
                 pan = (cd['data']['pan'] - (128 / 2)) / (128 / 2)
@@ -145,42 +224,31 @@ def create_wav_from_chart(chart_data,
 
             wav_filename = find_sound_filename(helper.getCaseInsensitivePath(os.path.join(input_foldername, wav_filename)))
             if os.path.exists(wav_filename):
-                keysound = audio.get_audio_file(wav_filename)
-                keysound = keysound.pan(-pan)
-                db = percentage_to_db((volume / 127) * 100)
-                keysound += db
-
                 if is_auto:
                     volume_key = volume_auto
 
                 else:
                     volume_key = volume_part
 
-                if volume_key != 100:
-                    volume_db = percentage_to_db(volume_key)
-                    if not volume_db:
-                        keysound = make_silent(keysound)
-                    elif volume_db != 0:
-                        keysound += volume_db
+                # Note volume, part volume and headroom all collapse into one gain per channel
+                gain = (volume / 127) * (volume_key / 100) * (VOLUME_OVERHEAD_PERCENT / 100)
+                gains = numpy.array(audio.get_pan_factors(-pan), dtype=numpy.float32) * gain
 
-                keysound += percentage_to_db(VOLUME_OVERHEAD_PERCENT)
-
-                sound_files[sound_key] = keysound
+                sound_files[sound_key] = sample_bank.get_samples(wav_filename) * gains
             else:
                 print("Couldn't find file: %s" % wav_filename)
 
         if sound_key in sound_files:
             position = cd['timestamp_ms'] #int(timestamp_key) / 0x12c
-            print("Overlaying sound at %f" % position)
-            output_audio = output_audio.overlay(sound_files[sound_key], position=position * 1000)
+            output_audio.add(int(round(position * RENDER_RATE)), sound_files[sound_key])
 
     return output_audio
 
 
-def get_selected_difficulty(json_data, params):
+def get_selected_difficulties(json_data, params):
     max_difficulty = None
     min_difficulty = None
-    selected_difficulty = None
+    selected_difficulties = []
 
     for chart_data in json_data['charts']:
         if chart_data['header']['is_metadata'] != 0:
@@ -193,15 +261,15 @@ def get_selected_difficulty(json_data, params):
             min_difficulty = chart_data['header']['difficulty']
 
         diff = ['nov', 'bsc', 'adv', 'ext', 'mst'][chart_data['header']['difficulty']]
-        if diff in params['difficulty']:
-            selected_difficulty = chart_data['header']['difficulty']
+        if diff in params['difficulty'] and chart_data['header']['difficulty'] not in selected_difficulties:
+            selected_difficulties.append(chart_data['header']['difficulty'])
 
     if 'min' in params['difficulty']:
-        selected_difficulty = min_difficulty
+        selected_difficulties = [min_difficulty]
     elif 'max' in params['difficulty']:
-        selected_difficulty = max_difficulty
+        selected_difficulties = [max_difficulty]
 
-    return selected_difficulty
+    return sorted([x for x in selected_difficulties if x is not None])
 
 
 def get_sound_metadata(params, json_data, input_foldername, game_type):
@@ -275,7 +343,7 @@ def get_output_filename(json_data, chart_data, params):
 def get_tags(json_data, chart_data):
     tags = {}
 
-    mdb_tags = mdb.get_song_info_from_csv("gitadora_music.csv", json_data['musicid'])
+    mdb_tags = mdb.get_song_info_from_csv("gitadora_music.csv", json_data['musicid']) or {}
 
     if 'title' in chart_data['header'] and chart_data['header']['title']:
         tags['title'] = chart_data['header']['title']
@@ -332,6 +400,66 @@ def get_bgm_filename(json_data, chart_data, input_foldername):
     return bgm_filename
 
 
+def render_difficulty(charts, bgm_filename, params, sample_bank):
+    # Parts of the same difficulty are layered on top of each other in the order they
+    # were rendered, so each output contains its own part and the ones before it
+    input_foldername = params.get('sound_folder')
+    no_bgm = params.get('render_no_bgm', False)
+    volume_bgm = params.get('render_volume_bgm', 100)
+    volume_part = params.get('render_volume', 100)
+
+    bgms = []
+    for chart_data, json_sound_metadata, tags, output_filename in charts:
+        print("Exporting %s..." % output_filename)
+
+        bgms.append(create_wav_from_chart(chart_data,
+                              input_foldername,
+                              json_sound_metadata,
+                              output_filename,
+                              bgm_filename,
+                              tags=tags,
+                              no_bgm=no_bgm,
+                              ext=params.get('render_ext', "mp3"),
+                              quality=params.get('render_quality', '320k'),
+                              volume_part=volume_part,
+                              volume_bgm=volume_bgm,
+                              volume_auto=params.get('render_volume_auto', 100),
+                              ignore_auto=params.get('render_ignore_auto', False),
+                              sample_bank=sample_bank))
+
+        print("Saving to %s..." % output_filename)
+
+        if not no_bgm:
+            bgm_audio = sample_bank.get_samples(helper.getCaseInsensitivePath(os.path.join(input_foldername, bgm_filename)))
+            base_audio = None
+            length = len(bgm_audio)
+
+        else:
+            base_audio = bgms.pop(0)
+            length = base_audio.length
+
+        gain = (volume_bgm / 100) * (VOLUME_OVERHEAD_PERCENT / 100)
+
+        with audio.AudioEncoder(output_filename, params.get('render_ext', "mp3"), RENDER_RATE, RENDER_CHANNELS, bitrate=params.get('render_quality', '320k'), tags=tags) as encoder:
+            for start in range(0, length, RENDER_BLOCK_FRAMES):
+                block_length = min(RENDER_BLOCK_FRAMES, length - start)
+
+                if base_audio is None:
+                    block = bgm_audio[start:start + block_length] * gain
+
+                else:
+                    block = numpy.zeros((block_length, RENDER_CHANNELS), dtype=numpy.float32)
+                    base_audio.mix_block(block, start)
+                    block *= gain
+
+                for bgm in bgms:
+                    chart_block = numpy.zeros((block_length, RENDER_CHANNELS), dtype=numpy.float32)
+                    bgm.mix_block(chart_block, start)
+                    block += chart_block
+
+                encoder.write(to_int16(block))
+
+
 def generate_wav_from_json(params, generate_output_filename=True):
     input_json = params.get('input')
     input_foldername = params.get('sound_folder')
@@ -349,95 +477,73 @@ def generate_wav_from_json(params, generate_output_filename=True):
     if not input_json:
         raise Exception("Couldn't find input data")
 
-    json_data = json.loads(input_json)
-    selected_difficulty = get_selected_difficulty(json_data, params)
+    json_data = helper.get_json_data(input_json)
+    selected_difficulties = get_selected_difficulties(json_data, params)
 
-    if not selected_difficulty:
+    if not selected_difficulties:
         raise Exception("Couldn't find selected difficulty")
 
-    bgms = []
-    bgm_filename = None
-    for chart_data in json_data['charts']:
-        # Skip metadata charts and stuff not specified by the user
-        if chart_data['header']['is_metadata'] != 0:
-            continue
+    # Every difficulty gets rendered against the same decoded BGMs and keysounds
+    renders = []
+    bgm_filenames = {}
+    for difficulty in selected_difficulties:
+        charts = []
+        bgm_filename = None
 
-        if chart_data['header']['difficulty'] != selected_difficulty:
-            continue
+        for chart_data in json_data['charts']:
+            # Skip metadata charts and stuff not specified by the user
+            if chart_data['header']['is_metadata'] != 0:
+                continue
 
-        game_type = ['drum', 'guitar', 'bass'][chart_data['header']['game_type']]
-        if game_type not in params['parts']:
-            continue
+            if chart_data['header']['difficulty'] != difficulty:
+                continue
 
-        tags = get_tags(json_data, chart_data)
-        if 'title' in tags:
-            chart_data['header']['title'] = tags['title']
+            game_type = ['drum', 'guitar', 'bass'][chart_data['header']['game_type']]
+            if game_type not in params['parts']:
+                continue
 
-        if 'artist' in tags:
-            chart_data['header']['artist'] = tags['artist']
+            tags = get_tags(json_data, chart_data)
+            if 'title' in tags:
+                chart_data['header']['title'] = tags['title']
 
-        output_filename = get_output_filename(json_data, chart_data, params)
+            if 'artist' in tags:
+                chart_data['header']['artist'] = tags['artist']
 
-        if not bgm_filename:
-            bgm_filename = get_bgm_filename(json_data, chart_data, input_foldername)
+            output_filename = get_output_filename(json_data, chart_data, params)
 
-        sound_metadata_type = ['drum', 'guitar', 'guitar'][chart_data['header']['game_type']]
-        json_sound_metadata = get_sound_metadata(params, json_data, input_foldername, sound_metadata_type)
-        if not json_sound_metadata:
-            raise Exception("Couldn't find sound metadata")
+            if not bgm_filename:
+                bgm_key = None if 'bgm' in json_data else chart_data['header']['game_type']
 
-        print("Exporting %s..." % output_filename)
-
-        volume_bgm = params.get('render_volume_bgm', 100)
-        volume_part = params.get('render_volume', 100)
-
-        bgms.append(create_wav_from_chart(chart_data,
-                              input_foldername,
-                              json_sound_metadata,
-                              output_filename,
-                              bgm_filename,
-                              tags=tags,
-                              no_bgm=params.get('render_no_bgm', False),
-                              ext=params.get('render_ext', "mp3"),
-                              quality=params.get('render_quality', '320k'),
-                              volume_part=volume_part,
-                              volume_bgm=volume_bgm,
-                              volume_auto=params.get('render_volume_auto', 100),
-                              ignore_auto=params.get('render_ignore_auto', False)))
+                if bgm_key not in bgm_filenames:
+                    bgm_filenames[bgm_key] = get_bgm_filename(json_data, chart_data, input_foldername)
 
+                bgm_filename = bgm_filenames[bgm_key]
 
-        if not bgm_filename:
-            return
+            sound_metadata_type = ['drum', 'guitar', 'guitar'][chart_data['header']['game_type']]
+            json_sound_metadata = get_sound_metadata(params, json_data, input_foldername, sound_metadata_type)
+            if not json_sound_metadata:
+                raise Exception("Couldn't find sound metadata")
 
-        bgm_filename = os.path.join(input_foldername, bgm_filename)
+            charts.append((chart_data, json_sound_metadata, tags, output_filename))
 
-        print("Saving to %s..." % output_filename)
+        if charts:
+            renders.append((charts, bgm_filename))
 
-        if not params.get('render_no_bgm', False):
-            output_audio = audio.get_audio_file(bgm_filename)
+    sample_bank = SampleBank()
+    workers = params.get('render_workers') or os.cpu_count() or 1
 
-        else:
-            if len(bgms) == 0:
-                return
+    if workers == 1 or len(renders) == 1:
+        for charts, bgm_filename in renders:
+            render_difficulty(charts, bgm_filename, params, sample_bank)
 
-            output_audio = bgms[0]
-            bgms = bgms[1:]
-
-        if volume_bgm != 100:
-            volume_bgm_db = percentage_to_db(volume_bgm)
-
-            if volume_bgm_db == 0:
-                output_audio = make_silent(output_audio)
-
-            elif volume_bgm_db != 0:
-                output_audio += volume_bgm_db
-
-        output_audio += percentage_to_db(VOLUME_OVERHEAD_PERCENT)
+    else:
+        # NumPy and ffmpeg release the GIL for the heavy work, so threads are enough
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(render_difficulty, charts, bgm_filename, params, sample_bank) for charts, bgm_filename in renders]
 
-        for bgm in bgms:
-            output_audio = output_audio.overlay(bgm)
+            for future in futures:
+                future.result()
 
-        output_audio.export(output_filename, format=params.get('render_ext', "mp3"), tags=tags, bitrate=params.get('render_quality', '320k'))
 
 class WavFormat:
     @staticmethod
@@ -0,0 +1,284 @@
+# Benchmark for the WAV output plugin
+#
+# Builds a synthetic song (keysounds, BGM and charts) in a temporary folder,
+# renders it through WavFormat.to_chart and reports the timings as JSON.
+# No game data is needed, so the results can be compared between commits.
+
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import numpy
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+import adpcmwave
+import audio
+import wavfile
+
+from plugins import wav
+
+MUSIC_ID = 1
+RATE = 48000
+DIFFICULTIES = ['nov', 'bsc', 'adv', 'ext', 'mst']
+PARTS = ['drum', 'guitar', 'bass']
+
+
+class Timer:
+    """Adds up the time spent in each stage.
+
+    Wrapped functions only count their own time, anything spent in another
+    wrapped function they call goes to that function's stage instead.
+    Calls from several threads are all added together, so the totals can be
+    more than the wall time when rendering with more than one worker.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def add(self, stage, duration):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0) + duration
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            # Time of the wrapped calls made by this one, for each level of nesting
+            if not hasattr(self.local, 'nested'):
+                self.local.nested = []
+
+            self.local.nested.append(0)
+            start = time.perf_counter()
+
+            try:
+                return func(*args, **kwargs)
+
+            finally:
+                duration = time.perf_counter() - start
+                nested = self.local.nested.pop()
+                self.add(stage, duration - nested)
+
+                if self.local.nested:
+                    self.local.nested[-1] += duration
+
+        return timed
+
+
+def get_peak_rss():
+    # Peak resident memory in KB of this process and of the ffmpeg encoders
+    if resource is None:
+        return None, None
+
+    scale = 1024 if sys.platform == "darwin" else 1
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale
+
+
+def generate_keysounds(foldername, count, length, rs, timer):
+    sounds = []
+
+    for idx in range(count):
+        frames = int(length * RATE * rs.uniform(0.25, 1.0))
+        t = numpy.arange(frames)
+        tone = numpy.sin(t * 2 * numpy.pi * rs.uniform(60, 2000) / RATE) * numpy.exp(-t / (frames / 5))
+        noise = rs.randn(frames) * numpy.exp(-t / (frames / 20))
+        sounds.append(((tone * 0.6 + noise * 0.1) * 20000).clip(-32768, 32767).astype(numpy.int16))
+
+    # Keysounds go through the same ADPCM codec as VA3 archives before they are used
+    start = time.perf_counter()
+    encoded, slices = adpcmwave.encode_batch([(sound, 1) for sound in sounds])
+    decoded = adpcmwave.decode_batch(encoded, [(offset, length, 1) for offset, length in slices])
+    timer.add('adpcm', time.perf_counter() - start)
+
+    for game_type in ['d', 'g']:
+        for idx, sound in enumerate(decoded):
+            wavfile.write(os.path.join(foldername, "%s_%04x.wav" % (game_type, idx)), RATE, sound.reshape(-1))
+
+
+def generate_bgms(foldername, length, rs):
+    frames = int(length * RATE)
+    t = numpy.arange(frames)
+    bgm = numpy.empty((frames, 2), dtype=numpy.int16)
+    bgm[:, 0] = numpy.sin(t * 2 * numpy.pi * 110 / RATE) * 4000 + rs.randn(frames) * 1000
+    bgm[:, 1] = numpy.sin(t * 2 * numpy.pi * 165 / RATE) * 4000 + rs.randn(frames) * 1000
+
+    for bgm_type in ['_gbk', 'd_bk', 'd__k']:
+        wavfile.write(os.path.join(foldername, "bgm%04d%s.wav" % (MUSIC_ID, bgm_type)), RATE, bgm)
+
+
+def generate_chart(difficulty, game_type, notes, keysounds, length, rs):
+    timestamps = numpy.sort(rs.uniform(0, length, notes))
+
+    beat_data = []
+    for timestamp in timestamps:
+        beat_data.append({
+            'name': "note",
+            'timestamp_ms': float(timestamp),
+            'data': {
+                'sound_id': int(rs.randint(keysounds)),
+                'volume': int(rs.choice([127, 110, 90])),
+                'pan': 64,
+                'auto_volume': 0,
+                'auto_note': 0,
+            }
+        })
+
+    return {
+        'header': {
+            'is_metadata': 0,
+            'difficulty': difficulty,
+            'game_type': game_type,
+            'title': "Benchmark",
+            'artist': "",
+        },
+        'beat_data': beat_data,
+    }
+
+
+def run_benchmark(args):
+    rs = numpy.random.RandomState(args.seed)
+    timer = Timer()
+    parts = PARTS[:args.parts]
+    difficulties = DIFFICULTIES[-args.difficulties:]
+    notes = int(args.density * args.length)
+
+    foldername = tempfile.mkdtemp(prefix="render_benchmark_")
+    cwd = os.getcwd()
+
+    try:
+        start = time.perf_counter()
+        generate_bgms(foldername, args.length, rs)
+        generate_keysounds(foldername, args.keysounds, args.keysound_length, rs, timer)
+        timer.add('generate', time.perf_counter() - start - timer.stages['adpcm'])
+
+        charts = []
+        for difficulty in difficulties:
+            for part in parts:
+                charts.append(generate_chart(DIFFICULTIES.index(difficulty), PARTS.index(part), notes, args.keysounds, args.length, rs))
+
+        sound_metadata = {
+            'entries': [{'sound_id': idx, 'volume': 127, 'pan': 64, 'filename': "", 'flags': []} for idx in range(args.keysounds)]
+        }
+
+        params = {
+            'input': json.dumps({'musicid': MUSIC_ID, 'charts': charts}),
+            'sound_folder': foldername,
+            'sound_metadata': sound_metadata,
+            'output': "benchmark." + args.format,
+            'parts': parts,
+            'difficulty': difficulties,
+            'render_ext': args.format,
+            'render_quality': args.quality,
+            'render_workers': args.workers,
+        }
+
+        # Time spent decoding sounds, placing notes, mixing blocks and waiting on the encoder
+        load_samples = wav.load_samples
+        create_wav_from_chart = wav.create_wav_from_chart
+        to_int16 = wav.to_int16
+        mix_block = wav.ChartMix.mix_block
+        encoder_class = audio.AudioEncoder
+
+        class TimedEncoder(encoder_class):
+            write = timer.wrap('encode', encoder_class.write)
+            close = timer.wrap('encode', encoder_class.close)
+
+        wav.load_samples = timer.wrap('decode', load_samples)
+        wav.create_wav_from_chart = timer.wrap('notes', create_wav_from_chart)
+        wav.to_int16 = timer.wrap('mix', to_int16)
+        wav.ChartMix.mix_block = timer.wrap('mix', mix_block)
+        audio.AudioEncoder = TimedEncoder
+
+        try:
+            os.chdir(foldername)
+            start = time.perf_counter()
+
+            # Keep the plugin's progress messages out of the JSON on stdout
+            with contextlib.redirect_stdout(sys.stderr):
+                wav.WavFormat.to_chart(params)
+
+            wall_time = time.perf_counter() - start
+
+        finally:
+            os.chdir(cwd)
+            wav.load_samples = load_samples
+            wav.create_wav_from_chart = create_wav_from_chart
+            wav.to_int16 = to_int16
+            wav.ChartMix.mix_block = mix_block
+            audio.AudioEncoder = encoder_class
+
+        output_size = sum(os.path.getsize(os.path.join(foldername, filename)) for filename in os.listdir(foldername) if filename.endswith("." + args.format) and filename.startswith("["))
+
+    finally:
+        shutil.rmtree(foldername, ignore_errors=True)
+
+    total_notes = notes * len(charts)
+    peak_rss, peak_rss_children = get_peak_rss()
+
+    return {
+        'config': {
+            'length': args.length,
+            'density': args.density,
+            'keysounds': args.keysounds,
+            'keysound_length': args.keysound_length,
+            'parts': parts,
+            'difficulties': difficulties,
+            'format': args.format,
+            'quality': args.quality,
+            'workers': args.workers,
+            'seed': args.seed,
+        },
+        'charts': len(charts),
+        'notes': total_notes,
+        'wall_time': wall_time,
+        'notes_per_sec': total_notes / wall_time if wall_time > 0 else None,
+        'peak_rss_kb': peak_rss,
+        'peak_rss_children_kb': peak_rss_children,
+        'output_bytes': output_size,
+        'stages': {
+            'generate': timer.stages.get('generate', 0),
+            'adpcm': timer.stages.get('adpcm', 0),
+        },
+        # Summed over all render threads, so these can add up to more than wall_time with several workers
+        'render_thread_time': {
+            'decode': timer.stages.get('decode', 0),
+            'notes': timer.stages.get('notes', 0),
+            'mix': timer.stages.get('mix', 0),
+            'encode': timer.stages.get('encode', 0),
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--length', help='Song length in seconds', default=120, type=float)
+    parser.add_argument('--density', help='Notes per second in each chart', default=10, type=float)
+    parser.add_argument('--keysounds', help='Number of keysounds', default=100, type=int)
+    parser.add_argument('--keysound-length', help='Maximum length of a keysound in seconds', default=1.0, type=float)
+    parser.add_argument('--parts', help='Number of parts to render (drum, guitar, bass)', default=1, type=int, choices=[1, 2, 3])
+    parser.add_argument('--difficulties', help='Number of difficulties to render, starting from MST', default=1, type=int, choices=[1, 2, 3, 4, 5])
+    parser.add_argument('--format', help='Output format', default='mp3')
+    parser.add_argument('--quality', help='Output quality', default='320k')
+    parser.add_argument('--workers', help='Number of difficulties rendered at the same time', default=1, type=int)
+    parser.add_argument('--seed', help='Random seed for the synthetic song', default=0, type=int)
+    parser.add_argument('--output', help='Write the results to a JSON file instead of stdout')
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+    else:
+        print(json.dumps(results, indent=4))
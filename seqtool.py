@@ -1,13 +1,18 @@
 # Gitadora Re:evolve SQ3 format
 import argparse
 import glob
+import hashlib
 import importlib
 import json
 import os
+import pickle
 import shutil
 import sys
 import threading
+import zlib
 
+import cache
+import helper
 import tmpfile
 
 import wavbintool
@@ -21,6 +26,12 @@ import plugins
 
 running_threads = []
 
+# Parsed charts are cached so converting the same input again skips parsing
+CHART_CACHE_CATEGORY = "charts"
+CHART_CACHE_VERSION = 1
+
+plugins_digest = None
+
 def find_handler(input_filename, input_format):
     formats = [importlib.import_module('plugins.' + name).get_class() for name in plugins.__all__]
 
@@ -37,8 +48,6 @@ def find_handler(input_filename, input_format):
 
 
 def filter_charts(json_data, params):
-    json_data = json.loads(json_data)
-
     if 'charts' not in json_data:
         return json_data
 
@@ -77,7 +86,103 @@ def filter_charts(json_data, params):
     for chart in filtered_charts:
         json_data['charts'].remove(chart)
 
-    return json.dumps(json_data, indent=4)
+    return json_data
+
+
+def get_file_digest(filename):
+    with open(filename, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def get_plugins_digest():
+    # Any change to the plugins invalidates the cache
+    global plugins_digest
+
+    if plugins_digest is None:
+        digest = hashlib.sha1()
+
+        for filename in sorted(glob.glob(os.path.join(os.path.dirname(plugins.__file__), "*.py"))):
+            with open(filename, "rb") as f:
+                digest.update(f.read())
+
+        plugins_digest = digest.hexdigest()
+
+    return plugins_digest
+
+
+def get_sound_files_digest(params, input_handler):
+    # Chart parsing can depend on the length of the sounds used by the chart.
+    # Keysounds extracted from a VA3 archive are rewritten on every run,
+    # so the archive they came from is used instead.
+    if params.get('sound_source'):
+        return get_file_digest(params['sound_source'])
+
+    get_sound_filenames = getattr(input_handler, 'get_sound_filenames', None)
+    if get_sound_filenames is None:
+        return None
+
+    digest = hashlib.sha1()
+    for filename in get_sound_filenames(params):
+        filename = helper.getCaseInsensitivePath(filename)
+        file_digest = get_file_digest(filename) if os.path.isfile(filename) else "missing"
+        digest.update(("%s:%s;" % (os.path.basename(filename), file_digest)).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def get_chart_cache_key(params, input_handler):
+    input_filenames = [params.get('input')]
+    for part in (params.get('input_split') or {}).values():
+        input_filenames += part.values()
+
+    input_filenames = [x for x in input_filenames if x]
+
+    # Folders (JSON input) aren't cached
+    if not input_filenames or not all(os.path.isfile(x) for x in input_filenames):
+        return None
+
+    settings = {
+        'version': CHART_CACHE_VERSION,
+        'format': input_handler.get_format_name(),
+        'plugins': get_plugins_digest(),
+        'inputs': [get_file_digest(x) for x in input_filenames],
+        'sounds': get_sound_files_digest(params, input_handler),
+        'sound_metadata': params.get('sound_metadata'),
+        'events': params.get('events'),
+        'parts': params.get('parts'),
+        'difficulty': params.get('difficulty'),
+        'musicid': params.get('musicid'),
+        'merge_guitars': params.get('merge_guitars'),
+        'dtx_pad_start': params.get('dtx_pad_start'),
+        'dtx_pad_end': params.get('dtx_pad_end'),
+        'dtx_fake_timesigs': params.get('dtx_fake_timesigs'),
+        'no_sounds': params.get('no_sounds'),
+    }
+
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def get_cached_chart(cache_key):
+    data = cache.read_cache_file(CHART_CACHE_CATEGORY, cache_key + ".bin")
+
+    if data is None:
+        return None
+
+    try:
+        cached_chart = pickle.loads(zlib.decompress(data))
+
+    except (ValueError, EOFError, zlib.error, pickle.UnpicklingError):
+        return None
+
+    print("Using cached chart data")
+
+    return cached_chart
+
+
+def save_cached_chart(cache_key, json_data, changed_params):
+    data = zlib.compress(pickle.dumps((json_data, changed_params), protocol=pickle.HIGHEST_PROTOCOL), 1)
+    cache_filename = cache.write_cache_file(CHART_CACHE_CATEGORY, cache_key + ".bin", data)
+    cache.evict_cache([cache_filename])
 
 
 def process_file(params):
@@ -104,7 +209,23 @@ def process_file(params):
 
     print("Using {} handler to process this file...".format(input_handler.get_format_name()))
 
-    json_data = input_handler.to_json(params)
+    cache_key = None if params.get('no_cache') else get_chart_cache_key(params, input_handler)
+    cached_chart = get_cached_chart(cache_key) if cache_key else None
+
+    if cached_chart:
+        json_data, changed_params = cached_chart
+        params.update(changed_params)
+
+    else:
+        musicid = params.get('musicid')
+
+        # Input plugins return chart data as Python objects, only JSON files need to be parsed.
+        # The charts are filtered and merged in place from here on.
+        json_data = helper.get_json_data(input_handler.to_json(params))
+
+        if cache_key and json_data:
+            # Some plugins fill in the music ID while parsing, so that is cached too
+            save_cached_chart(cache_key, json_data, {'musicid': params['musicid']} if params.get('musicid') != musicid else {})
 
     # Filter based on difficulty and parts here
     json_data = filter_charts(json_data, params)
@@ -131,8 +252,6 @@ def process_file(params):
                 mdb_info['movie_filename'] = csv_info['movie_filename']
 
         if mdb_info:
-            json_data = json.loads(json_data)
-
             for chart in json_data['charts']:
                 if chart['header']['is_metadata']:
                     continue
@@ -161,8 +280,6 @@ def process_file(params):
                 chart['header']['artist'] = mdb_info['artist']
                 chart['header']['bpm'] = mdb_info['bpm']
 
-            json_data = json.dumps(json_data)
-
     params['input'] = json_data
 
     output_handler.to_chart(params)
@@ -229,12 +346,16 @@ if __name__ == "__main__":
     parser.add_argument('--render-volume-auto', help="Force volume of auto notes during rendering", default=100, type=int)
     parser.add_argument('--render-no-bgm', action='store_true', help="Mute BGM during render", default=False)
     parser.add_argument('--render-ignore-auto', action='store_true', help="Mute auto notes during render", default=False)
+    parser.add_argument('--render-workers', help="Number of difficulties rendered at the same time (default: number of CPUs)", default=None, type=int)
 
     parser.add_argument('--dtx-pad-start', help="Pad the start of the song by x measures", default=0, type=int)
     parser.add_argument('--dtx-pad-end', help="Pad the end of the song by x measures", default=2, type=int)
     parser.add_argument('--dtx-fake-timesigs', help="Fake time signatures when converting to DTX to work around x/4 limitation", default=False, action='store_true')
+    parser.add_argument('--dtx-workers', help="Number of DTX charts parsed at the same time (default: number of charts, up to the number of CPUs)", default=None, type=int)
 
     parser.add_argument('--single-threaded', help="Process charts in single threads", default=False, action='store_true')
+    parser.add_argument('--no-cache', help="Don't use or update the parsed chart cache", default=False, action='store_true')
+    parser.add_argument('--bgm-workers', help="Number of processes used to decode BGMs (default: number of CPUs)", default=None, type=int)
 
     args = parser.parse_args()
 
@@ -253,10 +374,6 @@ if __name__ == "__main__":
     elif 'max' in args.difficulty:
         args.difficulty = ['max']
 
-    if args.output_format.lower() == "wav":
-        if 'all' in args.difficulty or len(args.difficulty) > 1:
-            raise Exception("Can only specify one difficulty for WAV export mode")
-
     if args.input_ifs_seq:
         if os.path.isdir(args.input_ifs_seq):
             filenames = glob.glob(args.input_ifs_seq + "/*")
@@ -335,18 +452,22 @@ if __name__ == "__main__":
             else:
                 filenames_bgm, ifs_path = ifs.extract(args.input_ifs_bgm)
 
+            bgm_filenames = []
             for filename in filenames_bgm:
                 # Convert to WAV
-                output_filename = filename.replace(".bin", ".wav")
                 output_filename = os.path.join(sound_folder, os.path.basename(filename).replace(".bin", ".wav"))
 
                 print("Converting %s..." % output_filename)
 
-                if not args.single_threaded:
-                    bgm_thread = threading.Thread(target=wavbintool.parse_bin, args=(filename, output_filename))
-                    bgm_thread.start()
-                    running_threads.append(bgm_thread)
-                else:
+                bgm_filenames.append((filename, output_filename))
+
+            if not args.single_threaded:
+                # Decode all BGMs in a process pool while the charts are being handled
+                bgm_thread = threading.Thread(target=wavbintool.parse_bins, args=(bgm_filenames, args.bgm_workers))
+                bgm_thread.start()
+                running_threads.append(bgm_thread)
+            else:
+                for filename, output_filename in bgm_filenames:
                     wavbintool.parse_bin(filename, output_filename)
         else:
             filenames_bgm = None
@@ -366,6 +487,7 @@ if __name__ == "__main__":
                 "output": args.output,
                 "output_format": args.output_format,
                 "sound_folder": sound_folder,
+                "sound_source": file_set['sound'] if 'sound' in file_set and not args.no_sounds else None,
                 "sound_metadata": get_sound_metadata(sound_folder),
                 "event_file": file_set['event'] if 'event' in file_set else None,
                 "parts": args.parts,
@@ -412,11 +534,15 @@ if __name__ == "__main__":
                 "render_volume": args.render_volume,
                 "render_volume_bgm": args.render_volume_bgm,
                 "render_ignore_auto": args.render_ignore_auto,
+                "render_workers": args.render_workers,
                 "dtx_pad_start": args.dtx_pad_start,
                 "dtx_pad_end": args.dtx_pad_end,
                 "dtx_fake_timesigs": args.dtx_fake_timesigs,
+                "dtx_workers": args.dtx_workers,
+                "single_threaded": args.single_threaded,
                 "no_sounds": args.no_sounds,
                 "generate_bgms": args.generate_bgms,
+                "no_cache": args.no_cache,
             }
 
             process_file(params)
@@ -501,11 +627,15 @@ if __name__ == "__main__":
             "render_volume": args.render_volume,
             "render_volume_bgm": args.render_volume_bgm,
             "render_ignore_auto": args.render_ignore_auto,
+            "render_workers": args.render_workers,
             "dtx_pad_start": args.dtx_pad_start,
             "dtx_pad_end": args.dtx_pad_end,
             "dtx_fake_timesigs": args.dtx_fake_timesigs,
+            "dtx_workers": args.dtx_workers,
+            "single_threaded": args.single_threaded,
             "no_sounds": args.no_sounds,
             "generate_bgms": args.generate_bgms,
+            "no_cache": args.no_cache,
         }
 
         if not args.single_threaded:
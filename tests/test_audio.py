@@ -0,0 +1,55 @@
+import os
+import struct
+import sys
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import audio
+
+
+def write_extensible_wav(filename, data, rate, sub_format, bits):
+    # WAVE_FORMAT_EXTENSIBLE header with the sub-format GUID's first two bytes set to sub_format
+    channels = 1 if data.ndim == 1 else data.shape[1]
+    block_align = channels * bits // 8
+    guid = struct.pack("<H", sub_format) + b"\x00\x00\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71"
+    fmt = struct.pack("<HHIIHHHHI", audio.WAVE_FORMAT_EXTENSIBLE, channels, rate, rate * block_align, block_align, bits, 22, bits, 0) + guid
+    raw = data.tobytes()
+
+    with open(filename, "wb") as f:
+        f.write(b"RIFF" + struct.pack("<I", 4 + 8 + len(fmt) + 8 + len(raw)) + b"WAVE")
+        f.write(b"fmt " + struct.pack("<I", len(fmt)) + fmt)
+        f.write(b"data" + struct.pack("<I", len(raw)) + raw)
+
+
+def get_sine(rate, amplitude=0.5):
+    return amplitude * numpy.sin(2 * numpy.pi * 440 * numpy.arange(rate // 10) / rate)
+
+
+def test_extensible_float_wav(tmp_path):
+    filename = str(tmp_path / "float.wav")
+    sine = get_sine(48000)
+    write_extensible_wav(filename, sine.astype(numpy.float32), 48000, audio.WAVE_FORMAT_IEEE_FLOAT, 32)
+
+    assert audio.is_pcm_wav(filename)
+
+    rate, data, bits = audio.get_processed_audio(filename, channels=1, rate=48000, bits=16)
+    expected = numpy.round(sine * 32768).astype(numpy.int16)
+
+    assert rate == 48000 and bits == 16
+    assert numpy.abs(data.astype(numpy.int32) - expected).max() <= 1
+
+
+def test_extensible_int16_wav(tmp_path):
+    filename = str(tmp_path / "int16.wav")
+    sine = numpy.round(get_sine(44100) * 32767).astype(numpy.int16)
+    stereo = numpy.stack([sine, -sine], axis=1)
+    write_extensible_wav(filename, stereo, 44100, audio.WAVE_FORMAT_PCM, 16)
+
+    assert audio.is_pcm_wav(filename)
+
+    rate, data, bits = audio.get_processed_audio(filename, channels=2, rate=44100, bits=16)
+
+    assert rate == 44100 and bits == 16
+    assert numpy.array_equal(data, stereo)
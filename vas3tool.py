@@ -1,16 +1,18 @@
 import argparse
+import hashlib
 import io
 import json
 import math
-import numpy
+import mmap
 import os
 import pydub
 import struct
 import sys
 import wavfile
-import pydub
+import pydub.utils
 
 import audio
+import cache
 import tmpfile
 import helper
 
@@ -28,6 +30,13 @@ FLAG_MAP = {
     "NoFilename": 0x0100
 }
 
+# Format that every keysound is converted to before encoding (channels, rate, bits)
+KEYSOUND_FORMAT = (1, 48000, 16)
+
+# Encoded keysounds are cached by the hash of their source file
+KEYSOUND_CACHE_CATEGORY = "va3"
+KEYSOUND_CACHE_VERSION = 1
+
 VOLUME_TABLE = [ 0, 14, 21, 28,  33,  37,  41,  44,
                 47, 50, 53, 55,  57,  59,  61,  63,
                 65, 66, 67, 68,  69,  70,  71,  71,
@@ -45,7 +54,40 @@ VOLUME_TABLE = [ 0, 14, 21, 28,  33,  37,  41,  44,
                 98, 98, 98, 98,  99,  99,  99,  99,
                 99, 99, 99, 99, 100, 100, 100, 100 ]
 
-def write_vas3(input_foldername, output_filename, force_game="drum", metadata=None):
+def get_keysound_cache_name(filename):
+    with open(filename, "rb") as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+
+    channels, rate, bits = KEYSOUND_FORMAT
+    return "%s_%d_%d_%d_v%d.bin" % (digest, channels, rate, bits, KEYSOUND_CACHE_VERSION)
+
+
+def get_cached_keysound(cache_name):
+    data = cache.read_cache_file(KEYSOUND_CACHE_CATEGORY, cache_name)
+
+    if data is None or len(data) < 6:
+        return None
+
+    channels, rate = struct.unpack("<HI", data[:6])
+    return channels, rate, data[6:]
+
+
+def encode_keysound(filename, cache_name=None):
+    channels, rate, bits = KEYSOUND_FORMAT
+
+    rate, raw_data, bits = audio.get_processed_audio(filename, channels=channels, rate=rate, bits=bits)
+
+    channels = 1 if len(raw_data.shape) == 1 else raw_data.shape[1]
+
+    encoded_data = adpcmwave.encode_data(raw_data, channels)
+
+    if cache_name:
+        cache.write_cache_file(KEYSOUND_CACHE_CATEGORY, cache_name, struct.pack("<HI", channels, rate) + bytes(encoded_data))
+
+    return channels, rate, encoded_data
+
+
+def write_vas3(input_foldername, output_filename, force_game="drum", metadata=None, workers=None, use_cache=True):
     if not input_foldername:
         input_foldername = ""
 
@@ -106,7 +148,8 @@ def write_vas3(input_foldername, output_filename, force_game="drum", metadata=No
             outfile.write(bytearray([0] * (gdx_entry_start - outfile.tell()))) # Padding
 
         defaults = [metadata['defaults'][x] for x in metadata['defaults']]
-        data_section = bytearray()
+        table_entries = []
+        source_filenames = []
 
         for entry in metadata['entries']:
             filename = entry['filename']
@@ -141,23 +184,40 @@ def write_vas3(input_foldername, output_filename, force_game="drum", metadata=No
             if 'extra' not in entry:
                 entry['extra'] = 255 # Normal?
 
-            # try:
-            #     rate, raw_data, bits = wavfile.read(filename)
-            # except:
+            table_entries.append(entry)
+            source_filenames.append(filename)
 
-            # Try using pysoundfile if wavfile failed
-            # If this code works well enough, I can probably get rid of
-            # wavfile for the was3tool since looping isn't required
-            # TODO: Replace this with code to detect if it's a WAV, 16bit, mono, and 48000 and if so, use wavfile instead
-            #print(filename)
-            filename = audio.get_processed_wav(filename, channels=1, rate=48000, bits=16)
+        # Reuse previously encoded sounds from the cache and encode the rest in a process pool
+        cache_names = [get_keysound_cache_name(filename) if use_cache else None for filename in source_filenames]
+        encoded_sounds = [get_cached_keysound(cache_name) if cache_name else None for cache_name in cache_names]
+        missing = [idx for idx, encoded in enumerate(encoded_sounds) if encoded is None]
 
-            rate, raw_data, bits = wavfile.read(filename)
+        if len(missing) > 1 and workers != 1:
+            with helper.get_process_pool(workers) as executor:
+                results = executor.map(encode_keysound, [source_filenames[idx] for idx in missing], [cache_names[idx] for idx in missing])
 
-            channels = 1 if len(raw_data.shape) == 1 else raw_data.shape[1]
+                for idx, encoded in zip(missing, results):
+                    encoded_sounds[idx] = encoded
+
+        else:
+            for idx in missing:
+                encoded_sounds[idx] = encode_keysound(source_filenames[idx], cache_names[idx])
+
+        if use_cache and len(missing) > 0:
+            cache.evict_cache([cache.get_cache_filename(KEYSOUND_CACHE_CATEGORY, cache_name) for cache_name in cache_names])
+
+        # Each entry is aligned to 0x10 bytes in the data section
+        data_section = bytearray()
+        data_slices = []
+        for channels, rate, encoded_data in encoded_sounds:
+            data_slices.append((len(data_section), len(encoded_data)))
+            data_section += encoded_data
 
-            encoded_data = adpcmwave.encode_data(raw_data, channels)
+            padding = 0x10 - (len(data_section) % 0x10)
+            if padding != 0x10:
+                data_section += bytearray([0] * padding)
 
+        for entry, (channels, rate, _), (data_offset, data_size) in zip(table_entries, encoded_sounds, data_slices):
             sound_flag = 0
             for flag in entry['flags']:
                 if flag in FLAG_MAP:
@@ -178,8 +238,8 @@ def write_vas3(input_foldername, output_filename, force_game="drum", metadata=No
             if version < 2:
                 volume = VOLUME_TABLE.index(min(VOLUME_TABLE, key=lambda x:abs(x-entry['volume'])))
 
-            outfile.write(struct.pack("<I", len(data_section)))
-            outfile.write(struct.pack("<I", len(encoded_data)))
+            outfile.write(struct.pack("<I", data_offset))
+            outfile.write(struct.pack("<I", data_size))
             outfile.write(struct.pack("<H", channels))
             outfile.write(struct.pack("<H", 0x10)) # Will this ever not be 16 bit?
             outfile.write(struct.pack("<I", rate))
@@ -197,12 +257,6 @@ def write_vas3(input_foldername, output_filename, force_game="drum", metadata=No
             if len(filename_bytes) < 0x20:
                 outfile.write(bytearray([0] * (0x20 - len(filename_bytes))))
 
-            data_section += encoded_data
-
-            padding = 0x10 - (len(data_section) % 0x10)
-            if padding != 0x10:
-                data_section += bytearray([0] * padding)
-
 
         if outfile.tell() < data_start:
             outfile.write(bytearray([0] * (data_start - outfile.tell()))) # Padding
@@ -210,81 +264,133 @@ def write_vas3(input_foldername, output_filename, force_game="drum", metadata=No
         outfile.write(data_section)
 
 
-def read_vas3(input_filename, output_folder, force_hex=False, mix_audio=False, force_game=None):
-    data = open(input_filename, "rb").read()
-
-    if data[0:4].decode('ascii') != "VA3W":
-        print("Not a valid VA3 file")
-        exit(1)
-
-    # v3 header is 1 0 0 2
-    version_flag1, version_flag2, version_flag3, version_flag4, entry_count, gdx_size, gdx_start, entry_start, data_start = struct.unpack("<BBBBIIIII", data[0x04:0x1c])
-
-    if entry_count <= 0:
-        print("No files to extract")
-        exit(1)
-
-    gdx_magic = data[gdx_start:gdx_start+4].decode('ascii')
-    if gdx_magic != "GDXH" and gdx_magic != "GDXG":
-        print("Not a valid GDXH header")
-        exit(1)
-
-    default_hihat, default_snare, default_bass, default_hightom, default_lowtom, default_rightcymbal = struct.unpack("<HHHHHH", data[gdx_start+0x04:gdx_start+0x10])
-    if gdx_magic == "GDXH":
-        default_leftcymbal = 0xfff0
-        default_floortom = 0xfff1
-        default_leftpedal = 0xfff2
-        gdx_type_unk1 = data[gdx_start+0x10] # Not used anywhere?
-        gdx_volume_flag = data[gdx_start+0x11] # How does this work with GDXG?
-
-        filename_prefix = "g"
-
-    elif gdx_magic == "GDXG":
-        default_leftcymbal, default_floortom, default_leftpedal = struct.unpack("<HHH", data[gdx_start+0x10:gdx_start+0x16])
-        gdx_type_unk1 = 0
-        gdx_volume_flag = 1
-
-        filename_prefix = "d"
-
-    if force_game:
-        filename_prefix = force_game[0]
-
-    metadata = {
-        'type': gdx_magic,
-        'version': version_flag4,
-        'defaults': {
-            'default_hihat': default_hihat,
-            'default_snare': default_snare,
-            'default_bass': default_bass,
-            'default_hightom': default_hightom,
-            'default_lowtom': default_lowtom,
-            'default_rightcymbal': default_rightcymbal,
-            'default_leftcymbal': default_leftcymbal,
-            'default_floortom': default_floortom,
-            'default_leftpedal': default_leftpedal,
-        },
-        'gdx_type_unk1': gdx_type_unk1,
-        'gdx_volume_flag': gdx_volume_flag,
-        'entries': [],
-    }
+class VA3Archive:
+    """Read-only view of a VA3 archive backed by mmap.
+
+    Nothing is parsed until it is needed and entry data is returned as
+    memoryview slices of the mapped file, so only the parts of the archive
+    that are actually used are read from disk.
+    """
+
+    def __init__(self, filename, force_game=None):
+        self.filename = filename
+        self.force_game = force_game
+
+        self.file = open(filename, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._header = None
+        self._gdx = None
+        self._entries = {}
+        self._sound_ids = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.header['entry_count']
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    @property
+    def header(self):
+        if self._header is None:
+            if self.data[0:4] != b"VA3W":
+                print("Not a valid VA3 file")
+                exit(1)
+
+            # v3 header is 1 0 0 2
+            version_flag1, version_flag2, version_flag3, version_flag4, entry_count, gdx_size, gdx_start, entry_start, data_start = struct.unpack_from("<BBBBIIIII", self.data, 0x04)
+
+            self._header = {
+                'version': version_flag4,
+                'entry_count': entry_count,
+                'gdx_size': gdx_size,
+                'gdx_start': gdx_start,
+                'entry_start': entry_start,
+                'data_start': data_start,
+            }
+
+        return self._header
+
+    @property
+    def gdx(self):
+        if self._gdx is None:
+            gdx_start = self.header['gdx_start']
+
+            gdx_magic = self.data[gdx_start:gdx_start+4].decode('ascii')
+            if gdx_magic != "GDXH" and gdx_magic != "GDXG":
+                print("Not a valid GDXH header")
+                exit(1)
+
+            default_hihat, default_snare, default_bass, default_hightom, default_lowtom, default_rightcymbal = struct.unpack_from("<HHHHHH", self.data, gdx_start+0x04)
+            if gdx_magic == "GDXH":
+                default_leftcymbal = 0xfff0
+                default_floortom = 0xfff1
+                default_leftpedal = 0xfff2
+                gdx_type_unk1 = self.data[gdx_start+0x10] # Not used anywhere?
+                gdx_volume_flag = self.data[gdx_start+0x11] # How does this work with GDXG?
+
+                filename_prefix = "g"
+
+            elif gdx_magic == "GDXG":
+                default_leftcymbal, default_floortom, default_leftpedal = struct.unpack_from("<HHH", self.data, gdx_start+0x10)
+                gdx_type_unk1 = 0
+                gdx_volume_flag = 1
+
+                filename_prefix = "d"
+
+            if self.force_game:
+                filename_prefix = self.force_game[0]
+
+            self._gdx = {
+                'type': gdx_magic,
+                'filename_prefix': filename_prefix,
+                'defaults': {
+                    'default_hihat': default_hihat,
+                    'default_snare': default_snare,
+                    'default_bass': default_bass,
+                    'default_hightom': default_hightom,
+                    'default_lowtom': default_lowtom,
+                    'default_rightcymbal': default_rightcymbal,
+                    'default_leftcymbal': default_leftcymbal,
+                    'default_floortom': default_floortom,
+                    'default_leftpedal': default_leftpedal,
+                },
+                'gdx_type_unk1': gdx_type_unk1,
+                'gdx_volume_flag': gdx_volume_flag,
+            }
+
+        return self._gdx
+
+    def get_entry(self, idx):
+        if idx in self._entries:
+            return self._entries[idx]
+
+        entry_count = self.header['entry_count']
+        entry_start = self.header['entry_start']
+        data_start = self.header['data_start']
+        entry_offset = entry_start + (idx * 0x40)
 
-    entries = []
-    prev_filesize = 0
-    for i in range(entry_count):
         # sound_flag seems to be related to defaults. If something is set to default, it is 0x02. Else it's 0x04 (for GDXG). Always 0 for GDXH?
         # entry_unk4 seems to always be 255??
-        offset, filesize, channels, bits, rate, entry_unk1, entry_unk2, volume, pan, sound_id, sound_flag, entry_unk4  = struct.unpack("<IIHHIIIBBHHH", data[entry_start+(i*0x40):entry_start+(i*0x40)+0x20])
-        filename = data[entry_start+(i*0x40)+0x20:entry_start+(i*0x40)+0x40].decode("ascii").strip('\0')
+        offset, filesize, channels, bits, rate, entry_unk1, entry_unk2, volume, pan, sound_id, sound_flag, entry_unk4 = struct.unpack_from("<IIHHIIIBBHHH", self.data, entry_offset)
+        filename = self.data[entry_offset+0x20:entry_offset+0x40].decode("ascii").strip('\0')
 
-        if filename_prefix == "g":
-            if i + 1 == entry_count:
-                filesize = len(data) - (data_start + offset)
+        if self.gdx['filename_prefix'] == "g":
+            if idx + 1 == entry_count:
+                filesize = len(self.data) - (data_start + offset)
 
             else:
-                filesize = int.from_bytes(data[entry_start+((i+1)*0x40):entry_start+((i+1)*0x40)+4], 'little')
-                t = prev_filesize
-                prev_filesize = filesize
-                filesize -= t
+                filesize = struct.unpack_from("<I", self.data, entry_offset + 0x40)[0]
+
+                if idx > 0:
+                    filesize -= offset
 
         elif entry_unk1 != 0:
             filesize = entry_unk1
@@ -296,13 +402,13 @@ def read_vas3(input_filename, output_folder, force_hex=False, mix_audio=False, f
             exit(1)
 
         if sound_id == 0xfff0:
-            sound_id = default_leftcymbal
+            sound_id = self.gdx['defaults']['default_leftcymbal']
         elif sound_id == 0xfff1:
-            sound_id = default_floortom
+            sound_id = self.gdx['defaults']['default_floortom']
         elif sound_id == 0xfff2:
-            sound_id = default_leftpedal
+            sound_id = self.gdx['defaults']['default_leftpedal']
 
-        entries.append({
+        self._entries[idx] = {
             'sound_id': sound_id,
             'filename': filename,
             'offset': offset,
@@ -312,18 +418,88 @@ def read_vas3(input_filename, output_folder, force_hex=False, mix_audio=False, f
             'rate': rate,
             'volume': volume,
             'pan': pan,
-        })
+            'sound_flag': sound_flag,
+            'extra': entry_unk4,
+        }
+
+        return self._entries[idx]
+
+    @property
+    def entries(self):
+        return [self.get_entry(idx) for idx in range(len(self))]
+
+    def get_entry_by_sound_id(self, sound_id):
+        if self._sound_ids is None:
+            self._sound_ids = {}
+
+            for idx in range(len(self)):
+                self._sound_ids.setdefault(self.get_entry(idx)['sound_id'], idx)
+
+        if sound_id not in self._sound_ids:
+            return None
+
+        return self.get_entry(self._sound_ids[sound_id])
+
+    def get_duration(self, entry):
+        # Every byte holds two samples, so the length can be worked out without decoding anything
+        frames = entry['filesize'] * 2 // entry['channels']
+        return frames / entry['rate']
+
+    def get_slice(self, entry):
+        start = self.header['data_start'] + entry['offset']
+        return (start, entry['filesize'], entry['channels'])
+
+    def get_data(self, entry):
+        start, length, _ = self.get_slice(entry)
+        return memoryview(self.data)[start:start+length]
+
+    def decode(self, entries=None):
+        """Decode a list of entries (everything by default) into int16 arrays"""
+
+        if entries is None:
+            entries = self.entries
+
+        return adpcmwave.decode_batch(self.data, [self.get_slice(entry) for entry in entries])
+
+
+def read_vas3(input_filename, output_folder, force_hex=False, mix_audio=False, force_game=None, metadata_only=False, sound_ids=None):
+    archive = VA3Archive(input_filename, force_game)
+
+    if len(archive) <= 0:
+        print("No files to extract")
+        exit(1)
+
+    gdx = archive.gdx
+    filename_prefix = gdx['filename_prefix']
+
+    metadata = {
+        'type': gdx['type'],
+        'version': archive.header['version'],
+        'defaults': gdx['defaults'],
+        'gdx_type_unk1': gdx['gdx_type_unk1'],
+        'gdx_volume_flag': gdx['gdx_volume_flag'],
+        'entries': [],
+    }
+
+    entries = archive.entries
+    for entry in entries:
+        sound_flag = entry['sound_flag']
 
         metadata['entries'].append({
-            'sound_id': sound_id,
-            'filename': filename,
-            'volume': volume,
-            'pan': pan,
-            'extra': entry_unk4, # Unknown flag, most likely always 255
+            'sound_id': entry['sound_id'],
+            'filename': entry['filename'],
+            'volume': entry['volume'],
+            'pan': entry['pan'],
+            'extra': entry['extra'], # Unknown flag, most likely always 255
             'flags': [],
+            'duration': archive.get_duration(entry),
+            'rate': entry['rate'],
+            'channels': entry['channels'],
+            'bits': entry['bits'],
+            'raw_filesize': entry['filesize'],
         })
 
-        if version_flag4 < 2:
+        if archive.header['version'] < 2:
             if (sound_flag & 0x02) != 0:
                 metadata['entries'][-1]['flags'].append(0x02)
 
@@ -337,55 +513,39 @@ def read_vas3(input_filename, output_folder, force_hex=False, mix_audio=False, f
 
     os.makedirs(basepath, exist_ok=True)
 
-    for entry in entries:
-        # print("Extracting", entry['filename'])
+    if metadata_only:
+        extract_entries = []
+    elif sound_ids is not None:
+        extract_entries = [(entry, entry_metadata) for entry, entry_metadata in zip(entries, metadata['entries']) if entry['sound_id'] in sound_ids]
+    else:
+        extract_entries = list(zip(entries, metadata['entries']))
 
-        print(entry)
+    # Decode every entry at once, each entry gets a view into one shared buffer
+    decoded_entries = archive.decode([entry for entry, _ in extract_entries])
 
-        wave_data = bytearray(data[data_start+entry['offset']:data_start+entry['offset']+entry['filesize']])
+    for (entry, entry_metadata), output in zip(extract_entries, decoded_entries):
+        # print("Extracting", entry['filename'])
 
-        output = adpcmwave.decode_data(wave_data, entry['rate'], entry['channels'], entry['bits'])
+        print(entry)
 
         output_filename = os.path.join(basepath, "{}_{}.wav".format(filename_prefix, entry['filename']))
 
         if (sound_flag & 0x100) != 0 or force_hex:
             output_filename = os.path.join(basepath, "%s_%04x.wav" % (filename_prefix, entry['sound_id']))
 
-        output = numpy.ndarray((int(len(output) // 2 // entry['channels']), entry['channels']), numpy.int16, output, 0)
+        # If mixing is enabled, apply the volume and pan before writing the file
+        if mix_audio:
+            pan = (entry['pan'] - (128 / 2)) / (128 / 2)
+            gain = pydub.utils.db_to_float(20 * math.log10(entry['volume'] / 127)) if entry['volume'] > 0 else 0
+            output = audio.apply_pan_and_gain(output, pan, gain)
 
         wavfile.write(output_filename, entry['rate'], output)
 
-        # If mixing is enabled, mix using AudioSegment
         if mix_audio:
-            # audio_segment = pydub.AudioSegment(
-            #     output_stream.getbuffer(),
-            #     frame_rate=entry['rate'],
-            #     sample_width=entry['bits'] // 8,
-            #     channels=entry['channels']
-            # )
-
-            audio_segment = pydub.AudioSegment.from_file(output_filename)
-            pan = (entry['pan'] - (128 / 2)) / (128 / 2)
-            audio_segment = audio_segment.pan(pan)
-            db = 20 * math.log10(entry['volume'] / 127)
-            audio_segment += db
-            audio_segment.export(output_filename, format="wav")
-
-            entry['volume'] = 127
-            entry['pan'] = 64
-
-        entry['duration'] = (entry['filesize'] * (entry['bits'] // 8) * entry['channels']) / entry['rate']
-
-        for idx in range(len(metadata['entries'])):
-            if metadata['entries'][idx]['sound_id'] == entry['sound_id']:
-                metadata['entries'][idx]['volume'] = entry['volume']
-                metadata['entries'][idx]['pan'] = entry['pan']
-                metadata['entries'][idx]['duration'] = entry['duration']
-                metadata['entries'][idx]['rate'] = entry['rate']
-                metadata['entries'][idx]['channels'] = entry['channels']
-                metadata['entries'][idx]['bits'] = entry['bits']
-                metadata['entries'][idx]['raw_filesize'] = entry['filesize']
-                break
+            entry_metadata['volume'] = 127
+            entry_metadata['pan'] = 64
+
+    archive.close()
 
     open(os.path.join(basepath, "%s_metadata.json" % filename_prefix), "w").write(json.dumps(metadata, indent=4))
 
@@ -400,10 +560,14 @@ if __name__ == "__main__":
     parser.add_argument('-m', '--mix', action='store_true', help='Mix output files using volume and pan parameters', required=False, default=False)
     parser.add_argument('-f', '--force-hex', action='store_true', help='Force hex filenames', required=False, default=False)
     parser.add_argument('-g', '--force-game', help='Force game type', required=True, default=None, choices=['drum', 'guitar'])
+    parser.add_argument('-w', '--workers', help='Number of processes used for encoding (default: number of CPUs)', type=int, default=None)
+    parser.add_argument('--no-cache', action='store_true', help='Don\'t use or update the encoded keysound cache', required=False, default=False)
+    parser.add_argument('--metadata-only', action='store_true', help='Only write the metadata JSON without extracting any sounds', required=False, default=False)
+    parser.add_argument('--ids', nargs='+', type=lambda x: int(x, 0), help='Only extract the sounds with these sound IDs (0x prefix for hex)', required=False, default=None)
     args = parser.parse_args()
 
     if args.create:
-        write_vas3(args.input, args.output, args.force_game)
+        write_vas3(args.input, args.output, args.force_game, workers=args.workers, use_cache=not args.no_cache)
 
     elif args.extract:
-        read_vas3(args.input, args.output, args.force_hex, args.mix, args.force_game)
+        read_vas3(args.input, args.output, args.force_hex, args.mix, args.force_game, args.metadata_only, args.ids)
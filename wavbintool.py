@@ -1,5 +1,6 @@
 import argparse
 import os
+import time
 import adpcmwave
 import numpy
 import struct
@@ -13,17 +14,19 @@ import helper
 
 helper.check_ffmpeg()
 
-def parse_bin(input_filename, output_filename):
-    with open(input_filename,"rb") as f:
-        data = f.read()
+# Size of each piece of a .bin file that is decoded at a time
+CHUNK_SIZE = 0x40000
+
+def read_header(f):
+    header = f.read(0x20)
 
-    if data[0:4].decode('ascii') != "BMP\0":
+    if header[0:4].decode('ascii') != "BMP\0":
         print("Not a BMP audio file")
         exit(1)
 
-    data_size, loop_start, loop_end = struct.unpack(">III", data[0x04:0x10])
-    channels, bits = struct.unpack("<HH", data[0x10:0x14])
-    rate, = struct.unpack(">I", data[0x14:0x18])
+    data_size, loop_start, loop_end = struct.unpack(">III", header[0x04:0x10])
+    channels, bits = struct.unpack("<HH", header[0x10:0x14])
+    rate, = struct.unpack(">I", header[0x14:0x18])
 
     is_looped = True if loop_start > 0 or loop_end > 0 else False
 
@@ -36,18 +39,82 @@ def parse_bin(input_filename, output_filename):
     else:
         loops = None
 
-    data = bytearray(data[0x20:])
-    output = adpcmwave.decode_data(data, rate, channels, bits)
-    output = numpy.ndarray((int(len(output) // 2 // channels), channels), numpy.int16, output, 0)
-    wavfile.write(output_filename, rate, output, loops=loops)
+    return channels, bits, rate, loops
+
+
+def parse_bin(input_filename, output_filename, chunk_size=CHUNK_SIZE):
+    with open(input_filename,"rb") as f:
+        channels, bits, rate, loops = read_header(f)
+
+        # Decode and write the audio a piece at a time so memory usage doesn't depend on the length of the song
+        chunks = iter(lambda: f.read(chunk_size), b"")
+        wavfile.write_chunks(output_filename, rate, channels, adpcmwave.decode_chunks(chunks, channels), loops=loops)
+
+
+def decode_bin_channel(input_filename, output_filename, data_offset, channel, chunk_size=CHUNK_SIZE):
+    # Decode one channel of a .bin file into its column of an already allocated WAV file
+    start_time = time.time()
+
+    with open(input_filename, "rb") as f:
+        f.seek(0x10)
+        channels, = struct.unpack("<H", f.read(2))
+        f.seek(0x20)
+
+        frames = (os.path.getsize(input_filename) - 0x20) * 2 // channels
+        if frames == 0:
+            return start_time, time.time()
+
+        output = numpy.memmap(output_filename, dtype=numpy.int16, mode='r+', offset=data_offset, shape=(frames, channels))
+
+        state = adpcmwave.INITIAL_STATE
+        frame = 0
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            nibbles = adpcmwave.split_nibbles(chunk, channels)[0 if channels == 1 else channel]
+            decoded, state = adpcmwave.decode_nibbles(nibbles, state)
+            output[frame:frame+len(decoded), channel] = decoded
+            frame += len(decoded)
+
+        output.flush()
+        del output
+
+    return start_time, time.time()
+
+
+def parse_bins(filenames, workers=None, chunk_size=CHUNK_SIZE):
+    """Convert several .bin files to WAV using a pool of processes.
+
+    filenames is a list of (input_filename, output_filename) tuples.
+    Every channel of a file is decoded by its own worker.
+    Returns a dict of the time taken to convert each output file.
+    """
+
+    jobs = {}
+    for input_filename, output_filename in filenames:
+        with open(input_filename, "rb") as f:
+            channels, bits, rate, loops = read_header(f)
+
+        frames = (os.path.getsize(input_filename) - 0x20) * 2 // channels
+        data_offset = wavfile.allocate(output_filename, rate, channels, frames, loops=loops)
+        jobs[output_filename] = [(input_filename, output_filename, data_offset, channel, chunk_size) for channel in range(channels)]
+
+    timings = {}
+    with helper.get_process_pool(workers) as executor:
+        futures = {output_filename: [executor.submit(decode_bin_channel, *job) for job in file_jobs] for output_filename, file_jobs in jobs.items()}
+
+        for output_filename, file_futures in futures.items():
+            times = [future.result() for future in file_futures]
+            timings[output_filename] = max(end for _, end in times) - min(start for start, _ in times)
+            print("Converted %s in %.2fs" % (output_filename, timings[output_filename]))
+
+    return timings
 
 def parse_wav(input_filename, output_filename, loop_start=None, loop_end=None, channels=2, rate=48000):
-    input_filename = audio.get_processed_wav(input_filename, channels=channels, rate=rate, bits=16)
+    processed = audio.get_processed_audio(input_filename, channels=channels, rate=rate, bits=16, readloops=True)
 
-    if not input_filename:
+    if not processed:
         return
 
-    rate, data, bits, loops = wavfile.read(input_filename, readloops=True)
+    rate, data, bits, loops = processed
     channels = 1 if len(data.shape) == 1 else data.shape[1]
 
     if len(loops) > 0:
@@ -82,9 +149,10 @@ if __name__ == "__main__":
     parser.add_argument('-r', '--rate', help='Sample rate for input WAV', type=int, default=48000)
     parser.add_argument('-ls', '--loop-start', help='Loop start point (in bytes)', type=int, default=None)
     parser.add_argument('-le', '--loop-end', help='Loop end point (in bytes)', type=int, default=None)
+    parser.add_argument('-w', '--workers', help='Number of processes used for decoding (default: number of CPUs)', type=int, default=None)
     args = parser.parse_args()
 
     if args.decode:
-        parse_bin(args.input, args.output)
+        parse_bins([(args.input, args.output)], args.workers)
     elif args.encode:
         parse_wav(args.input, args.output, args.loop_start, args.loop_end, args.channels, args.rate)
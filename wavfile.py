@@ -44,27 +44,27 @@ from operator import itemgetter
 class WavFileWarning(UserWarning):
     pass
 
-_ieee = False
-
 # assumes file pointer is immediately
 #  after the 'fmt ' id
 def _read_fmt_chunk(fid):
     res = struct.unpack('<ihHIIHH',fid.read(20))
     size, comp, noc, rate, sbytes, ba, bits = res
+    ieee = False
+    extra = fid.read(size-16) if size > 16 else b''
+    if (comp & 0xffff) == 0xfffe and len(extra) >= 10:
+        # WAVE_FORMAT_EXTENSIBLE: the real format is the first two bytes of the sub-format GUID
+        comp = struct.unpack('<H', extra[8:10])[0]
     if (comp != 1 or size > 16):
         if (comp == 3):
-          global _ieee
-          _ieee = True
+          ieee = True
           #warnings.warn("IEEE format not supported", WavFileWarning)
-        else:
+        elif (comp != 1):
           warnings.warn("Unfamiliar format bytes", WavFileWarning)
-        if (size>16):
-            fid.read(size-16)
-    return size, comp, noc, rate, sbytes, ba, bits
+    return size, comp, noc, rate, sbytes, ba, bits, ieee
 
 # assumes file pointer is immediately
 #   after the 'data' id
-def _read_data_chunk(fid, noc, bits, normalized=False):
+def _read_data_chunk(fid, noc, bits, normalized=False, ieee=False):
     size = struct.unpack('<i',fid.read(4))[0]
 
     if bits == 8 or bits == 24:
@@ -74,7 +74,7 @@ def _read_data_chunk(fid, noc, bits, normalized=False):
         bytes = bits//8
         dtype = '<i%d' % bytes
 
-    if bits == 32 and _ieee:
+    if bits == 32 and ieee:
        dtype = 'float32'
 
     data = numpy.fromfile(fid, dtype=dtype, count=size//bytes)
@@ -150,6 +150,7 @@ def read(file, readmarkers=False, readmarkerlabels=False, readmarkerslist=False,
     fsize = _read_riff_chunk(fid)
     noc = 1
     bits = 8
+    ieee = False
     #_cue = []
     #_cuelabels = []
     _markersdict = collections.defaultdict(lambda: {'position': -1, 'label': ''})
@@ -159,9 +160,9 @@ def read(file, readmarkers=False, readmarkerlabels=False, readmarkerslist=False,
         # read the next chunk
         chunk_id = fid.read(4)
         if chunk_id == b'fmt ':
-            size, comp, noc, rate, sbytes, ba, bits = _read_fmt_chunk(fid)
+            size, comp, noc, rate, sbytes, ba, bits, ieee = _read_fmt_chunk(fid)
         elif chunk_id == b'data':
-            data = _read_data_chunk(fid, noc, bits, normalized)
+            data = _read_data_chunk(fid, noc, bits, normalized, ieee)
         elif chunk_id == b'cue ':
             str1 = fid.read(8)
             size, numcue = struct.unpack('<ii',str1)
@@ -214,6 +215,26 @@ def read(file, readmarkers=False, readmarkerlabels=False, readmarkerslist=False,
 
 
 
+def _write_smpl_chunk(fid, rate, loops=None, pitch=None):
+    if loops or pitch:
+      if not loops:
+        loops = []
+      if pitch:
+        midiunitynote = 12 * numpy.log2(pitch * 1.0 / 440.0) + 69
+        midipitchfraction = int((midiunitynote - int(midiunitynote)) * (2**32-1))
+        midiunitynote = int(midiunitynote)
+        #print(midipitchfraction, midiunitynote)
+      else:
+        midiunitynote = 0
+        midipitchfraction = 0
+      fid.write(b'smpl')
+      size = 36 + len(loops) * 24
+      sampleperiod = int(1000000000.0 / rate)
+
+      fid.write(struct.pack('<iiiiiIiiii', size, 0, 0, sampleperiod, midiunitynote, midipitchfraction, 0, 0, len(loops), 0))
+      for i, loop in enumerate(loops):
+        fid.write(struct.pack('<iiiiii', 0, 0, loop[0], loop[1], 0, 0))
+
 def write(filename, rate, data, bitrate=None, markers=None, loops=None, pitch=None, normalized=False):
     """
     Write a numpy array as a WAV file
@@ -307,28 +328,114 @@ def write(filename, rate, data, bitrate=None, markers=None, loops=None, pitch=No
         fid.write(lbls)
 
     # smpl chunk
-    if loops or pitch:
-      if not loops:
-        loops = []
-      if pitch:
-        midiunitynote = 12 * numpy.log2(pitch * 1.0 / 440.0) + 69
-        midipitchfraction = int((midiunitynote - int(midiunitynote)) * (2**32-1))
-        midiunitynote = int(midiunitynote)
-        #print(midipitchfraction, midiunitynote)
-      else:
-        midiunitynote = 0
-        midipitchfraction = 0
-      fid.write(b'smpl')
-      size = 36 + len(loops) * 24
-      sampleperiod = int(1000000000.0 / rate)
-
-      fid.write(struct.pack('<iiiiiIiiii', size, 0, 0, sampleperiod, midiunitynote, midipitchfraction, 0, 0, len(loops), 0))
-      for i, loop in enumerate(loops):
-        fid.write(struct.pack('<iiiiii', 0, 0, loop[0], loop[1], 0, 0))
+    _write_smpl_chunk(fid, rate, loops, pitch)
 
     # Determine file size and place it in correct
     #  position at start of the file.
     size = fid.tell()
     fid.seek(4)
     fid.write(struct.pack('<i', size-8))
-    fid.close()
\ No newline at end of file
+    fid.close()
+
+def write_chunks(filename, rate, noc, chunks, loops=None, pitch=None):
+    """
+    Write a WAV file from an iterable of numpy arrays
+
+    Only one chunk has to be held in memory at a time, so this is suited
+    to audio that is being decoded on the fly.
+
+    Parameters
+    ----------
+    filename : file
+        The name of the file to write (will be over-written).
+    rate : int
+        The sample rate (in samples/sec).
+    noc : int
+        The number of channels.
+    chunks : iterable
+        1-D or 2-D numpy arrays of the same integer data-type.
+
+    """
+
+    fid = open(filename, 'wb')
+    fid.write(b'RIFF')
+    fid.write(b'\x00\x00\x00\x00')
+    fid.write(b'WAVE')
+
+    # fmt chunk is written once the data-type of the first chunk is known
+    fmt_pos = fid.tell()
+    fid.write(b'\x00' * 24)
+
+    fid.write(b'data')
+    data_size_pos = fid.tell()
+    fid.write(b'\x00\x00\x00\x00')
+
+    import sys
+    data_size = 0
+    itemsize = 2
+    for data in chunks:
+        itemsize = data.dtype.itemsize
+        if data.dtype.byteorder == '>' or (data.dtype.byteorder == '=' and sys.byteorder == 'big'):
+            data = data.byteswap()
+
+        data.tofile(fid)
+        data_size += data.nbytes
+
+    # smpl chunk
+    _write_smpl_chunk(fid, rate, loops, pitch)
+
+    size = fid.tell()
+
+    bits = itemsize * 8
+    sbytes = rate * (bits // 8) * noc
+    ba = noc * (bits // 8)
+    fid.seek(fmt_pos)
+    fid.write(b'fmt ')
+    fid.write(struct.pack('<ihHIIHH', 16, 1, noc, rate, sbytes, ba, bits))
+
+    fid.seek(data_size_pos)
+    fid.write(struct.pack('<i', data_size))
+
+    fid.seek(4)
+    fid.write(struct.pack('<i', size-8))
+    fid.close()
+
+def allocate(filename, rate, noc, nframes, dtype=numpy.int16, loops=None, pitch=None):
+    """
+    Create a WAV file with room for nframes of audio data
+
+    The data is left zeroed so it can be filled in later, for example
+    through numpy.memmap. Returns the byte offset of the audio data.
+
+    """
+
+    dtype = numpy.dtype(dtype)
+    bits = dtype.itemsize * 8
+    sbytes = rate * (bits // 8) * noc
+    ba = noc * (bits // 8)
+    data_size = nframes * ba
+
+    fid = open(filename, 'wb')
+    fid.write(b'RIFF')
+    fid.write(b'\x00\x00\x00\x00')
+    fid.write(b'WAVE')
+
+    fid.write(b'fmt ')
+    fid.write(struct.pack('<ihHIIHH', 16, 1, noc, rate, sbytes, ba, bits))
+
+    fid.write(b'data')
+    fid.write(struct.pack('<i', data_size))
+    data_offset = fid.tell()
+
+    fid.seek(data_size, 1)
+    fid.truncate()
+
+    # smpl chunk
+    _write_smpl_chunk(fid, rate, loops, pitch)
+
+    size = fid.tell()
+    fid.seek(4)
+    fid.write(struct.pack('<i', size-8))
+    fid.close()
+
+    return data_offset